@@ -0,0 +1,125 @@
+"""
+Compare binding keys in chunked IN lists of several sizes against selecting them from a temporary table, for
+growing numbers of keys, to find where batching should switch over.
+
+    python -m sample_db.benchmarks.batching --tubes 100000 --keys 100,1000,10000,50000
+
+Runs against a file database in a temporary directory, filled with matrix tubes of a single specimen.
+"""
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+from sqlalchemy import select
+
+from ..db_impl.app import SampleDB
+from ..db_impl.models import StudySubject, Specimen, StorageContainer, MatrixTube
+from ..db_impl.batching import chunks, in_criteria, DEFAULT_MAX_PARAMETERS
+
+CHUNK_SIZES = (500, 999, 5000, 32766)
+
+
+def fill(db, tubes):
+    """
+    Insert tubes matrix tubes with barcodes MT00000000 and up, all holding the same specimen.
+    :return: Barcodes
+    """
+    study = db.create_study('Benchmark', 'BM', False, 'Benchmark')
+    specimen_type = db.register_new_specimen_type('DNA')
+    storage_container = StorageContainer.__table__
+    matrix_tube = MatrixTube.__table__
+    barcodes = ['MT{:08d}'.format(_) for _ in range(tubes)]
+    with db._session_scope() as session:
+        study_subject_id = session.execute(StudySubject.__table__.insert().values(
+            uid='1', study_id=study.id)).inserted_primary_key[0]
+        specimen_id = session.execute(Specimen.__table__.insert().values(
+            study_subject_id=study_subject_id, specimen_type_id=specimen_type.id)).inserted_primary_key[0]
+        session.execute(storage_container.insert(), [
+            {'id': i + 1, 'specimen_id': specimen_id, 'type': 'matrix_tube', 'exhausted': False}
+            for i in range(tubes)])
+        session.execute(matrix_tube.insert(), [
+            {'id': i + 1, 'barcode': barcode, 'well_position': 'A01'} for i, barcode in enumerate(barcodes)])
+    db.remove_session()
+    return barcodes
+
+
+def lookup(session, criteria):
+    matrix_tube = MatrixTube.__table__
+    ids = []
+    for criterion in criteria:
+        ids += [_ for _, in session.execute(select([matrix_tube.c.id]).where(criterion))]
+    return ids
+
+
+def update(session, criteria):
+    storage_container = StorageContainer.__table__
+    for criterion in criteria:
+        session.execute(storage_container.update().where(criterion).values(exhausted=True))
+
+
+def best_of(repeat, db, func):
+    """
+    Time func in a session of its own, rolled back so updates can be repeated.
+    :return: Fastest of repeat timings in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        session = db._session()
+        start = time.time()
+        func(session)
+        timings.append(time.time() - start)
+        session.rollback()
+        db.remove_session()
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tubes', type=int, default=100000, help="Matrix tubes in the database.")
+    parser.add_argument('--keys', default='100,1000,5000,10000,50000', help="Comma separated numbers of keys.")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs of each strategy, the fastest counts.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the keys drawn.")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        # Every key count above the threshold selects its keys from the temporary table.
+        db = SampleDB('sqlite:///' + os.path.join(directory, 'batching.db'), temp_table_threshold=0)
+        barcodes = fill(db, args.tubes)
+        session = db._session()
+        max_parameters = session.connection().info.get('max_parameters', DEFAULT_MAX_PARAMETERS)
+        db.remove_session()
+        chunk_sizes = [_ for _ in CHUNK_SIZES if _ <= max_parameters]
+        print('{} matrix tubes, at most {} bound parameters per statement'.format(args.tubes, max_parameters))
+
+        strategies = ['chunks of {}'.format(_) for _ in chunk_sizes] + ['temp table']
+        rng = random.Random(args.seed)
+        for operation, func in (('select', lookup), ('update', update)):
+            print('')
+            print('{:>8}  '.format(operation) + ''.join(['{:>16}'.format(_) for _ in strategies]))
+            for count in [int(_) for _ in args.keys.split(',')]:
+                # Lookups go by barcode, updates by ID.
+                if operation == 'select':
+                    keys = rng.sample(barcodes, min(count, len(barcodes)))
+                    column = MatrixTube.__table__.c.barcode
+                else:
+                    keys = rng.sample(range(1, len(barcodes) + 1), min(count, len(barcodes)))
+                    column = StorageContainer.__table__.c.id
+                timings = []
+                for size in chunk_sizes:
+                    timings.append(best_of(args.repeat, db, lambda session: func(
+                        session, [column.in_(_) for _ in chunks(keys, size)])))
+                timings.append(best_of(args.repeat, db, lambda session: func(
+                    session, in_criteria(session, column, keys))))
+                fastest = strategies[timings.index(min(timings))]
+                print('{:>8}  '.format(len(keys)) + ''.join(['{:>13.1f} ms'.format(_ * 1000) for _ in timings]) +
+                      '   fastest: ' + fastest)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import random
+import datetime
+from collections import namedtuple
+
+from ..db_impl.occupancy import WELLS
+
+# What generate created, plus every tube as the specimen entry it was uploaded with.
+Dataset = namedtuple('Dataset', ['studies', 'specimen_types', 'locations', 'plates', 'tubes', 'generated_at'])
+
+SCALES = {
+    'tiny': {'studies': 2, 'subjects': 50, 'timepoints': 2, 'locations': 2, 'plates': 5},
+    'small': {'studies': 4, 'subjects': 500, 'timepoints': 4, 'locations': 4, 'plates': 50},
+    'medium': {'studies': 8, 'subjects': 2000, 'timepoints': 6, 'locations': 8, 'plates': 500},
+    'large': {'studies': 12, 'subjects': 5000, 'timepoints': 8, 'locations': 12, 'plates': 2000},
+}
+
+SPECIMEN_TYPES = ('DNA', 'Plasma', 'Serum', 'DBS', 'Whole Blood', 'PBMC')
+
+
+def generate(db, studies=4, subjects=500, timepoints=4, specimen_types=SPECIMEN_TYPES, locations=4, plates=50,
+             seed=0):
+    """
+    Fill a database with synthetic lab data, the same for the same arguments and seed. Every other study is
+    longitudinal, its subjects are sampled at up to timepoints collection dates a month apart. Plates are full 96
+    well plates whose tubes hold randomly chosen specimens, so some specimens end up with several aliquots.
+    :param db: SampleDB to fill, preferably empty.
+    :param studies: Number of studies.
+    :param subjects: Number of study subjects each study samples from.
+    :param timepoints: Number of collection dates of subjects of longitudinal studies.
+    :param specimen_types: Labels of the specimen types to register.
+    :param locations: Number of freezers plates are spread over.
+    :param plates: Number of plates.
+    :param seed: Random seed.
+    :return: Dataset
+    """
+    rng = random.Random(seed)
+    specimen_types = [db.register_new_specimen_type(_) for _ in specimen_types]
+    locations = [db.register_new_location('Freezer {}'.format(i + 1)) for i in range(locations)]
+    studies = [db.create_study('Study {}'.format(i + 1), 'S{}'.format(i + 1), i % 2 == 0,
+                               'Investigator {}'.format(i + 1), 'Synthetic study') for i in range(studies)]
+    enrollment = datetime.date(2017, 1, 1)
+
+    matrix_plates = []
+    tubes = []
+    for plate in range(plates):
+        plate_uid = 'PL{:06d}'.format(plate)
+        specimen_entries = []
+        for well in WELLS:
+            study = rng.choice(studies)
+            timepoint = rng.randrange(timepoints) if study.is_longitudinal else None
+            specimen_entries.append({
+                'uid': '{}-{:05d}'.format(study.short_code, rng.randrange(subjects)),
+                'short_code': study.short_code,
+                'specimen_type': rng.choice(specimen_types).label,
+                'collection_date': enrollment + datetime.timedelta(days=30 * timepoint)
+                if timepoint is not None else None,
+                'barcode': 'MT{:08d}'.format(len(tubes) + len(specimen_entries)),
+                'well_position': well,
+                'comments': None,
+                'plate_uid': plate_uid
+            })
+        matrix_plates.append(db.add_matrix_plate_with_specimens(
+            plate_uid, rng.choice(locations).id, specimen_entries, create_missing_specimens=True,
+            create_missing_subjects=True)[0])
+        tubes += specimen_entries
+        db.remove_session()
+    return Dataset(studies, specimen_types, locations, matrix_plates, tubes, datetime.datetime.utcnow())
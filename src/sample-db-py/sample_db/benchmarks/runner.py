@@ -0,0 +1,330 @@
+"""
+Time the public SampleDB methods and the main endpoints against a generated dataset.
+
+    python -m sample_db.benchmarks.runner --scale small --output results.json
+    python -m sample_db.benchmarks.runner --scale small --compare results.json
+
+Every case reports throughput, p50 and p99 latency and the number of SQL statements per call. Results are saved
+as JSON, --compare prints the change against a previous run. Endpoints run through the Flask test client, which
+starts the Flask application with its Benchmark configuration, keeping its data in the temporary directory of the
+run; skip them with --no-endpoints where it cannot start.
+"""
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import datetime
+import itertools
+import tempfile
+from collections import namedtuple
+from StringIO import StringIO
+
+from data import generate, SCALES
+from ..db_impl.app import SampleDB
+from ..db_impl.occupancy import WELLS
+
+# A timed operation. setup is called before every run, untimed, and returns the arguments of run.
+Case = namedtuple('Case', ['name', 'run', 'setup'])
+
+# Public methods that are not timed on their own.
+UNTIMED = {
+    'remove_session',
+    'iter_find_specimens',  # Through find_specimens.
+    'iter_convert_barcoded_entries',  # Through convert_barcoded_entries.
+}
+
+
+def case(name, run, setup=None):
+    return Case(name, run, setup or (lambda i: ()))
+
+
+def percentile(timings, p):
+    """
+    Nearest rank percentile of a sorted list.
+    """
+    return timings[max(0, int(math.ceil(p / 100.0 * len(timings))) - 1)]
+
+
+def measure(db, c, repeat):
+    """
+    Run a case repeat times, every run with a fresh session like a request would get.
+    :return: Dict of the case's statistics
+    """
+    timings = []
+    statements = 0
+    for i in range(repeat):
+        args = c.setup(i)
+        db.remove_session()
+        with db.query_recorder.recording() as stats:
+            start = time.time()
+            c.run(*args)
+            timings.append(time.time() - start)
+        statements += stats.count
+        db.remove_session()
+    timings.sort()
+    return {
+        'name': c.name,
+        'runs': repeat,
+        'throughput': repeat / sum(timings) if sum(timings) else None,
+        'p50_ms': percentile(timings, 50) * 1000,
+        'p99_ms': percentile(timings, 99) * 1000,
+        'statements': float(statements) / repeat,
+    }
+
+
+def method_cases(db, dataset):
+    study = dataset.studies[0]
+    plate = dataset.plates[0]
+    location = dataset.locations[0]
+    specimen_type = dataset.specimen_types[0]
+    tube = dataset.tubes[0]
+    barcodes = [_['barcode'] for _ in dataset.tubes[:100]]
+    # Searches get collection dates as parsed from files.
+    search_entries = [dict(_, collection_date=datetime.datetime.combine(_['collection_date'], datetime.time())
+                           if _['collection_date'] else None) for _ in dataset.tubes[:1000]]
+    names = ('BM{:06d}'.format(_) for _ in itertools.count())
+
+    def new_study(i):
+        name = next(names)
+        return db.create_study(name, name, False, 'Benchmark'),
+
+    def new_plate(i):
+        study_code = study.short_code
+        specimen_entries = [{'uid': next(names), 'short_code': study_code, 'specimen_type': specimen_type.label,
+                             'collection_date': datetime.date(2017, 1, 1), 'barcode': next(names),
+                             'well_position': well, 'comments': None} for well in WELLS]
+        return next(names), location.id, specimen_entries, True, True
+
+    def filled_plate(i):
+        return db.add_matrix_plate_with_specimens(*new_plate(i))
+
+    def stored_specimen_entries(i):
+        plate = new_plate(i)
+        db.add_matrix_plate_with_specimens(*plate)
+        return plate[2],
+
+    # Tubes of one plate are moved to a new, empty plate on every run.
+    moving = [_['barcode'] for _ in dataset.tubes if _['plate_uid'] == plate.uid]
+
+    def moves(i):
+        plate_uid = next(names)
+        db.add_matrix_plate_with_specimens(plate_uid, location.id, [])
+        return [{'barcode': barcode, 'plate_uid': plate_uid, 'well_position': well}
+                for barcode, well in zip(moving, WELLS)],
+
+    def edited_study(i):
+        edited = db.get_study(study.id)[0]
+        edited.description = 'Edited {}'.format(i)
+        return edited,
+
+    return [
+        case('get_studies', lambda: db.get_studies()),
+        case('get_study', lambda: db.get_study(study.id)),
+        case('dump_study', lambda: db.dump_study(study.id)),
+        case('get_study_changes', lambda: db.get_study_changes(study.id, dataset.generated_at)),
+        case('get_study_by_short_code', lambda: db.get_study_by_short_code(study.short_code)),
+        case('get_study_subjects', lambda: db.get_study_subjects(study.id)),
+        case('create_study', lambda name: db.create_study(name, name, False, 'Benchmark'),
+             lambda i: (next(names),)),
+        case('edit_study', db.edit_study, edited_study),
+        case('update_study', lambda i: db.update_study(study.id, {'description': 'Updated {}'.format(i)}),
+             lambda i: (i,)),
+        case('delete_study', db.delete_study, new_study),
+        case('add_study_subject', lambda uid: db.add_study_subject(uid, study.id), lambda i: (next(names),)),
+        case('add_study_subjects', lambda uids: db.add_study_subjects(uids, study.id),
+             lambda i: ([next(names) for _ in range(100)],)),
+        case('delete_study_subject', db.delete_study_subject,
+             lambda i: (db.add_study_subject(next(names), study.id).id,)),
+        case('get_locations', lambda: db.get_locations()),
+        case('get_location', lambda: db.get_location(location.id)),
+        case('register_new_location', db.register_new_location, lambda i: (next(names),)),
+        case('update_location', lambda i: db.update_location(location.id, {'description': next(names)}),
+             lambda i: (i,)),
+        case('delete_location', db.delete_location, lambda i: (db.register_new_location(next(names)).id,)),
+        case('get_specimen_types', lambda: db.get_specimen_types()),
+        case('get_specimen_type', lambda: db.get_specimen_type(specimen_type.id)),
+        case('register_new_specimen_type', db.register_new_specimen_type, lambda i: (next(names),)),
+        case('update_specimen_type', lambda specimen_type_id: db.update_specimen_type(
+            specimen_type_id, {'label': next(names)}), lambda i: (db.register_new_specimen_type(next(names)).id,)),
+        case('delete_specimen_type', db.delete_specimen_type,
+             lambda i: (db.register_new_specimen_type(next(names)).id,)),
+        case('get_specimens', lambda: db.get_specimens(tube['uid'], tube['short_code'])),
+        case('get_matrix_plates', lambda: db.get_matrix_plates()),
+        case('get_matrix_plate', lambda: db.get_matrix_plate(plate.id)),
+        case('dump_matrix_plate', lambda: db.dump_matrix_plate(plate.id)),
+        case('get_matrix_plate_changes', lambda: db.get_matrix_plate_changes(plate.id, dataset.generated_at)),
+        case('add_matrix_plate_with_specimens', db.add_matrix_plate_with_specimens, new_plate),
+        case('update_matrix_tube_locations', db.update_matrix_tube_locations, moves),
+        case('delete_plate', db.delete_plate, lambda i: (filled_plate(i)[0].id,)),
+        case('hide_plates', lambda: db.hide_plates([_.id for _ in dataset.plates[:10]])),
+        case('unhide_plates', lambda: db.unhide_plates([_.id for _ in dataset.plates[:10]])),
+        case('find_specimens', lambda: db.find_specimens(search_entries)),
+        case('get_matrix_tubes_from_specimens', lambda: db.get_matrix_tubes_from_specimens(search_entries[:100])),
+        case('get_matrix_tube', lambda: db.get_matrix_tube(tube['barcode'])),
+        case('get_matrix_tubes', lambda: db.get_matrix_tubes(barcodes)),
+        case('set_matrix_tubes_exhausted', lambda: db.set_matrix_tubes_exhausted(barcodes)),
+        case('unset_matrix_tubes_exhausted', lambda: db.unset_matrix_tubes_exhausted(barcodes)),
+        case('convert_barcoded_entries', db.convert_barcoded_entries,
+             lambda i: ([{'barcode': _['barcode']} for _ in search_entries],)),
+        case('delete_matrix_tubes_and_specimens', db.delete_matrix_tubes_and_specimens,
+             lambda i: (lambda changes: (changes[3], changes[2]))(filled_plate(i))),
+        case('delete_matrix_tubes', db.delete_matrix_tubes, lambda i: (filled_plate(i)[3],)),
+        case('delete_matrix_tubes_by_barcode', db.delete_matrix_tubes_by_barcode,
+             lambda i: ([_.barcode for _ in filled_plate(i)[3]],)),
+        case('delete_specimens', db.delete_specimens, stored_specimen_entries),
+        case('get_count_summaries', lambda: db.get_count_summaries()),
+        case('rebuild_count_summaries', lambda: db.rebuild_count_summaries()),
+        case('get_version', lambda: db.get_version('study', study.id)),
+        case('create_job', lambda: db.create_job('benchmark', 100, 'benchmark.json')),
+        case('get_job', db.get_job, lambda i: (db.create_job('benchmark').id,)),
+        case('update_job', lambda job_id: db.update_job(job_id, {'rows_processed': 50}),
+             lambda i: (db.create_job('benchmark').id,)),
+        case('fail_unfinished_jobs', lambda: db.fail_unfinished_jobs('Benchmark')),
+    ]
+
+
+def endpoint_cases(client, dataset):
+    study = dataset.studies[0]
+    plate = dataset.plates[0]
+    location = dataset.locations[0]
+    # Uploads carry no collection dates.
+    cross_sectional = [_ for _ in dataset.studies if not _.is_longitudinal][0]
+    since = dataset.generated_at.isoformat()
+    names = ('BE{:06d}'.format(_) for _ in itertools.count())
+    # Longitudinal subjects have a specimen of each type per collection date, so the date is part of the search.
+    specimen_search = "UID,Study Short Code,Specimen Type,Date\n" + "\n".join(
+        ["{uid},{short_code},{specimen_type},{date}".format(date=_['collection_date'].strftime('%d-%b-%Y'), **_)
+         for _ in dataset.tubes if _['collection_date']][:1000])
+    # The response header follows the first tube, so all tubes searched come from the same study.
+    barcode_search = "Barcode\n" + "\n".join(
+        [_['barcode'] for _ in dataset.tubes if _['short_code'] == study.short_code][:1000])
+    moving = [_['barcode'] for _ in dataset.tubes if _['plate_uid'] == dataset.plates[1].uid]
+
+    def checked(response):
+        if response.status_code not in (200, 304):
+            raise AssertionError("{} {}".format(response.status_code, response.data[:200]))
+        # Streamed responses only run while being read.
+        return response.get_data()
+
+    def get(url):
+        return case('GET ' + url, lambda: checked(client.get(url.format(study=study.id, plate=plate.id,
+                                                                        since=since))))
+
+    def post(url, data):
+        return case('POST ' + url, lambda d: checked(client.post(url, data=d)), lambda i: (data(i),))
+
+    def upload(i):
+        rows = ["B{},{},{},DNA,{}".format(next(names), well, next(names), cross_sectional.short_code)
+                for well in WELLS]
+        return {'files': (StringIO("Barcode,Well,UID,Specimen Type,Study Short Code\n" + "\n".join(rows)),
+                          'plate.csv'),
+                'plate_uid': next(names), 'location_id': str(location.id),
+                'create_missing_subjects': 'true', 'create_missing_specimens': 'true'}
+
+    def update(i):
+        plate_uid = next(names)
+        checked(client.post('/plate/upload', data={
+            'files': (StringIO("Barcode,Well,UID,Specimen Type,Study Short Code\n"), 'plate.csv'),
+            'plate_uid': plate_uid, 'location_id': str(location.id),
+            'create_missing_subjects': 'true', 'create_missing_specimens': 'true'}))
+        rows = ["{},{}".format(well, barcode) for barcode, well in zip(moving, WELLS)]
+        return {'files': [(StringIO("Well,Barcode\n" + "\n".join(rows)), plate_uid + '.csv')]}
+
+    return [
+        get('/study'),
+        get('/study/{study}'),
+        get('/study/{study}?format=columnar'),
+        get('/study/{study}/changes?since={since}'),
+        get('/plate'),
+        get('/plate/{plate}'),
+        get('/location'),
+        get('/specimen-type'),
+        get('/summary'),
+        post('/search/specimen', lambda i: {'files': (StringIO(specimen_search), 'search.csv')}),
+        post('/search/barcode', lambda i: {'files': (StringIO(barcode_search), 'search.csv')}),
+        post('/plate/upload', upload),
+        post('/plate/update', update),
+    ]
+
+
+def compare(results, baseline):
+    """
+    Print the change of every case against a previous run.
+    """
+    previous = dict([(_['name'], _) for _ in baseline['cases']])
+    print "{:<40} {:>12} {:>12} {:>8} {:>12}".format('case', 'p50 ms', 'was', 'change', 'statements')
+    for result in results['cases']:
+        before = previous.get(result['name'])
+        if not before:
+            print "{:<40} {:>12.2f} {:>12} {:>8} {:>12.1f}".format(result['name'], result['p50_ms'], '-', '-',
+                                                                    result['statements'])
+            continue
+        change = (result['p50_ms'] - before['p50_ms']) / before['p50_ms'] * 100 if before['p50_ms'] else 0
+        print "{:<40} {:>12.2f} {:>12.2f} {:>7.0f}% {:>5.1f} ({:+.1f})".format(
+            result['name'], result['p50_ms'], before['p50_ms'], change, result['statements'],
+            result['statements'] - before['statements'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small', help="Size of the generated dataset.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the generated dataset.")
+    parser.add_argument('--repeat', type=int, default=20, help="Runs of every case.")
+    parser.add_argument('--only', help="Only run cases whose name contains this.")
+    parser.add_argument('--no-endpoints', action='store_true', help="Only time SampleDB methods.")
+    parser.add_argument('--output', help="File to save the results to as JSON.")
+    parser.add_argument('--compare', help="JSON results of a previous run to compare against.")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix='sample_db_benchmark')
+    if args.no_endpoints:
+        db = SampleDB('sqlite:///' + os.path.join(data_dir, 'benchmark.sqlite'), expire_on_commit=False)
+        client = None
+    else:
+        os.environ['CONFIG'] = 'Benchmark'
+        os.environ['BENCHMARK_DIR'] = data_dir
+        from ..flask_impl import app, db
+        client = app.test_client()
+
+    start = time.time()
+    dataset = generate(db, seed=args.seed, **SCALES[args.scale])
+    sys.stderr.write("Generated {} scale dataset, {} tubes, in {:.1f}s\n".format(args.scale, len(dataset.tubes),
+                                                                              time.time() - start))
+
+    cases = method_cases(db, dataset)
+    timed = set([_.name for _ in cases])
+    untimed = sorted([_ for _ in dir(SampleDB) if not _.startswith('_') and callable(getattr(SampleDB, _)) and
+                      _ not in timed and _ not in UNTIMED])
+    if untimed:
+        sys.stderr.write("Public methods without a benchmark case: {}\n".format(', '.join(untimed)))
+    if client:
+        cases += endpoint_cases(client, dataset)
+    if args.only:
+        cases = [_ for _ in cases if args.only in _.name]
+
+    results = {
+        'scale': args.scale,
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'tubes': len(dataset.tubes),
+        'date': datetime.datetime.utcnow().isoformat(),
+        'cases': []
+    }
+    for c in cases:
+        result = measure(db, c, args.repeat)
+        results['cases'].append(result)
+        sys.stderr.write("{name:<40} {p50_ms:10.2f} ms p50 {p99_ms:10.2f} ms p99 {statements:8.1f} statements\n"
+                         .format(**result))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Compare dumping a study and a plate through the marshmallow ModelSchemas against the Core projections.
+
+    python -m sample_db.benchmarks.serialization --plates 100
+
+Importing the schemas starts the Flask application, with its Benchmark configuration keeping its data in a
+temporary directory. The benchmark itself runs against its own in-memory database.
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+
+os.environ['CONFIG'] = 'Benchmark'
+os.environ['BENCHMARK_DIR'] = tempfile.mkdtemp(prefix='sample_db_benchmark')
+
+from ..db_impl.app import SampleDB
+from ..flask_impl.schemas import StudySchema, StudySubjectSchema, SpecimenSchema, MatrixTubeSchema, \
+    MatrixPlateSchema
+from data import generate
+
+study_schema = StudySchema()
+study_subject_schema = StudySubjectSchema()
+specimen_schema = SpecimenSchema()
+matrix_tube_schema = MatrixTubeSchema()
+matrix_plate_schema = MatrixPlateSchema()
+
+
+def best_of(repeat, db, func):
+    """
+    Time func, every run gets a fresh session like a request would.
+    :return: Result of the last call and the fastest of repeat timings in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        timings.append(time.time() - start)
+        db.remove_session()
+    return result, min(timings)
+
+
+def schema_study(db, study_id):
+    study, study_subjects, specimens, matrix_tubes = db.get_study(study_id)
+    return json.dumps([study_schema.dump(study).data,
+                       study_subject_schema.dump(study_subjects, many=True).data,
+                       specimen_schema.dump(specimens, many=True).data,
+                       matrix_tube_schema.dump(matrix_tubes, many=True).data])
+
+
+def projection_study(db, study_id):
+    return json.dumps(list(db.dump_study(study_id)))
+
+
+def schema_plate(db, plate_id):
+    plate, study_subjects, specimens, matrix_tubes = db.get_matrix_plate(plate_id)
+    return json.dumps([matrix_plate_schema.dump(plate).data,
+                       study_subject_schema.dump(study_subjects, many=True).data,
+                       specimen_schema.dump(specimens, many=True).data,
+                       matrix_tube_schema.dump(matrix_tubes, many=True).data])
+
+
+def projection_plate(db, plate_id):
+    return json.dumps(list(db.dump_matrix_plate(plate_id)))
+
+
+def same_entries(a, b):
+    """
+    ModelSchema dumps come in load order, projections in ID order.
+    """
+    def normalize(entries):
+        entries = json.loads(entries)
+        return [sorted(_, key=lambda entry: int(entry['id'])) if isinstance(_, list) else _ for _ in entries]
+    return normalize(a) == normalize(b)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--plates', type=int, default=100, help="Full 96 well plates in the study.")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs of each path, the fastest counts.")
+    args = parser.parse_args()
+
+    db = SampleDB('sqlite://', expire_on_commit=False)
+    dataset = generate(db, studies=1, plates=args.plates)
+    study = dataset.studies[0]
+    plate = dataset.plates[0]
+
+    for name, scope_id, schema_path, projection_path in [('study', study.id, schema_study, projection_study),
+                                                         ('plate', plate.id, schema_plate, projection_plate)]:
+        schema_result, schema_time = best_of(args.repeat, db, lambda: schema_path(db, scope_id))
+        projection_result, projection_time = best_of(args.repeat, db, lambda: projection_path(db, scope_id))
+        if not same_entries(schema_result, projection_result):
+            raise AssertionError("Projection of the {} differs from the ModelSchema dump".format(name))
+        print "{:<6} ModelSchema {:8.3f}s  projection {:8.3f}s  speedup {:5.1f}x".format(
+            name, schema_time, projection_time, schema_time / projection_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,16 +15,96 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+import hashlib
+from collections import namedtuple, OrderedDict
 from contextlib import contextmanager
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, and_, or_, select, bindparam, func, case, distinct, null
 from sqlalchemy.event import listen
 from sqlalchemy.engine import Engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.exc import NoResultFound
-
-from models import Base, Study, StudySubject, Specimen, MatrixPlate, MatrixTube, SpecimenType, Location
-
-Session = sessionmaker()
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session, sessionmaker, scoped_session, joinedload, subqueryload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
+
+from models import Base, Study, StudySubject, Specimen, MatrixPlate, MatrixTube, SpecimenType, Location, \
+    StorageContainer, CountSummary, Job, Tombstone
+from occupancy import PlateOccupancy, WellConflictError
+from cache import ReferenceCache
+from instrumentation import QueryRecorder
+from slow_queries import SlowQueryLog
+from batching import configure_engine, chunks, batches, in_criteria, in_input_order
+import projections
+
+# Entries of a search are matched and streamed this many at a time, progress is reported after every chunk.
+ENTRY_CHUNK_SIZE = 500
+
+# Tubes of a plate upload or update are written this many at a time, progress is reported after every chunk.
+WRITE_CHUNK_SIZE = 24
+
+# Lightweight stand-ins for a specimen and the matrix tubes holding it, used by the batched search paths.
+SpecimenLocations = namedtuple('SpecimenLocations', ['id', 'collection_date', 'matrix_tubes'])
+MatrixTubeLocation = namedtuple('MatrixTubeLocation', ['plate_uid', 'well_position', 'comments'])
+# Version of what a GET endpoint serves, see SampleDB.get_version.
+Version = namedtuple('Version', ['etag', 'last_modified'])
+# Stand in for a specimen a dry run would have created.
+PendingSpecimen = namedtuple('PendingSpecimen', ['collection_date'])
+# Rows of a study or plate that changed or left it since a given time, see SampleDB.get_study_changes.
+Changes = namedtuple('Changes', ['scope', 'study_subjects', 'specimens', 'matrix_tubes', 'tombstones', 'synced_at'])
+
+# last_updated is set when a row is flushed, not when its transaction commits, so a change feed read can miss rows of
+# a transaction that is still running. Change feeds hand out a cursor this far in the past to pick them up next time.
+CHANGES_OVERLAP = datetime.timedelta(minutes=1)
+
+
+def _paginate(query, key, limit=None, after=None):
+    """
+    Keyset pagination, returns at most limit rows whose key comes after the given cursor.
+    :param query: Query to paginate.
+    :param key: Unique column to order by, usually the primary key.
+    :param limit: Maximum number of rows, all rows if not provided.
+    :param after: Key of the last row of the previous page.
+    """
+    if after is not None:
+        query = query.filter(key > after)
+    query = query.order_by(key)
+    if limit:
+        query = query.limit(limit)
+    return query
+
+
+def _as_date(d):
+    if isinstance(d, datetime.datetime):
+        return d.date()
+    return d
+
+
+def _detached(model, row):
+    """
+    Build a detached instance of model from a row of its table, without involving a session.
+    """
+    instance = model()
+    for key, value in row.items():
+        set_committed_value(instance, key, value)
+    make_transient_to_detached(instance)
+    return instance
+
+
+def _merged_copies(session, instances):
+    """
+    Copy detached instances shared between sessions, e.g. those of the reference cache, for the caller to keep. The
+    copies are merged into the session and expunged again, together with the related instances merged along with
+    them, so that the commit of the session scope does not expire them.
+    """
+    copies = [session.merge(_, load=False) for _ in instances]
+    for copy in copies:
+        state = inspect(copy)
+        related = [_ for _, __, ___, ____ in state.mapper.cascade_iterator('merge', state)]
+        for obj in [copy] + related:
+            if obj in session:
+                session.expunge(obj)
+    return copies
 
 
 def set_sqlite_pragma(dbapi_connection, connection_record):
@@ -32,41 +112,425 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
     dbapi_connection.execute("PRAGMA cache_size=-1000000")
 
 
+def sqlite_wal_pragmas(busy_timeout, mmap_size, read_only=False):
+    """
+    Build a connect listener that puts SQLite connections in WAL mode, so readers and the writer no longer block
+    each other. Read only connections refuse to write, python 2's sqlite3 cannot open a database with mode=ro.
+    :param busy_timeout: Milliseconds to wait on a locked database before failing.
+    :param mmap_size: Bytes of the database file to memory map.
+    :param read_only: Set query_only on the connection.
+    """
+    def set_sqlite_wal_pragma(dbapi_connection, connection_record):
+        if read_only:
+            dbapi_connection.execute("PRAGMA query_only=ON")
+        else:
+            dbapi_connection.execute("PRAGMA journal_mode=WAL")
+        dbapi_connection.execute("PRAGMA synchronous=NORMAL")
+        dbapi_connection.execute("PRAGMA busy_timeout={:d}".format(busy_timeout))
+        dbapi_connection.execute("PRAGMA mmap_size={:d}".format(mmap_size))
+    return set_sqlite_wal_pragma
+
+
 class SampleDB(object):
-    def __init__(self, conn_string, **kwargs):
+    def __init__(self, conn_string, scopefunc=None, expire_on_commit=True, wal_mode=False, busy_timeout=5000,
+                 mmap_size=268435456, reference_cache_size=1000, slow_query_threshold=None, temp_table_threshold=None,
+                 **kwargs):
         """
         SampleDB takes as an arg a connection string that describes the database to connect to, of the type used
         by SQLAlchemy.
         :param conn_string:
-        :param kwargs:
+        :param scopefunc: Optional function identifying the current scope, e.g. a web request. Each scope gets its
+            own session, which must be released with remove_session when the scope ends. Sessions are thread local
+            by default.
+        :param expire_on_commit: Expire all loaded instances after each commit.
+        :param wal_mode: Run a file based SQLite database in WAL mode, and serve reads from a separate read only
+            connection pool so they do not wait on writes.
+        :param busy_timeout: Milliseconds SQLite connections wait on a locked database in WAL mode.
+        :param mmap_size: Bytes of the database file SQLite connections memory map in WAL mode.
+        :param reference_cache_size: Maximum number of rows of each reference table (studies, specimen types,
+            locations) kept in memory. Larger tables are always queried.
+        :param slow_query_threshold: Optional seconds, statements taking longer are logged to 'sample_db.slow_queries'.
+        :param temp_table_threshold: Optional number of keys, e.g. barcodes, from which bulk statements on SQLite
+            select their keys from a temporary table instead of binding them in chunks. Reads of the read only
+            connections in WAL mode always bind them.
+        :param kwargs: Passed on to create_engine, e.g. connection pool configuration.
         """
         if 'sqlite' in conn_string:
             listen(Engine, "connect", set_sqlite_pragma)
 
         self._conn_string = conn_string
         self.engine = create_engine(conn_string, **kwargs)
+        self.read_engine = self.engine
+        if wal_mode and 'sqlite' in conn_string and make_url(conn_string).database not in (None, '', ':memory:'):
+            listen(self.engine, "connect", sqlite_wal_pragmas(busy_timeout, mmap_size))
+            self.read_engine = create_engine(conn_string, **kwargs)
+            listen(self.read_engine, "connect", sqlite_wal_pragmas(busy_timeout, mmap_size, read_only=True))
+        configure_engine(self.engine, temp_tables=temp_table_threshold is not None)
+        if self.read_engine is not self.engine:
+            configure_engine(self.read_engine)
+        # Counts and times the statements of both engines, e.g. per web request or in tests.
+        self.query_recorder = QueryRecorder([self.engine, self.read_engine], scopefunc)
+        if slow_query_threshold is not None:
+            SlowQueryLog(slow_query_threshold, self.engine, self.read_engine)
         Base.metadata.create_all(self.engine)
-        self._session = Session(bind=self.engine)
-
+        self._create_missing_indexes()
+        self._session = scoped_session(sessionmaker(bind=self.engine, expire_on_commit=expire_on_commit,
+                                                    info={'temp_table_threshold': temp_table_threshold}),
+                                       scopefunc=scopefunc)
+        if self.read_engine is self.engine:
+            self._read_session = self._session
+        else:
+            self._read_session = scoped_session(sessionmaker(bind=self.read_engine,
+                                                             expire_on_commit=expire_on_commit),
+                                                scopefunc=scopefunc)
+        self._reference_cache = ReferenceCache(reference_cache_size)
+
+        # Databases created before count summaries existed get them built once on first start.
+        with self._session_scope() as session:
+            if not session.query(CountSummary.id).first() and (session.query(Study.id).first() or
+                                                                session.query(Location.id).first()):
+                self._rebuild_count_summaries(session)
+        self.remove_session()
 
+    def _create_missing_indexes(self):
+        """
+        create_all only creates indexes along with their table, indexes added to existing tables are created here.
+        """
+        inspector = inspect(self.engine)
+        for table in Base.metadata.sorted_tables:
+            existing = set([_['name'] for _ in inspector.get_indexes(table.name)])
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(self.engine)
+
+    def remove_session(self):
+        """
+        Close the sessions of the current scope and return their connections to the pool.
+        """
+        self._session.remove()
+        self._read_session.remove()
 
     @contextmanager
-    def _session_scope(self):
+    def _session_scope(self, read_only=False):
         """
         Context manager that creates a scope that rolls back database on errors and commits on completion.
+        Read only scopes use the read only connection pool when the database runs in WAL mode.
         usage:
 
         >>  with self.session_scope() as _session:
         >>      ...
 
         """
+        if read_only:
+            session = self._read_session()
+        else:
+            session = self._session()
         try:
-            yield self._session
-            self._session.commit()
+            yield session
+            session.commit()
         except:
-            self._session.rollback()
+            session.rollback()
             raise
 
+    def _get_references(self, session, kind):
+        # type: (Session, str) -> list
+        """
+        Unmanaged function to get every row of a reference table from the reference cache, loading it with the
+        session on a miss. The cached instances are detached and shared, merge them into the session before use, or
+        hand out _merged_copies of them.
+        :param session: The _session to use for querying the database.
+        :param kind: 'study', 'study_listing' (studies along with their subjects), 'specimen_type' or 'location'.
+        :return: List of detached instances ordered by ID, or None if the table is too large to be cached.
+        """
+        model = {'study': Study, 'study_listing': Study, 'specimen_type': SpecimenType, 'location': Location}[kind]
+
+        def load():
+            table = model.__table__
+            instances = [_detached(model, _) for _ in session.execute(select([table]).order_by(table.c.id))]
+            if kind == 'study_listing':
+                study_subject = StudySubject.__table__
+                study_subjects = {}
+                for row in session.execute(select([study_subject]).order_by(study_subject.c.id)):
+                    study_subjects.setdefault(row['study_id'], []).append(_detached(StudySubject, row))
+                for study in instances:
+                    set_committed_value(study, 'subjects', study_subjects.get(study.id, []))
+            return instances
+
+        if kind == 'study_listing':
+            return self._reference_cache.get(kind, load, lambda studies: sum([1 + len(_.subjects) for _ in studies]))
+        return self._reference_cache.get(kind, load)
+
+    @staticmethod
+    def _refresh_count_summaries(session, study_ids=(), plate_ids=(), location_ids=()):
+        # type: (Session, list[int], list[int], list[int]) -> None
+        """
+        Unmanaged function to recount the summaries of the given studies, plates and locations with a handful of
+        grouped queries per chunk of IDs. Only the scopes passed in are recounted, so the cost of keeping summaries
+        current follows the size of the write, not the size of the database. Summaries of IDs that no longer exist
+        are removed.
+        :param session: The _session to use for querying the database.
+        :param study_ids: IDs of the studies touched by the write.
+        :param plate_ids: IDs of the matrix plates touched by the write.
+        :param location_ids: IDs of the locations touched by the write.
+        """
+        session.flush()
+        study = Study.__table__
+        location = Location.__table__
+        study_subject = StudySubject.__table__
+        specimen = Specimen.__table__
+        storage_container = StorageContainer.__table__
+        matrix_tube = MatrixTube.__table__
+        matrix_plate = MatrixPlate.__table__
+        count_summary = CountSummary.__table__
+
+        tubes = matrix_tube.join(storage_container, matrix_tube.c.id == storage_container.c.id)\
+            .join(specimen, storage_container.c.specimen_id == specimen.c.id)\
+            .join(study_subject, specimen.c.study_subject_id == study_subject.c.id)
+        exhausted_tube_count = func.sum(case([(storage_container.c.exhausted == True, 1)], else_=0))\
+            .label('exhausted_tube_count')
+
+        def study_counts(chunk):
+            return [
+                select([study_subject.c.study_id.label('scope_id'),
+                        func.count(study_subject.c.id).label('subject_count')])
+                .where(study_subject.c.study_id.in_(chunk)).group_by(study_subject.c.study_id),
+                select([study_subject.c.study_id.label('scope_id'), func.count(specimen.c.id).label('specimen_count')])
+                .select_from(specimen.join(study_subject, specimen.c.study_subject_id == study_subject.c.id))
+                .where(study_subject.c.study_id.in_(chunk)).group_by(study_subject.c.study_id),
+                select([study_subject.c.study_id.label('scope_id'),
+                        func.count(distinct(matrix_tube.c.plate_id)).label('plate_count'),
+                        func.count(matrix_tube.c.id).label('tube_count'), exhausted_tube_count])
+                .select_from(tubes).where(study_subject.c.study_id.in_(chunk)).group_by(study_subject.c.study_id)
+            ]
+
+        def plate_counts(chunk):
+            return [
+                select([matrix_plate.c.id.label('scope_id'), func.count(matrix_plate.c.id).label('plate_count')])
+                .where(matrix_plate.c.id.in_(chunk)).group_by(matrix_plate.c.id),
+                select([matrix_tube.c.plate_id.label('scope_id'),
+                        func.count(distinct(study_subject.c.id)).label('subject_count'),
+                        func.count(distinct(specimen.c.id)).label('specimen_count'),
+                        func.count(matrix_tube.c.id).label('tube_count'), exhausted_tube_count])
+                .select_from(tubes).where(matrix_tube.c.plate_id.in_(chunk)).group_by(matrix_tube.c.plate_id)
+            ]
+
+        def location_counts(chunk):
+            return [
+                select([matrix_plate.c.location_id.label('scope_id'),
+                        func.count(matrix_plate.c.id).label('plate_count')])
+                .where(matrix_plate.c.location_id.in_(chunk)).group_by(matrix_plate.c.location_id),
+                select([matrix_plate.c.location_id.label('scope_id'),
+                        func.count(distinct(study_subject.c.id)).label('subject_count'),
+                        func.count(distinct(specimen.c.id)).label('specimen_count'),
+                        func.count(matrix_tube.c.id).label('tube_count'), exhausted_tube_count])
+                .select_from(tubes.join(matrix_plate, matrix_tube.c.plate_id == matrix_plate.c.id))
+                .where(matrix_plate.c.location_id.in_(chunk)).group_by(matrix_plate.c.location_id)
+            ]
+
+        count_columns = ('subject_count', 'specimen_count', 'plate_count', 'tube_count', 'exhausted_tube_count')
+        summary_update = count_summary.update().where(and_(count_summary.c.scope == bindparam('_scope'),
+                                                           count_summary.c.scope_id == bindparam('_scope_id')))\
+            .values(**dict([(_, bindparam('_' + _)) for _ in count_columns]))
+
+        for scope, ids, id_column, counts in (('study', study_ids, study.c.id, study_counts),
+                                              ('plate', plate_ids, matrix_plate.c.id, plate_counts),
+                                              ('location', location_ids, location.c.id, location_counts)):
+            # Queries of a chunk also bind the scope and the constants of the exhausted tube count.
+            for chunk in batches(session, sorted(set([_ for _ in ids if _ is not None])), reserved=3):
+                summaries = OrderedDict()
+                for row in session.execute(select([id_column]).where(id_column.in_(chunk)).order_by(id_column)):
+                    summaries[row[0]] = dict([('_scope', scope), ('_scope_id', row[0])] +
+                                             [('_' + _, 0) for _ in count_columns])
+                for query in counts(chunk):
+                    for row in session.execute(query):
+                        if row['scope_id'] in summaries:
+                            summaries[row['scope_id']].update(
+                                [('_' + k, v or 0) for k, v in row.items() if k != 'scope_id'])
+
+                # Existing summaries are updated in place so their IDs stay stable, summaries of deleted rows are
+                # dropped and new ones inserted.
+                existing_ids = set([_ for _, in session.execute(
+                    select([count_summary.c.scope_id]).where(and_(count_summary.c.scope == scope,
+                                                                  count_summary.c.scope_id.in_(chunk))))])
+                deleted_ids = [_ for _ in existing_ids if _ not in summaries]
+                if deleted_ids:
+                    session.execute(count_summary.delete().where(and_(count_summary.c.scope == scope,
+                                                                      count_summary.c.scope_id.in_(deleted_ids))))
+                updated = [v for k, v in summaries.items() if k in existing_ids]
+                if updated:
+                    session.execute(summary_update, updated)
+                inserted = [dict([(k[1:], v) for k, v in summary.items()])
+                            for scope_id, summary in summaries.items() if scope_id not in existing_ids]
+                if inserted:
+                    session.execute(count_summary.insert(), inserted)
+
+    @staticmethod
+    def _get_matrix_tube_scopes(session, matrix_tube_ids):
+        # type: (Session, list[int]) -> (set[int], set[int], set[int])
+        """
+        Unmanaged function to find the studies, plates and locations a set of matrix tubes count towards.
+        :param session: The _session to use for querying the database.
+        :param matrix_tube_ids: IDs of the matrix tubes.
+        :return: Study IDs, plate IDs and location IDs
+        """
+        study_subject = StudySubject.__table__
+        specimen = Specimen.__table__
+        storage_container = StorageContainer.__table__
+        matrix_tube = MatrixTube.__table__
+        matrix_plate = MatrixPlate.__table__
+        study_ids, plate_ids, location_ids = set(), set(), set()
+        for criterion in in_criteria(session, matrix_tube.c.id, matrix_tube_ids):
+            query = select([study_subject.c.study_id, matrix_tube.c.plate_id, matrix_plate.c.location_id])\
+                .select_from(matrix_tube.join(storage_container, matrix_tube.c.id == storage_container.c.id)
+                             .join(specimen, storage_container.c.specimen_id == specimen.c.id)
+                             .join(study_subject, specimen.c.study_subject_id == study_subject.c.id)
+                             .outerjoin(matrix_plate, matrix_tube.c.plate_id == matrix_plate.c.id))\
+                .where(criterion).distinct()
+            for study_id, plate_id, location_id in session.execute(query):
+                study_ids.add(study_id)
+                plate_ids.add(plate_id)
+                location_ids.add(location_id)
+        return study_ids, plate_ids, location_ids
+
+    @staticmethod
+    def _add_tombstones(session, table_name, row_ids):
+        # type: (Session, str, list[int]) -> None
+        """
+        Unmanaged function to record the deletion of rows. Must run before the rows are deleted, the studies and
+        plates they belong to are looked up through them.
+        :param session: The _session to use for querying the database.
+        :param table_name: Table the rows are deleted from.
+        :param row_ids: IDs of the deleted rows.
+        """
+        study_subject = StudySubject.__table__
+        specimen = Specimen.__table__
+        storage_container = StorageContainer.__table__
+        matrix_tube = MatrixTube.__table__
+        queries = {
+            'study_subject': lambda criterion: select([study_subject.c.id, study_subject.c.study_id, null()])
+                .where(criterion),
+            'specimen': lambda criterion: select([specimen.c.id, study_subject.c.study_id, matrix_tube.c.plate_id])
+                .select_from(specimen.join(study_subject, specimen.c.study_subject_id == study_subject.c.id)
+                             .outerjoin(storage_container, storage_container.c.specimen_id == specimen.c.id)
+                             .outerjoin(matrix_tube, matrix_tube.c.id == storage_container.c.id))
+                .where(criterion).distinct(),
+            'matrix_tube': lambda criterion: select([matrix_tube.c.id, study_subject.c.study_id,
+                                                     matrix_tube.c.plate_id])
+                .select_from(matrix_tube.join(storage_container, matrix_tube.c.id == storage_container.c.id)
+                             .join(specimen, storage_container.c.specimen_id == specimen.c.id)
+                             .join(study_subject, specimen.c.study_subject_id == study_subject.c.id))
+                .where(criterion),
+        }
+        id_columns = {'study_subject': study_subject.c.id, 'specimen': specimen.c.id, 'matrix_tube': matrix_tube.c.id}
+        if table_name in queries:
+            rows = []
+            for criterion in in_criteria(session, id_columns[table_name], row_ids):
+                rows += session.execute(queries[table_name](criterion)).fetchall()
+        else:
+            rows = [(_, _ if table_name == 'study' else None, _ if table_name == 'matrix_plate' else None)
+                    for _ in set(row_ids)]
+        if rows:
+            session.execute(Tombstone.__table__.insert(), [
+                {'table_name': table_name, 'row_id': row_id, 'study_id': study_id, 'plate_id': plate_id}
+                for row_id, study_id, plate_id in rows])
+
+    def _rebuild_count_summaries(self, session):
+        session.execute(CountSummary.__table__.delete())
+        self._refresh_count_summaries(session,
+                                      study_ids=[_ for _, in session.query(Study.id)],
+                                      plate_ids=[_ for _, in session.query(MatrixPlate.id)],
+                                      location_ids=[_ for _, in session.query(Location.id)])
+
+    def rebuild_count_summaries(self):
+        """
+        Recount the summaries of every study, plate and location from scratch. Only needed if the database was
+        written to by something other than SampleDB.
+        """
+        with self._session_scope() as session:
+            self._rebuild_count_summaries(session)
+        return True
+
+    def get_count_summaries(self, scope=None):
+        # type: (str) -> list[CountSummary]
+        """
+        Get the precomputed counts of studies, plates and locations.
+        :param scope: Optional scope to restrict to, one of 'study', 'plate' or 'location'.
+        :return: CountSummary[]
+        """
+        if scope is not None and scope not in CountSummary.scopes:
+            raise ValueError("{} is not a valid summary scope.".format(scope))
+        with self._session_scope(read_only=True) as session:
+            query = session.query(CountSummary)
+            if scope is not None:
+                query = query.filter(CountSummary.scope == scope)
+            summaries = query.order_by(CountSummary.scope, CountSummary.scope_id).all()
+        return summaries
+
+    def get_version(self, scope, scope_id=None):
+        # type: (str, int) -> Version
+        """
+        Cheap version token of a scope, built from the row count and latest last_updated of every table that feeds
+        it. Any insert, update or delete of a row in the scope changes the token.
+        :param scope: One of 'studies', 'study', 'plates', 'plate', 'locations', 'location', 'specimen_types' or
+            'specimen_type'.
+        :param scope_id: ID of the row of the single row scopes.
+        :return: Version, or None if the row of a single row scope does not exist.
+        """
+        study = Study.__table__
+        study_subject = StudySubject.__table__
+        specimen = Specimen.__table__
+        storage_container = StorageContainer.__table__
+        matrix_tube = MatrixTube.__table__
+        matrix_plate = MatrixPlate.__table__
+
+        def stats(table, *criteria, **kwargs):
+            query = select([func.count(table.c.id), func.max(table.c.last_updated)])
+            if 'select_from' in kwargs:
+                query = query.select_from(kwargs['select_from'])
+            return query.where(and_(*criteria)) if criteria else query
+
+        specimens_of_subjects = specimen.join(study_subject, specimen.c.study_subject_id == study_subject.c.id)
+        containers_of_subjects = storage_container.join(specimen, storage_container.c.specimen_id == specimen.c.id)\
+            .join(study_subject, specimen.c.study_subject_id == study_subject.c.id)
+        # Subject and specimen entries list the IDs of all their specimens and containers, not only the ones in scope.
+        plate_subject_ids = select([specimen.c.study_subject_id])\
+            .select_from(matrix_tube.join(storage_container, matrix_tube.c.id == storage_container.c.id)
+                         .join(specimen, storage_container.c.specimen_id == specimen.c.id))\
+            .where(matrix_tube.c.plate_id == scope_id)
+
+        queries = {
+            'studies': lambda: [stats(study), stats(study_subject)],
+            'study': lambda: [
+                stats(study, study.c.id == scope_id),
+                stats(study_subject, study_subject.c.study_id == scope_id),
+                stats(specimen, study_subject.c.study_id == scope_id, select_from=specimens_of_subjects),
+                stats(storage_container, study_subject.c.study_id == scope_id, select_from=containers_of_subjects)],
+            'plates': lambda: [
+                stats(matrix_plate),
+                stats(storage_container,
+                      select_from=storage_container.join(matrix_tube, matrix_tube.c.id == storage_container.c.id))],
+            'plate': lambda: [
+                stats(matrix_plate, matrix_plate.c.id == scope_id),
+                stats(study_subject, study_subject.c.id.in_(plate_subject_ids)),
+                stats(specimen, specimen.c.study_subject_id.in_(plate_subject_ids)),
+                stats(storage_container, study_subject.c.id.in_(plate_subject_ids),
+                      select_from=containers_of_subjects)],
+            'locations': lambda: [stats(Location.__table__)],
+            'location': lambda: [stats(Location.__table__, Location.__table__.c.id == scope_id)],
+            'specimen_types': lambda: [stats(SpecimenType.__table__)],
+            'specimen_type': lambda: [stats(SpecimenType.__table__, SpecimenType.__table__.c.id == scope_id)],
+        }
+        if scope not in queries:
+            raise ValueError("{} is not a valid version scope.".format(scope))
+        with self._session_scope(read_only=True) as session:
+            counts = [tuple(session.execute(_).first()) for _ in queries[scope]()]
+        if scope_id is not None and not counts[0][0]:
+            return None
+        etag = hashlib.md5(repr([(count, str(last_updated)) for count, last_updated in counts])).hexdigest()
+        last_updates = [last_updated for _, last_updated in counts if last_updated]
+        last_modified = max(last_updates) if last_updates else None
+        return Version(etag, last_modified)
+
     def create_study(self, title, short_code, is_longitudinal, lead_person, description=None, **kwargs):
         # type: (str, str, bool, str, str) -> Study
         """
@@ -81,30 +545,135 @@ class SampleDB(object):
             study = Study(title=title, short_code=short_code, is_longitudinal=is_longitudinal, lead_person=lead_person,
                           description=description)  # type: Study
             session.add(study)
+            session.flush()
+            self._refresh_count_summaries(session, study_ids=[study.id])
+        self._reference_cache.invalidate('study', 'study_listing')
         return study
 
-    def get_study(self, study_id):
-        # type: (int) -> tuple[Study, list[StudySubject], list[Specimen], list[MatrixTube]]
+    def get_study(self, study_id, limit=None, after=None, exhausted=None, specimen_type_id=None, plate_id=None):
+        # type: (int, int, int, bool, int, int) -> tuple[Study, list[StudySubject], list[Specimen], list[MatrixTube]]
         """
         Get a study
         :param study_id: study ID
-        :return: Study with short code.
+        :param limit: Optional maximum number of matrix tubes to return.
+        :param after: Optional matrix tube ID, only tubes with a greater ID are returned.
+        :param exhausted: Optionally only return matrix tubes that are, or are not, exhausted.
+        :param specimen_type_id: Optionally only return matrix tubes holding specimens of this type.
+        :param plate_id: Optionally only return matrix tubes in this plate.
+        :return: Study with short code. If the matrix tubes are paginated or filtered, only the study subjects and
+            specimens of the returned tubes are included.
         """
-        with self._session_scope() as session:
+        with self._session_scope(read_only=True) as session:
             study = session.query(Study).get(study_id)  # type: Study
-            study_subjects = session.query(StudySubject).filter(StudySubject.study_id == study_id).all() # type: list[StudySubject]
-            specimens = session.query(Specimen).join(StudySubject).filter(StudySubject.study_id == study_id).all() # type: list[Specimen]
-            matrix_tubes = session.query(MatrixTube).join(Specimen).join(StudySubject).filter(StudySubject.study_id == study_id).all()
+            matrix_tube_query = session.query(MatrixTube).join(Specimen).join(StudySubject)\
+                .filter(StudySubject.study_id == study_id)
+            if exhausted is not None:
+                matrix_tube_query = matrix_tube_query.filter(MatrixTube.exhausted == exhausted)
+            if specimen_type_id is not None:
+                matrix_tube_query = matrix_tube_query.filter(Specimen.specimen_type_id == specimen_type_id)
+            if plate_id is not None:
+                matrix_tube_query = matrix_tube_query.filter(MatrixTube.plate_id == plate_id)
+            matrix_tubes = _paginate(matrix_tube_query, MatrixTube.id, limit, after).all()
+            if any([_ is not None for _ in (limit, after, exhausted, specimen_type_id, plate_id)]):
+                specimens = []
+                for criterion in in_criteria(session, Specimen.id, [_.specimen_id for _ in matrix_tubes]):
+                    specimens += session.query(Specimen).filter(criterion).all()
+                study_subjects = []
+                for criterion in in_criteria(session, StudySubject.id, [_.study_subject_id for _ in specimens]):
+                    study_subjects += session.query(StudySubject).filter(criterion).all()
+            else:
+                study_subjects = session.query(StudySubject).filter(StudySubject.study_id == study_id).all() # type: list[StudySubject]
+                specimens = session.query(Specimen).join(StudySubject).filter(StudySubject.study_id == study_id).all() # type: list[Specimen]
         return study, study_subjects, specimens, matrix_tubes
 
+    def dump_study(self, study_id, limit=None, after=None, exhausted=None, specimen_type_id=None, plate_id=None):
+        # type: (int, int, int, bool, int, int) -> tuple[dict, list[dict], list[dict], list[dict]]
+        """
+        Same as get_study, but returns the entries the StudySchema, StudySubjectSchema, SpecimenSchema and
+        MatrixTubeSchema would dump, selected through projections instead of loading ORM instances.
+        :return: Entries of the study, or None if it does not exist, and of its study subjects, specimens and matrix
+            tubes.
+        """
+        study_subject = StudySubject.__table__
+        specimen = Specimen.__table__
+        storage_container = StorageContainer.__table__
+        matrix_tube = MatrixTube.__table__
+        with self._session_scope(read_only=True) as session:
+            studies = projections.STUDY.dump(session, [Study.__table__.c.id == study_id])
+            criteria = [study_subject.c.study_id == study_id]
+            if exhausted is not None:
+                criteria.append(storage_container.c.exhausted == exhausted)
+            if specimen_type_id is not None:
+                criteria.append(specimen.c.specimen_type_id == specimen_type_id)
+            if plate_id is not None:
+                criteria.append(matrix_tube.c.plate_id == plate_id)
+            if after is not None:
+                criteria.append(matrix_tube.c.id > after)
+            matrix_tubes = projections.MATRIX_TUBE.dump(
+                session, criteria, limit=limit,
+                joins=[(specimen, storage_container.c.specimen_id == specimen.c.id),
+                       (study_subject, specimen.c.study_subject_id == study_subject.c.id)])
+            if any([_ is not None for _ in (limit, after, exhausted, specimen_type_id, plate_id)]):
+                specimens = []
+                for criterion in in_criteria(session, specimen.c.id, [int(_['specimen']) for _ in matrix_tubes]):
+                    specimens += projections.SPECIMEN.dump(session, [criterion])
+                study_subjects = []
+                for criterion in in_criteria(session, study_subject.c.id, [_['study_subject'] for _ in specimens]):
+                    study_subjects += projections.STUDY_SUBJECT.dump(session, [criterion])
+            else:
+                study_subjects = projections.STUDY_SUBJECT.dump(session, [study_subject.c.study_id == study_id])
+                specimens = projections.SPECIMEN.dump(
+                    session, [study_subject.c.study_id == study_id],
+                    joins=[(study_subject, specimen.c.study_subject_id == study_subject.c.id)])
+        return (studies[0] if studies else None), study_subjects, specimens, matrix_tubes
+
     @staticmethod
-    def _get_study_by_short_code(session, short_code):
-        study = session.query(Study).filter(Study.short_code == short_code).one()
+    def _get_tombstones(session, since, *criteria):
+        # type: (Session, datetime.datetime, ...) -> list[Tombstone]
+        """
+        Unmanaged function to get the tombstones recorded after since, one per row.
+        """
+        tombstones = session.query(Tombstone).filter(Tombstone.last_updated > since, *criteria)\
+            .order_by(Tombstone.id).all()
+        return OrderedDict([((_.table_name, _.row_id), _) for _ in tombstones]).values()
+
+    def get_study_changes(self, study_id, since):
+        # type: (int, datetime.datetime) -> Changes
+        """
+        Get the rows of a study that were created, updated or deleted after a point in time, so a client holding a
+        copy of the study can bring it up to date. Clients apply the tombstones before the changed rows, as IDs of
+        deleted rows may be reused.
+        :param study_id: Study ID
+        :param since: UTC time of the previous sync, the synced_at of its Changes.
+        :return: Changes with the study as scope, synced_at is the since of the next sync.
+        """
+        synced_at = datetime.datetime.utcnow() - CHANGES_OVERLAP
+        with self._session_scope(read_only=True) as session:
+            study = session.query(Study).get(study_id)  # type: Study
+            if not study:
+                raise NoResultFound('Study {} does not exist.'.format(study_id))
+            # Changed rows are dumped with the IDs of their children, loaded up front rather than per row.
+            study_subjects = session.query(StudySubject).options(subqueryload(StudySubject.specimens))\
+                .filter(StudySubject.study_id == study_id, StudySubject.last_updated > since).all()
+            specimens = session.query(Specimen).options(subqueryload(Specimen.storage_containers))\
+                .join(StudySubject)\
+                .filter(StudySubject.study_id == study_id, Specimen.last_updated > since).all()
+            matrix_tubes = session.query(MatrixTube).join(Specimen).join(StudySubject)\
+                .filter(StudySubject.study_id == study_id, MatrixTube.last_updated > since).all()
+            tombstones = self._get_tombstones(session, since, Tombstone.study_id == study_id)
+        return Changes(study, study_subjects, specimens, matrix_tubes, tombstones, synced_at)
+
+    def _get_study_by_short_code(self, session, short_code):
+        study = self._get_studies_by_short_code(session, [short_code]).get(short_code)
+        if not study:
+            raise NoResultFound("No row was found for one()")
         return study
 
     def get_study_by_short_code(self, short_code):
-        with self._session_scope() as session:
+        with self._session_scope(read_only=True) as session:
             study = self._get_study_by_short_code(session, short_code)
+            # Not expired by the commit, whether it came from the reference cache or not.
+            session.expunge(study)
         return study
 
     def edit_study(self, study):
@@ -119,6 +688,7 @@ class SampleDB(object):
             study_subjects = session.query(StudySubject).filter(StudySubject.study_id == old_study.id).all() # type: list[StudySubject]
             specimens = session.query(Specimen).join(StudySubject).filter(StudySubject.study_id == old_study.id).all() # type: list[Specimen]
             matrix_tubes = session.query(MatrixTube).join(Specimen).join(StudySubject).filter(StudySubject.study_id == old_study.id).all()
+        self._reference_cache.invalidate('study', 'study_listing')
         return old_study, study_subjects, specimens, matrix_tubes
 
     def update_study(self, id, d):
@@ -133,23 +703,33 @@ class SampleDB(object):
                 StudySubject.study_id == study.id).all()  # type: list[Specimen]
             matrix_tubes = session.query(MatrixTube).join(Specimen).join(StudySubject).filter(
                 StudySubject.study_id == study.id).all()
+        self._reference_cache.invalidate('study', 'study_listing')
         return study, study_subjects, specimens, matrix_tubes
 
     def delete_study(self, study):
         # type: (Study) -> boolean
         with self._session_scope() as session:
             s = session.query(Study).get(study.id)
+            self._add_tombstones(session, 'study', [s.id])
             session.delete(s)
+            self._refresh_count_summaries(session, study_ids=[study.id])
+        self._reference_cache.invalidate('study', 'study_listing')
         return True
 
-    def get_studies(self):
-        # type () -> list[Study]
+    def get_studies(self, limit=None, after=None):
+        # type (int, int) -> list[Study]
         """
         Get list of all studies
+        :param limit: Optional maximum number of studies to return.
+        :param after: Optional study ID, only studies with a greater ID are returned.
         :return: List of Studies
         """
-        with self._session_scope() as session:
-            studies = session.query(Study).all()
+        with self._session_scope(read_only=True) as session:
+            studies = self._get_references(session, 'study_listing')
+            if studies is None:
+                studies = _paginate(session.query(Study), Study.id, limit, after).all()
+            else:
+                studies = _merged_copies(session, [_ for _ in studies if after is None or _.id > after][:limit])
         return studies
 
     def get_study_subjects(self, study_id):
@@ -159,7 +739,7 @@ class SampleDB(object):
         :param study_id: Study ID
         :return: StudySubject[]
         """
-        with self._session_scope() as session:
+        with self._session_scope(read_only=True) as session:
             study_subjects = session.query(StudySubject).join(Study).filter(Study.id == study_id).all()
         return study_subjects
 
@@ -173,6 +753,8 @@ class SampleDB(object):
         """
         with self._session_scope() as session:
             study_subject = self._add_study_subject(session, study_id, uid)
+            self._refresh_count_summaries(session, study_ids=[study_id])
+        self._reference_cache.invalidate('study_listing')
         return study_subject
 
     @staticmethod
@@ -194,6 +776,8 @@ class SampleDB(object):
             study = session.query(Study).get(study_id)
             study_subjects = [StudySubject(uid=_, study_id=study.id) for _ in uids]
             map(session.add, study_subjects)
+            self._refresh_count_summaries(session, study_ids=[study.id])
+        self._reference_cache.invalidate('study_listing')
         return study_subjects
 
     def delete_study_subject(self, study_subject_id):
@@ -203,7 +787,10 @@ class SampleDB(object):
                 raise NoResultFound
             if study_subject.specimens:
                 raise ValueError("Cannot delete study subject with associated specimens.")
+            self._add_tombstones(session, 'study_subject', [study_subject.id])
             session.delete(study_subject)
+            self._refresh_count_summaries(session, study_ids=[study_subject.study_id])
+        self._reference_cache.invalidate('study_listing')
         return True
 
 
@@ -217,6 +804,9 @@ class SampleDB(object):
         with self._session_scope() as session:
             location = Location(description=description)
             session.add(location)
+            session.flush()
+            self._refresh_count_summaries(session, location_ids=[location.id])
+        self._reference_cache.invalidate('location')
         return location
 
     def get_locations(self):
@@ -225,8 +815,12 @@ class SampleDB(object):
         Get the list of all registered storage locations.
         :return: Location[]
         """
-        with self._session_scope() as session:
-            locations = session.query(Location).all()
+        with self._session_scope(read_only=True) as session:
+            locations = self._get_references(session, 'location')
+            if locations is None:
+                locations = session.query(Location).all()
+            else:
+                locations = _merged_copies(session, locations)
         return locations
 
     def get_location(self, id):
@@ -236,8 +830,12 @@ class SampleDB(object):
         :param id: Location ID
         :return: Location
         """
-        with self._session_scope() as session:
-            location = session.query(Location).get(id)
+        with self._session_scope(read_only=True) as session:
+            locations = self._get_references(session, 'location')
+            if locations is None:
+                location = session.query(Location).get(id)
+            else:
+                location = next(iter(_merged_copies(session, [_ for _ in locations if _.id == id])), None)
         return location
 
     def update_location(self, id, d):
@@ -245,13 +843,17 @@ class SampleDB(object):
         with self._session_scope() as session:
             location = session.query(Location).get(id)
             location.update(d)
+        self._reference_cache.invalidate('location')
         return location
 
     def delete_location(self, id):
         # type: (int) -> Boolean
         with self._session_scope() as session:
             location = session.query(Location).get(id)
+            self._add_tombstones(session, 'location', [location.id])
             session.delete(location)
+            self._refresh_count_summaries(session, location_ids=[id])
+        self._reference_cache.invalidate('location')
         return True
 
     def register_new_specimen_type(self, label, **kwargs):
@@ -264,6 +866,7 @@ class SampleDB(object):
         with self._session_scope() as session:
             specimen_type = SpecimenType(label=label)
             session.add(specimen_type)
+        self._reference_cache.invalidate('specimen_type')
         return specimen_type
 
     def get_specimen_types(self):
@@ -272,14 +875,22 @@ class SampleDB(object):
         Get the list of all registered specimen types.
         :return: SpecimenType[]
         """
-        with self._session_scope() as session:
-            specimen_types = session.query(SpecimenType).all()
+        with self._session_scope(read_only=True) as session:
+            specimen_types = self._get_references(session, 'specimen_type')
+            if specimen_types is None:
+                specimen_types = session.query(SpecimenType).all()
+            else:
+                specimen_types = _merged_copies(session, specimen_types)
         return specimen_types
 
     def get_specimen_type(self, id):
         # type: (int) -> SpecimenType
-        with self._session_scope() as session:
-            specimen_type = session.query(SpecimenType).get(id)
+        with self._session_scope(read_only=True) as session:
+            specimen_types = self._get_references(session, 'specimen_type')
+            if specimen_types is None:
+                specimen_type = session.query(SpecimenType).get(id)
+            else:
+                specimen_type = next(iter(_merged_copies(session, [_ for _ in specimen_types if _.id == id])), None)
         return specimen_type
 
     def update_specimen_type(self, id, d):
@@ -287,13 +898,16 @@ class SampleDB(object):
         with self._session_scope() as session:
             specimen_type = session.query(SpecimenType).get(id)
             specimen_type.update(d)
+        self._reference_cache.invalidate('specimen_type')
         return specimen_type
 
     def delete_specimen_type(self, id):
         # type: (int) -> Boolean
         with self._session_scope() as session:
             specimen_type = session.query(SpecimenType).get(id)
+            self._add_tombstones(session, 'specimen_type', [specimen_type.id])
             session.delete(specimen_type)
+        self._reference_cache.invalidate('specimen_type')
         return True
 
     @staticmethod
@@ -316,8 +930,7 @@ class SampleDB(object):
 
         return specimen_query.one()
 
-    @staticmethod
-    def _add_specimen(session, uid, short_code, specimen_type, collection_date=None):
+    def _add_specimen(self, session, uid, short_code, specimen_type, collection_date=None):
         # type: (Session, str, str, str, datetime.date, Optional[str]) -> Specimen
         """
         Unmanaged function to add a new specimen to a study subject
@@ -330,7 +943,9 @@ class SampleDB(object):
         """
         study_subject = session.query(StudySubject).join(Study).filter(Study.short_code == short_code)\
             .filter(StudySubject.uid == uid).one()
-        specimen_type = session.query(SpecimenType).filter(SpecimenType.label == specimen_type).one()
+        specimen_type = self._get_specimen_types_by_label(session, [specimen_type]).get(specimen_type)
+        if not specimen_type:
+            raise NoResultFound("No row was found for one()")
         specimen = Specimen()
         specimen.study_subject = study_subject
         specimen.specimen_type = specimen_type
@@ -338,6 +953,110 @@ class SampleDB(object):
         session.add(specimen)
         return specimen
 
+    def _get_studies_by_short_code(self, session, short_codes):
+        # type: (Session, list[str]) -> dict[str, Study]
+        """
+        Unmanaged function to get all studies matching any of the short codes, from the reference cache when possible.
+        :param session: The _session to use for querying the database.
+        :param short_codes: Short codes identifying studies, may contain duplicates.
+        :return: Map of short code to Study
+        """
+        cached_studies = self._get_references(session, 'study')
+        if cached_studies is not None:
+            short_codes = set(short_codes)
+            return dict([(_.short_code, session.merge(_, load=False)) for _ in cached_studies
+                         if _.short_code in short_codes])
+        studies = {}
+        for criterion in in_criteria(session, Study.short_code, short_codes):
+            for study in session.query(Study).filter(criterion):
+                studies[study.short_code] = study
+        return studies
+
+    def _get_specimen_types_by_label(self, session, labels):
+        # type: (Session, list[str]) -> dict[str, SpecimenType]
+        """
+        Unmanaged function to get all specimen types matching any of the labels, from the reference cache when
+        possible.
+        :param session: The _session to use for querying the database.
+        :param labels: Labels describing specimen types, may contain duplicates.
+        :return: Map of label to SpecimenType
+        """
+        cached_specimen_types = self._get_references(session, 'specimen_type')
+        if cached_specimen_types is not None:
+            labels = set(labels)
+            return dict([(_.label, session.merge(_, load=False)) for _ in cached_specimen_types if _.label in labels])
+        specimen_types = {}
+        for criterion in in_criteria(session, SpecimenType.label, labels):
+            for specimen_type in session.query(SpecimenType).filter(criterion):
+                specimen_types[specimen_type.label] = specimen_type
+        return specimen_types
+
+    @staticmethod
+    def _get_study_subjects_by_uid(session, study_ids, uids):
+        # type: (Session, list[int], list[str]) -> dict[tuple[int, str], StudySubject]
+        """
+        Unmanaged function to get all study subjects with one of the uids in one of the studies.
+        :param session: The _session to use for querying the database.
+        :param study_ids: Study IDs to search in.
+        :param uids: Unique IDs identifying study subjects, may contain duplicates.
+        :return: Map of (study ID, uid) to StudySubject
+        """
+        study_subjects = {}
+        study_ids = list(set(study_ids))
+        if not study_ids:
+            return study_subjects
+        for criterion in in_criteria(session, StudySubject.uid, uids, reserved=len(study_ids)):
+            study_subject_query = session.query(StudySubject).filter(StudySubject.study_id.in_(study_ids))\
+                .filter(criterion)
+            for study_subject in study_subject_query:
+                study_subjects[(study_subject.study_id, study_subject.uid)] = study_subject
+        return study_subjects
+
+    @staticmethod
+    def _get_specimens_by_subject_and_type(session, study_subjects, specimen_types):
+        # type: (Session, list[StudySubject], list[SpecimenType]) -> dict[tuple[int, str, str], list[Specimen]]
+        """
+        Unmanaged function to get all specimens of the given types belonging to the given study subjects.
+        :param session: The _session to use for querying the database.
+        :param study_subjects: Previously loaded study subjects.
+        :param specimen_types: Previously loaded specimen types.
+        :return: Map of (study ID, uid, specimen type label) to the list of matching Specimens
+        """
+        specimens = {}
+        study_subjects = {_.id: _ for _ in study_subjects}
+        specimen_types = {_.id: _ for _ in specimen_types}
+        if not study_subjects or not specimen_types:
+            return specimens
+        for criterion in in_criteria(session, Specimen.study_subject_id, study_subjects.keys(),
+                                     reserved=len(specimen_types)):
+            specimen_query = session.query(Specimen).filter(criterion)\
+                .filter(Specimen.specimen_type_id.in_(specimen_types.keys())).order_by(Specimen.id)
+            for specimen in specimen_query:
+                study_subject = study_subjects[specimen.study_subject_id]
+                specimen_type = specimen_types[specimen.specimen_type_id]
+                key = (study_subject.study_id, study_subject.uid, specimen_type.label)
+                specimens.setdefault(key, []).append(specimen)
+        return specimens
+
+    @staticmethod
+    def _match_specimen(specimens, collection_date):
+        # type: (list[Specimen], datetime.date) -> Specimen
+        """
+        Pick the specimen with the collection date out of previously loaded candidates, following the same rules
+        as _get_specimen.
+        :param specimens: Specimens of a single type for a single study subject.
+        :param collection_date: The date of collection. If not provided, there must be exactly one candidate.
+        :return: Specimen
+        """
+        if collection_date:
+            collection_date = _as_date(collection_date)
+            specimens = [_ for _ in specimens if _.collection_date == collection_date]
+        if not specimens:
+            raise NoResultFound("No row was found for one()")
+        if len(specimens) > 1:
+            raise MultipleResultsFound("Multiple rows were found for one()")
+        return specimens[0]
+
     def get_specimens(self, uid, short_code, collection_date=None):
         """
         Get all specimens associated with a study subject
@@ -346,7 +1065,7 @@ class SampleDB(object):
         :param collection_date: Optional date on which the specimen was collected.
         :return:
         """
-        with self._session_scope() as session:
+        with self._session_scope(read_only=True) as session:
             specimen_query = session.query(Specimen).join(StudySubject).filter(StudySubject.uid == uid)\
                 .join(Study).filter(Study.short_code == short_code)
 
@@ -355,22 +1074,88 @@ class SampleDB(object):
             specimens = specimen_query.all()
         return specimens
 
-    def get_matrix_plates(self):
-        with self._session_scope() as session:
-            matrix_plates = session.query(MatrixPlate).all()
+    def get_matrix_plates(self, limit=None, after=None, hidden=None):
+        # type: (int, int, bool) -> list[MatrixPlate]
+        """
+        Get list of all matrix plates
+        :param limit: Optional maximum number of plates to return.
+        :param after: Optional plate ID, only plates with a greater ID are returned.
+        :param hidden: Optionally only return plates that are, or are not, hidden.
+        :return: List of MatrixPlates
+        """
+        with self._session_scope(read_only=True) as session:
+            matrix_plate_query = session.query(MatrixPlate)
+            if hidden is not None:
+                matrix_plate_query = matrix_plate_query.filter(MatrixPlate.hidden == hidden)
+            matrix_plates = _paginate(matrix_plate_query, MatrixPlate.id, limit, after).all()
         return matrix_plates
 
     def get_matrix_plate(self, plate_id):
-        with self._session_scope() as session:
+        with self._session_scope(read_only=True) as session:
             plate = session.query(MatrixPlate).get(plate_id)
             study_subjects = session.query(StudySubject).join(Specimen).join(MatrixTube).join(MatrixPlate).\
                 filter(MatrixPlate.id == plate_id).all()
             specimens = session.query(Specimen).join(MatrixTube).join(MatrixPlate).filter(MatrixPlate.id == plate_id).all()
         return plate, study_subjects, specimens, plate.tubes
 
+    def dump_matrix_plate(self, plate_id):
+        # type: (int) -> tuple[dict, list[dict], list[dict], list[dict]]
+        """
+        Same as get_matrix_plate, but returns the entries the MatrixPlateSchema, StudySubjectSchema, SpecimenSchema
+        and MatrixTubeSchema would dump, see dump_study.
+        :return: Entries of the plate, or None if it does not exist, and of the study subjects, specimens and matrix
+            tubes on it.
+        """
+        study_subject = StudySubject.__table__
+        specimen = Specimen.__table__
+        storage_container = StorageContainer.__table__
+        matrix_tube = MatrixTube.__table__
+        tubes_of_specimens = [(storage_container, storage_container.c.specimen_id == specimen.c.id),
+                              (matrix_tube, matrix_tube.c.id == storage_container.c.id)]
+        with self._session_scope(read_only=True) as session:
+            plates = projections.MATRIX_PLATE.dump(session, [MatrixPlate.__table__.c.id == plate_id])
+            if not plates:
+                return None, [], [], []
+            criteria = [matrix_tube.c.plate_id == plate_id]
+            study_subjects = projections.STUDY_SUBJECT.dump(
+                session, criteria, distinct=True,
+                joins=[(specimen, specimen.c.study_subject_id == study_subject.c.id)] + tubes_of_specimens)
+            specimens = projections.SPECIMEN.dump(session, criteria, joins=tubes_of_specimens, distinct=True)
+            matrix_tubes = projections.MATRIX_TUBE.dump(session, criteria)
+        return plates[0], study_subjects, specimens, matrix_tubes
+
+    def get_matrix_plate_changes(self, plate_id, since):
+        # type: (int, datetime.datetime) -> Changes
+        """
+        Get the rows of a plate that were created, updated or removed after a point in time, see get_study_changes.
+        Tubes that were moved onto the plate come with their specimens and study subjects, tubes moved off it get a
+        tombstone.
+        :param plate_id: Matrix plate ID
+        :param since: UTC time of the previous sync, the synced_at of its Changes.
+        :return: Changes with the plate as scope, synced_at is the since of the next sync.
+        """
+        synced_at = datetime.datetime.utcnow() - CHANGES_OVERLAP
+        with self._session_scope(read_only=True) as session:
+            plate = session.query(MatrixPlate).get(plate_id)  # type: MatrixPlate
+            if not plate:
+                raise NoResultFound('Matrix plate {} does not exist.'.format(plate_id))
+            matrix_tubes = session.query(MatrixTube)\
+                .filter(MatrixTube.plate_id == plate_id, MatrixTube.last_updated > since).all()
+            specimens = session.query(Specimen).options(subqueryload(Specimen.storage_containers))\
+                .join(MatrixTube)\
+                .filter(MatrixTube.plate_id == plate_id,
+                        or_(Specimen.last_updated > since, MatrixTube.last_updated > since)).distinct().all()
+            study_subjects = session.query(StudySubject).options(subqueryload(StudySubject.specimens))\
+                .join(Specimen).join(MatrixTube)\
+                .filter(MatrixTube.plate_id == plate_id,
+                        or_(StudySubject.last_updated > since, Specimen.last_updated > since,
+                            MatrixTube.last_updated > since)).distinct().all()
+            tombstones = self._get_tombstones(session, since, Tombstone.plate_id == plate_id)
+        return Changes(plate, study_subjects, specimens, matrix_tubes, tombstones, synced_at)
+
     def add_matrix_plate_with_specimens(self, plate_uid, location_id, specimen_entries, create_missing_specimens=False,
-                                        create_missing_subjects=False):
-        # type: (str, int, list(dict)) -> list(MatrixTube)
+                                        create_missing_subjects=False, dry_run=False, progress=None):
+        # type: (str, int, list(dict), bool, bool, bool, callable) -> list(MatrixTube)
         """
         Add a new matrix plate with new specimens
         :param plate_uid: Unique Plate ID.
@@ -387,58 +1172,262 @@ class SampleDB(object):
             }
         :param create_missing_specimens: If specimen for subject missing in study, create if true
         :param create_missing_subjects: If subjects missing in study, create if true
-        :return: List of added MatrixTubes.
+        :param dry_run: Only validate the entries, nothing is written.
+        :param progress: Optional callable, passed the number of entries written so far after every chunk.
+        :return: List of added MatrixTubes. On a dry run, a list of error messages for each entry instead.
         """
+        if dry_run:
+            with self._session_scope(read_only=True) as session:
+                report = self._check_new_plate_entries(session, plate_uid, specimen_entries, create_missing_specimens,
+                                                       create_missing_subjects)
+            return report
         matrix_tubes = []
         study_subjects = []
         specimens = []
         with self._session_scope() as session:
-            try:
-                matrix_plate = session.query(MatrixPlate).filter(MatrixPlate.uid == plate_uid).one()
-            except NoResultFound:
+            matrix_plate = session.query(MatrixPlate).filter(MatrixPlate.uid == plate_uid).first()
+
+            # Check the wells against the plate's occupancy before anything is written.
+            for specimen_entry in specimen_entries:
+                if specimen_entry['well_position'] not in MatrixTube.well_list or \
+                        specimen_entry['well_position'].startswith('-'):
+                    raise ValueError("{} is not a valid well position.".format(specimen_entry['well_position']))
+            if matrix_plate:
+                occupancy = self._get_plate_occupancy(session, [matrix_plate.id])
+            else:
+                occupancy = PlateOccupancy()
+            plate_id = matrix_plate.id if matrix_plate else None
+            conflicts = occupancy.place([(plate_id, _['well_position'], None) for _ in specimen_entries])
+            if conflicts:
+                raise WellConflictError([(plate_uid, well_position) for _, well_position, _ in conflicts])
+
+            if not matrix_plate:
                 matrix_plate = MatrixPlate(uid=plate_uid, location_id=location_id)
                 session.add(matrix_plate)
                 session.flush()
-            for specimen_entry in specimen_entries:
-                uid = specimen_entry['uid']
-                short_code = specimen_entry['short_code']
-                specimen_type = specimen_entry['specimen_type']
-                collection_date = specimen_entry.get('collection_date')
-                study = self._get_study_by_short_code(session, short_code)
-                try:
-                    specimen = self._get_specimen(session, uid, short_code, specimen_type, collection_date)
-                except NoResultFound:
-                    if create_missing_specimens:
-                        try:
-                            specimen = self._add_specimen(session, uid, short_code, specimen_type, collection_date)
-                        except NoResultFound:
-                            if create_missing_subjects:
-                                self._add_study_subject(session, study.id, uid)
-                                session.flush()
-                                specimen = self._add_specimen(session, uid, short_code, specimen_type, collection_date)
-                            else:
-                                raise ValueError("Sample {} in Study {} does not exist.".format(uid, short_code))
-                    else:
-                        raise ValueError(
-                            "{} Specimen for Sample {} does not exist in Study {}".format(specimen_type, uid,
-                                                                                          short_code))
-                session.flush()
 
-                barcode = specimen_entry['barcode']
-                well_position = specimen_entry['well_position']
-                comments = specimen_entry.get('comments')
-                matrix_tube = MatrixTube(barcode=barcode, comments=comments, well_position=well_position)
-                matrix_tube.plate = matrix_plate
-                matrix_tube.specimen = specimen
-                session.add(matrix_tube)
-                matrix_tubes.append(matrix_tube)
+            # Resolve everything the entries refer to up front, the loop below only touches these maps.
+            study_map = self._get_studies_by_short_code(session, [_['short_code'] for _ in specimen_entries])
+            specimen_type_map = self._get_specimen_types_by_label(session,
+                                                                  [_['specimen_type'] for _ in specimen_entries])
+            study_subject_map = self._get_study_subjects_by_uid(session, [_.id for _ in study_map.values()],
+                                                                [_['uid'] for _ in specimen_entries])
+            specimen_map = self._get_specimens_by_subject_and_type(session, study_subject_map.values(),
+                                                                   specimen_type_map.values())
+
+            processed = 0
+            for specimen_entry_chunk in chunks(specimen_entries, WRITE_CHUNK_SIZE):
+                for specimen_entry in specimen_entry_chunk:
+                    uid = specimen_entry['uid']
+                    short_code = specimen_entry['short_code']
+                    specimen_type = specimen_entry['specimen_type']
+                    collection_date = specimen_entry.get('collection_date')
+                    study = study_map.get(short_code)
+                    if not study:
+                        raise NoResultFound("No row was found for one()")
+                    specimen_key = (study.id, uid, specimen_type)
+                    try:
+                        specimen = self._match_specimen(specimen_map.get(specimen_key, []), collection_date)
+                    except NoResultFound:
+                        if create_missing_specimens:
+                            study_subject = study_subject_map.get((study.id, uid))
+                            if not study_subject:
+                                if create_missing_subjects:
+                                    study_subject = StudySubject(uid=uid, study=study)
+                                    session.add(study_subject)
+                                    study_subject_map[(study.id, uid)] = study_subject
+                                else:
+                                    raise ValueError("Sample {} in Study {} does not exist.".format(uid, short_code))
+                            if specimen_type not in specimen_type_map:
+                                raise NoResultFound("No row was found for one()")
+                            specimen = Specimen()
+                            specimen.study_subject = study_subject
+                            specimen.specimen_type = specimen_type_map[specimen_type]
+                            specimen.collection_date = _as_date(collection_date)
+                            session.add(specimen)
+                            specimen_map.setdefault(specimen_key, []).append(specimen)
+                        else:
+                            raise ValueError(
+                                "{} Specimen for Sample {} does not exist in Study {}".format(specimen_type, uid,
+                                                                                              short_code))
+
+                    barcode = specimen_entry['barcode']
+                    well_position = specimen_entry['well_position']
+                    comments = specimen_entry.get('comments')
+                    matrix_tube = MatrixTube(barcode=barcode, comments=comments, well_position=well_position)
+                    matrix_tube.plate = matrix_plate
+                    matrix_tube.specimen = specimen
+                    matrix_tubes.append(matrix_tube)
+                session.add_all(matrix_tubes[processed:])
+                session.flush()
+                processed += len(specimen_entry_chunk)
+                if progress:
+                    progress(processed)
             study_subjects = session.query(StudySubject).join(Specimen).join(MatrixTube).\
                 filter(MatrixTube.plate_id == matrix_plate.id).all()
             specimens = session.query(Specimen).join(MatrixTube).filter(MatrixTube.plate_id == matrix_plate.id).all()
+            self._refresh_count_summaries(session, study_ids=[_.study_id for _ in study_subjects],
+                                          plate_ids=[matrix_plate.id], location_ids=[matrix_plate.location_id])
+        if create_missing_subjects:
+            self._reference_cache.invalidate('study_listing')
         return matrix_plate, study_subjects, specimens, matrix_tubes
 
-    def update_matrix_tube_locations(self, matrix_tube_entries):
-        # type: (list(dict)) -> list(MatrixTube)
+    def _check_new_plate_entries(self, session, plate_uid, specimen_entries, create_missing_specimens=False,
+                                 create_missing_subjects=False):
+        # type: (Session, str, list[dict], bool, bool) -> list[list[str]]
+        """
+        Unmanaged function to validate the entries of a plate upload in one batched pass, without writing anything.
+        Every entry is checked, rather than stopping at the first error.
+        :param session: The _session to use for querying the database.
+        :param plate_uid: Unique Plate ID.
+        :param specimen_entries: list of specimen entries, as taken by add_matrix_plate_with_specimens.
+        :param create_missing_specimens: If specimen for subject missing in study, create if true
+        :param create_missing_subjects: If subjects missing in study, create if true
+        :return: List of error messages for each entry, empty if the entry is valid.
+        """
+        matrix_tube = MatrixTube.__table__
+        report = [[] for _ in specimen_entries]
+        matrix_plate = session.query(MatrixPlate).filter(MatrixPlate.uid == plate_uid).first()
+        study_map = self._get_studies_by_short_code(session, [_['short_code'] for _ in specimen_entries])
+        specimen_type_map = self._get_specimen_types_by_label(session, [_['specimen_type'] for _ in specimen_entries])
+        study_subject_map = self._get_study_subjects_by_uid(session, [_.id for _ in study_map.values()],
+                                                           [_['uid'] for _ in specimen_entries])
+        specimen_map = self._get_specimens_by_subject_and_type(session, study_subject_map.values(),
+                                                              specimen_type_map.values())
+        existing_barcodes = set()
+        for criterion in in_criteria(session, matrix_tube.c.barcode, [_['barcode'] for _ in specimen_entries]):
+            existing_barcodes.update([_ for _, in session.execute(select([matrix_tube.c.barcode]).where(criterion))])
+        if matrix_plate:
+            occupancy = self._get_plate_occupancy(session, [matrix_plate.id])
+        else:
+            occupancy = PlateOccupancy()
+        plate_id = matrix_plate.id if matrix_plate else None
+
+        barcode_rows = {}
+        for row, specimen_entry in enumerate(specimen_entries):
+            errors = report[row]
+            uid = specimen_entry['uid']
+            short_code = specimen_entry['short_code']
+            specimen_type = specimen_entry['specimen_type']
+            collection_date = specimen_entry.get('collection_date')
+            barcode = specimen_entry['barcode']
+            well_position = specimen_entry['well_position']
+
+            if barcode in existing_barcodes:
+                errors.append("Matrix tube with barcode {} already exists.".format(barcode))
+            elif barcode in barcode_rows:
+                errors.append("Barcode {} is also used in entry {}.".format(barcode, barcode_rows[barcode] + 1))
+            barcode_rows.setdefault(barcode, row)
+
+            if well_position not in MatrixTube.well_list or well_position.startswith('-'):
+                errors.append("{} is not a valid well position.".format(well_position))
+            elif occupancy.place([(plate_id, well_position, None)]):
+                errors.append("Tube Position Conflict at {} {}.".format(plate_uid, well_position))
+
+            study = study_map.get(short_code)
+            if not study:
+                errors.append("Study {} does not exist.".format(short_code))
+            if specimen_type not in specimen_type_map:
+                errors.append("Specimen type {} is not registered.".format(specimen_type))
+            if not study or specimen_type not in specimen_type_map:
+                continue
+
+            specimen_key = (study.id, uid, specimen_type)
+            try:
+                self._match_specimen(specimen_map.get(specimen_key, []), collection_date)
+            except MultipleResultsFound:
+                errors.append("Multiple {} Specimens for Sample {} exist in Study {}, a collection date is "
+                              "required.".format(specimen_type, uid, short_code))
+            except NoResultFound:
+                if not create_missing_specimens:
+                    errors.append("{} Specimen for Sample {} does not exist in Study {}".format(specimen_type, uid,
+                                                                                               short_code))
+                elif (study.id, uid) not in study_subject_map and not create_missing_subjects:
+                    errors.append("Sample {} in Study {} does not exist.".format(uid, short_code))
+                elif study.is_longitudinal and not collection_date:
+                    errors.append("Not allowed to add specimens without a collection date to a longitudinal "
+                                  "study.")
+                else:
+                    # Later entries for the same specimen pick up the one this entry would create.
+                    study_subject_map.setdefault((study.id, uid), None)
+                    specimen_map.setdefault(specimen_key, []).append(PendingSpecimen(_as_date(collection_date)))
+        return report
+
+    @staticmethod
+    def _get_plates_by_uid(session, plate_uids):
+        # type: (Session, list[str]) -> dict[str, MatrixPlate]
+        """
+        Unmanaged function to get matrix plates from a collection of UIDs, using one query per chunk of UIDs.
+        :param session: The _session to use for querying the database.
+        :param plate_uids: Unique plate IDs, may contain duplicates.
+        :return: Map of UID to MatrixPlate, UIDs that do not exist are left out.
+        """
+        plates = {}
+        for criterion in in_criteria(session, MatrixPlate.uid, plate_uids):
+            for plate in session.query(MatrixPlate).filter(criterion):
+                plates[plate.uid] = plate
+        return plates
+
+    @staticmethod
+    def _get_plate_occupancy(session, plate_ids):
+        # type: (Session, list[int]) -> PlateOccupancy
+        """
+        Unmanaged function to get the occupied wells of a collection of plates with one query per chunk of IDs.
+        :param session: The _session to use for querying the database.
+        :param plate_ids: IDs of the plates.
+        :return: PlateOccupancy of the plates
+        """
+        matrix_tube = MatrixTube.__table__
+        occupancy = PlateOccupancy()
+        for criterion in in_criteria(session, matrix_tube.c.plate_id, plate_ids):
+            well_query = select([matrix_tube.c.plate_id, matrix_tube.c.well_position, matrix_tube.c.id])\
+                .where(criterion)
+            for plate_id, well_position, matrix_tube_id in session.execute(well_query):
+                occupancy.add(plate_id, well_position, matrix_tube_id)
+        return occupancy
+
+    @classmethod
+    def _check_matrix_tube_moves(cls, session, matrix_tube_entries):
+        # type: (Session, list[dict]) -> list[list[str]]
+        """
+        Unmanaged function to validate the entries of a matrix tube relocation in one batched pass, without writing
+        anything. Every entry is checked, rather than stopping at the first error.
+        :param session: The _session to use for querying the database.
+        :param matrix_tube_entries: list of matrix tube entries, as taken by update_matrix_tube_locations.
+        :return: List of error messages for each entry, empty if the entry is valid.
+        """
+        report = [[] for _ in matrix_tube_entries]
+        matrix_tube_map = cls._get_matrix_tubes_by_barcode(session, [_['barcode'] for _ in matrix_tube_entries])
+        plate_map = cls._get_plates_by_uid(session, [_['plate_uid'] for _ in matrix_tube_entries])
+
+        moves = OrderedDict()
+        for row, matrix_tube_entry in enumerate(matrix_tube_entries):
+            errors = report[row]
+            barcode = matrix_tube_entry['barcode']
+            plate_uid = matrix_tube_entry['plate_uid']
+            well_position = matrix_tube_entry['well_position']
+            if barcode not in matrix_tube_map:
+                errors.append('Matrix Tube with barcode {} does not exist.'.format(barcode))
+            if plate_uid not in plate_map:
+                errors.append('Matrix plate with UID {} does not exist.'.format(plate_uid))
+            if well_position not in MatrixTube.well_list or well_position.startswith('-'):
+                errors.append("{} is not a valid well position.".format(well_position))
+            if not errors:
+                # Like update_matrix_tube_locations, the last entry for a barcode wins.
+                moves[barcode] = row
+
+        occupancy = cls._get_plate_occupancy(session, [_.id for _ in plate_map.values()])
+        map(occupancy.release, [matrix_tube_map[_].id for _ in moves])
+        for barcode, row in moves.items():
+            matrix_tube_entry = matrix_tube_entries[row]
+            plate_id = plate_map[matrix_tube_entry['plate_uid']].id
+            if occupancy.place([(plate_id, matrix_tube_entry['well_position'], matrix_tube_map[barcode].id)]):
+                report[row].append("Tube Position Conflict at {} {}.".format(matrix_tube_entry['plate_uid'],
+                                                                            matrix_tube_entry['well_position']))
+        return report
+
+    def update_matrix_tube_locations(self, matrix_tube_entries, dry_run=False, progress=None):
+        # type: (list(dict), bool, callable) -> list(MatrixTube)
         """
         Update locations of matrix tubes.
         :param matrix_tube_entries: list of matrix_tube_entries:
@@ -448,134 +1437,288 @@ class SampleDB(object):
                 'well_position': New matrix tube position,
                 'comments': Optional comments
             }
-        :return:
+        :param dry_run: Only validate the entries, nothing is written.
+        :param progress: Optional callable, passed the number of matrix tubes moved so far after every chunk.
+        :return: On a dry run, a list of error messages for each entry.
         """
-        matrix_tubes = []
+        if dry_run:
+            with self._session_scope(read_only=True) as session:
+                report = self._check_matrix_tube_moves(session, matrix_tube_entries)
+            return report
+        storage_container = StorageContainer.__table__
+        matrix_tube_table = MatrixTube.__table__
         with self._session_scope() as session:
-            with session.no_autoflush:
-                temp_matrix_tube_map = {}
-                matrix_plates = []
-                study_subjects = []
-                specimens = []
-                for matrix_tube_entry in matrix_tube_entries:
-                    barcode = matrix_tube_entry['barcode']
-                    plate_uid = matrix_tube_entry['plate_uid']
-
-                    # Yes, this looks weird, but it's necessary to be able to move tubes around. Essentially every tube is
-                    # being moved to a temporary "mirror" state, where the well position is prefixed with a '-'. After that
-                    # is complete, they're moved to their proper true well position without the prefixed '-'. If we try to
-                    # do an in-place move, the unique constraint of the database triggers and throws an error. This is only
-                    # a problem in MySQL and SQLITE.
-
-                    well_position = '-' + matrix_tube_entry['well_position']
-                    temp_matrix_tube_map[barcode] = matrix_tube_entry['well_position']
-
-                    comments = matrix_tube_entry.get('comments')
-                    try:
-                        matrix_tube = session.query(MatrixTube).filter(MatrixTube.barcode == barcode).one()  # type: MatrixTube
-                    except NoResultFound:
-                        raise NoResultFound('Matrix Tube with barcode {} does not exist.'.format(barcode))
-                    old_plate = matrix_tube.plate
-
-                    try:
-                        destination_plate = session.query(MatrixPlate).filter(MatrixPlate.uid == plate_uid).one()  # type: MatrixPlate
-                    except NoResultFound:
-                        raise NoResultFound('Matrix plate with UID {} does not exist.'.format(plate_uid))
-                    matrix_tube.plate = destination_plate
-                    matrix_tube.well_position = well_position
-                    if comments:
-                        matrix_tube.comments = comments
-                    matrix_tubes.append(matrix_tube)
-                    matrix_plates += [old_plate, destination_plate]
-                    study_subjects.append(matrix_tube.specimen.study_subject)
-                    specimens.append(matrix_tube.specimen)
-                session.flush()
-                # Do the proper remapping
-                for tube in matrix_tubes:
-                    tube.well_position = temp_matrix_tube_map[tube.barcode]
-                matrix_plates = list(set(matrix_plates))
-                study_subjects = list(set(study_subjects))
-                specimens = list(set(specimens))
-            session.flush()
+            matrix_tube_map = self._get_matrix_tubes_by_barcode(
+                session, [_['barcode'] for _ in matrix_tube_entries],
+                joinedload(MatrixTube.plate),
+                joinedload(MatrixTube.specimen).joinedload(Specimen.study_subject))
+            plate_map = self._get_plates_by_uid(session, [_['plate_uid'] for _ in matrix_tube_entries])
+
+            moves = OrderedDict()
+            for matrix_tube_entry in matrix_tube_entries:
+                barcode = matrix_tube_entry['barcode']
+                plate_uid = matrix_tube_entry['plate_uid']
+                well_position = matrix_tube_entry['well_position']
+                if barcode not in matrix_tube_map:
+                    raise NoResultFound('Matrix Tube with barcode {} does not exist.'.format(barcode))
+                if plate_uid not in plate_map:
+                    raise NoResultFound('Matrix plate with UID {} does not exist.'.format(plate_uid))
+                if well_position not in MatrixTube.well_list or well_position.startswith('-'):
+                    raise ValueError("{} is not a valid well position.".format(well_position))
+                moves[barcode] = matrix_tube_entry
+
+            # Check the final layout of every destination plate before writing anything. Tubes that are being moved
+            # free up their current wells.
+            matrix_tubes = [matrix_tube_map[_] for _ in moves]
+            moved_matrix_tube_ids = set([_.id for _ in matrix_tubes])
+            occupancy = self._get_plate_occupancy(session, [_.id for _ in plate_map.values()])
+            map(occupancy.release, moved_matrix_tube_ids)
+            plate_uids = dict([(_.id, _.uid) for _ in plate_map.values()])
+            conflicts = occupancy.place([(plate_map[_['plate_uid']].id, _['well_position'],
+                                          matrix_tube_map[barcode].id) for barcode, _ in moves.items()])
+            if conflicts:
+                raise WellConflictError([(plate_uids[plate_id], well_position) for plate_id, well_position, _ in
+                                         conflicts], "Make sure all plates with moved tubes are being updated.")
+
+            # Yes, this looks weird, but it's necessary to be able to move tubes around. Essentially every tube is
+            # being moved to a temporary "mirror" state, where the well position is prefixed with a '-'. After that
+            # is complete, they're moved to their proper true well position without the prefixed '-'. If we try to
+            # do an in-place move, the unique constraint of the database triggers and throws an error. This is only
+            # a problem in MySQL and SQLITE.
+            position_update = matrix_tube_table.update().where(matrix_tube_table.c.id == bindparam('_id'))\
+                .values(plate_id=bindparam('_plate_id'), well_position=bindparam('_well_position'))
+            comment_update = storage_container.update().where(storage_container.c.id == bindparam('_id'))\
+                .values(comments=bindparam('_comments'))
+            mirror_positions = []
+            well_positions = []
+            comments = []
+            moved_off = []
+            for barcode, matrix_tube_entry in moves.items():
+                matrix_tube = matrix_tube_map[barcode]
+                plate_id = plate_map[matrix_tube_entry['plate_uid']].id
+                well_position = matrix_tube_entry['well_position']
+                mirror_positions.append({'_id': matrix_tube.id, '_plate_id': plate_id,
+                                         '_well_position': '-' + well_position})
+                well_positions.append({'_id': matrix_tube.id, '_plate_id': plate_id,
+                                       '_well_position': well_position})
+                comments.append({'_id': matrix_tube.id,
+                                 '_comments': matrix_tube_entry.get('comments') or matrix_tube.comments})
+                if matrix_tube.plate_id not in (None, plate_id):
+                    moved_off.append({'table_name': 'matrix_tube', 'row_id': matrix_tube.id, 'study_id': None,
+                                      'plate_id': matrix_tube.plate_id})
+            if moves:
+                session.execute(position_update, mirror_positions)
+            # Every tube is off its well by now, the final positions can be written a chunk at a time.
+            processed = 0
+            for well_position_chunk, comment_chunk in zip(chunks(well_positions, WRITE_CHUNK_SIZE),
+                                                          chunks(comments, WRITE_CHUNK_SIZE)):
+                session.execute(position_update, well_position_chunk)
+                session.execute(comment_update, comment_chunk)
+                processed += len(well_position_chunk)
+                if progress:
+                    progress(processed)
+            if moved_off:
+                session.execute(Tombstone.__table__.insert(), moved_off)
+
+            matrix_plates = set([_.plate for _ in matrix_tubes if _.plate])
+            matrix_plates.update([plate_map[_['plate_uid']] for _ in moves.values()])
+            matrix_plates = list(matrix_plates)
+            study_subjects = list(set([_.specimen.study_subject for _ in matrix_tubes]))
+            specimens = list(set([_.specimen for _ in matrix_tubes]))
+            if moves:
+                self._refresh_count_summaries(session, study_ids=[_.study_id for _ in study_subjects],
+                                              plate_ids=[_.id for _ in matrix_plates],
+                                              location_ids=[_.location_id for _ in matrix_plates])
+            for criterion in in_criteria(session, MatrixTube.id, moved_matrix_tube_ids):
+                session.query(MatrixTube).populate_existing().filter(criterion).all()
+            for matrix_plate in matrix_plates:
+                session.expire(matrix_plate, ['tubes'])
         return matrix_plates, study_subjects, specimens, matrix_tubes
 
     def delete_plate(self, plate_id):
         with self._session_scope() as session:
             matrix_plate = session.query(MatrixPlate).get(plate_id)
+            matrix_tube_ids = [_.id for _ in matrix_plate.tubes]
+            study_ids, _, _ = self._get_matrix_tube_scopes(session, matrix_tube_ids)
+            self._add_tombstones(session, 'matrix_plate', [plate_id])
+            # The tubes stay behind without a plate, only their matrix_tube rows change, so their last_updated is
+            # bumped for the change feeds of their studies to pick them up.
+            storage_container = StorageContainer.__table__
+            for criterion in in_criteria(session, storage_container.c.id, matrix_tube_ids):
+                session.execute(storage_container.update().where(criterion)
+                                .values(last_updated=datetime.datetime.utcnow()))
             session.delete(matrix_plate)
+            self._refresh_count_summaries(session, study_ids=study_ids, plate_ids=[plate_id],
+                                          location_ids=[matrix_plate.location_id])
         return True
 
+    @staticmethod
+    def _set_plates_hidden(session, plate_ids, hidden):
+        # type: (Session, list[int], bool) -> dict[int, MatrixPlate]
+        """
+        Unmanaged function to set the hidden flag of plates with one UPDATE per chunk of IDs.
+        :param session: The _session to use for querying the database.
+        :param plate_ids: IDs of the plates to update.
+        :param hidden: New value of the hidden flag.
+        :return: Map of ID to the updated MatrixPlate
+        """
+        matrix_plate = MatrixPlate.__table__
+        plate_ids = list(set(plate_ids))
+        for criterion in in_criteria(session, matrix_plate.c.id, plate_ids):
+            session.execute(matrix_plate.update().where(criterion).values(hidden=hidden))
+        plates = {}
+        for criterion in in_criteria(session, MatrixPlate.id, plate_ids):
+            for plate in session.query(MatrixPlate).populate_existing().filter(criterion):
+                plates[plate.id] = plate
+        missing_plate_ids = [_ for _ in plate_ids if _ not in plates]
+        if missing_plate_ids:
+            raise NoResultFound('Matrix plates with IDs {} do not exist.'.format(
+                ', '.join([str(_) for _ in sorted(missing_plate_ids)])))
+        return plates
+
     def hide_plates(self, plate_ids):
-        plates = []
         with self._session_scope() as session:
-            for plate_id in plate_ids:
-                plate = session.query(MatrixPlate).get(plate_id)
-                plate.hidden = True
-                plates.append(plate)
-        return plates
+            plates = self._set_plates_hidden(session, plate_ids, True)
+        return [plates[_] for _ in plate_ids]
 
     def unhide_plates(self, plate_ids):
-        plates = []
         with self._session_scope() as session:
-            for plate_id in plate_ids:
-                plate = session.query(MatrixPlate).get(plate_id)
-                plate.hidden = False
-                plates.append(plate)
-        return plates
+            plates = self._set_plates_hidden(session, plate_ids, False)
+        return [plates[_] for _ in plate_ids]
+
+    @staticmethod
+    def _get_specimen_locations(session, specimen_entries):
+        # type: (Session, list[dict]) -> dict[tuple[str, str, str], list[SpecimenLocations]]
+        """
+        Unmanaged function to get the matrix tube locations of every specimen that may match one of the entries.
+        Specimens, matrix tubes and plates are fetched together with one query per chunk of study subject uids.
+        :param session: The _session to use for querying the database.
+        :param specimen_entries: list of entries with 'uid', 'short_code' and 'specimen_type' keys.
+        :return: Map of (short code, uid, specimen type label) to candidate specimens ordered by ID
+        """
+        specimen_locations = {}
+        short_codes = list(set([_['short_code'] for _ in specimen_entries]))
+        specimen_types = list(set([_['specimen_type'] for _ in specimen_entries]))
+        if not short_codes or not specimen_types:
+            return specimen_locations
+        storage_container = StorageContainer.__table__
+        matrix_tube = MatrixTube.__table__
+        matrix_plate = MatrixPlate.__table__
+        # The short codes, specimen types and container type are bound as well.
+        for criterion in in_criteria(session, StudySubject.uid, [_['uid'] for _ in specimen_entries],
+                                     reserved=len(short_codes) + len(specimen_types) + 1):
+            location_query = session.query(Study.short_code, StudySubject.uid, SpecimenType.label, Specimen.id,
+                                           Specimen.collection_date, matrix_plate.c.uid, matrix_tube.c.well_position,
+                                           storage_container.c.comments)\
+                .select_from(Specimen).join(StudySubject).join(Study).join(SpecimenType)\
+                .outerjoin(storage_container, and_(storage_container.c.specimen_id == Specimen.id,
+                                                   storage_container.c.type == 'matrix_tube'))\
+                .outerjoin(matrix_tube, matrix_tube.c.id == storage_container.c.id)\
+                .outerjoin(matrix_plate, matrix_plate.c.id == matrix_tube.c.plate_id)\
+                .filter(criterion)\
+                .filter(Study.short_code.in_(short_codes))\
+                .filter(SpecimenType.label.in_(specimen_types))\
+                .order_by(Specimen.id, storage_container.c.id)
+            specimen = None
+            for short_code, uid, label, specimen_id, collection_date, plate_uid, well_position, comments \
+                    in location_query:
+                if specimen is None or specimen.id != specimen_id:
+                    specimen = SpecimenLocations(specimen_id, collection_date, [])
+                    specimen_locations.setdefault((short_code, uid, label), []).append(specimen)
+                if well_position is not None:
+                    specimen.matrix_tubes.append(MatrixTubeLocation(plate_uid, well_position, comments))
+        return specimen_locations
 
     def find_specimens(self, specimen_entries, date_format="%d/%m/%Y"):
-        results = []
-        with self._session_scope() as session:
-            for specimen_entry in specimen_entries:
-                uid = specimen_entry['uid']
-                short_code = specimen_entry['short_code']
-                specimen_type = specimen_entry['specimen_type']
-                collection_date = specimen_entry.get('collection_date')
+        return list(self.iter_find_specimens(specimen_entries, date_format))
+
+    def iter_find_specimens(self, specimen_entries, date_format="%d/%m/%Y", progress=None):
+        """
+        Generator version of find_specimens, entries are looked up a chunk at a time and result rows are yielded
+        in input order as soon as their chunk has been read.
+        :param progress: Optional callable, passed the number of entries processed so far after every chunk.
+        """
+        processed = 0
+        with self._session_scope(read_only=True) as session:
+            for specimen_entry_chunk in chunks(specimen_entries, ENTRY_CHUNK_SIZE):
+                specimen_locations = self._get_specimen_locations(session, specimen_entry_chunk)
+                for specimen_entry in specimen_entry_chunk:
+                    uid = specimen_entry['uid']
+                    short_code = specimen_entry['short_code']
+                    specimen_type = specimen_entry['specimen_type']
+                    collection_date = specimen_entry.get('collection_date')
+                    try:
+                        specimen = self._match_specimen(specimen_locations.get((short_code, uid, specimen_type), []),
+                                                        collection_date)
+                        specimen_matrix_tubes = specimen.matrix_tubes
+                    except NoResultFound:
+                        specimen_matrix_tubes = []
+                    for matrix_tube in specimen_matrix_tubes:
+                        r = {
+                            'UID': uid,
+                            'Study Short Code': short_code,
+                            'Specimen Type': specimen_type,
+                            'Plate UID': matrix_tube.plate_uid,
+                            'Well': matrix_tube.well_position,
+                            'Comments': matrix_tube.comments
+                        }
+                        if collection_date:
+                            r.update({'Date': datetime.datetime.strftime(collection_date, date_format)})
+                        yield r
+                    if not specimen_matrix_tubes:
+                        r = {
+                            'UID': uid,
+                            'Study Short Code': short_code,
+                            'Specimen Type': specimen_type,
+                            'Plate UID': 'Specimen not found',
+                            'Well': '',
+                            'Comments': ''
+                        }
+                        if collection_date:
+                            r.update({'Date': datetime.datetime.strftime(collection_date, date_format)})
+                        yield r
+                processed += len(specimen_entry_chunk)
+                if progress:
+                    progress(processed)
+
+    @classmethod
+    def _match_specimen_entries(cls, session, specimen_entries):
+        # type: (Session, list[dict]) -> list[int]
+        """
+        Unmanaged function to find the specimens matching entries, following the same rules as _get_specimen.
+        :param session: The _session to use for querying the database.
+        :param specimen_entries: list of entries with 'uid', 'short_code', 'specimen_type' and optional
+            'collection_date' keys.
+        :raises MultipleResultsFound: An entry without a collection date matches several specimens.
+        :return: IDs of the matching specimens in the order of the entries, entries without one are skipped.
+        """
+        specimen_ids = []
+        for specimen_entry_chunk in chunks(specimen_entries, ENTRY_CHUNK_SIZE):
+            specimen_locations = cls._get_specimen_locations(session, specimen_entry_chunk)
+            for entry in specimen_entry_chunk:
                 try:
-                    specimen = self._get_specimen(session, uid, short_code, specimen_type, collection_date)
-                    specimen_matrix_tubes = [_ for _ in specimen.storage_containers if _.discriminator == 'matrix_tube']
+                    specimen_ids.append(cls._match_specimen(
+                        specimen_locations.get((entry['short_code'], entry['uid'], entry['specimen_type']), []),
+                        entry.get('collection_date')).id)
                 except NoResultFound:
-                    specimen_matrix_tubes = []
-                for matrix_tube in specimen_matrix_tubes:
-                    r = {
-                        'UID': uid,
-                        'Study Short Code': short_code,
-                        'Specimen Type': specimen_type,
-                        'Plate UID': matrix_tube.plate.uid,
-                        'Well': matrix_tube.well_position,
-                        'Comments': matrix_tube.comments
-                    }
-                    if collection_date:
-                        r.update({'Date': datetime.datetime.strftime(collection_date, date_format)})
-                    results.append(r)
-                if not specimen_matrix_tubes:
-                    r = {
-                        'UID': uid,
-                        'Study Short Code': short_code,
-                        'Specimen Type': specimen_type,
-                        'Plate UID': 'Specimen not found',
-                        'Well': '',
-                        'Comments': ''
-                    }
-                    if collection_date:
-                        r.update({'Date': datetime.datetime.strftime(collection_date, date_format)})
-                    results.append(r)
-        return results
+                    continue
+        return specimen_ids
 
     def get_matrix_tubes_from_specimens(self, specimen_entries):
-        results = []
+        # type: (list[dict]) -> list[MatrixTube]
+        """
+        Get the matrix tubes of the specimens matching entries, in the order of the entries. Entries without a
+        matching specimen are skipped.
+        :param specimen_entries: list of entries with 'uid', 'short_code', 'specimen_type' and optional
+            'collection_date' keys.
+        :return: List of MatrixTubes
+        """
         with self._session_scope() as session:
-            for entry in specimen_entries:
-                uid = entry['uid']
-                short_code = entry['short_code']
-                specimen_type = entry['specimen_type']
-                collection_date = entry.get('collection_date')
-                try:
-                    specimen = self._get_specimen(session, uid, short_code, specimen_type, collection_date)
-                    specimen_matrix_tubes = [_ for _ in specimen.storage_containers if _.discriminator == 'matrix_tube']
-                except NoResultFound:
-                    specimen_matrix_tubes = []
-                results += specimen_matrix_tubes
+            specimen_ids = self._match_specimen_entries(session, specimen_entries)
+            matrix_tubes = []
+            for criterion in in_criteria(session, MatrixTube.specimen_id, specimen_ids):
+                matrix_tubes += session.query(MatrixTube).filter(criterion).order_by(MatrixTube.id).all()
+            results = in_input_order(specimen_ids, matrix_tubes, lambda _: _.specimen_id)
         return results
 
     @staticmethod
@@ -590,6 +1733,22 @@ class SampleDB(object):
         matrix_tube = session.query(MatrixTube).filter(MatrixTube.barcode == matrix_tube_barcode).one()
         return matrix_tube
 
+    @staticmethod
+    def _get_matrix_tubes_by_barcode(session, matrix_tube_barcodes, *options):
+        # type: (Session, list[str], *MapperOption) -> dict[str, MatrixTube]
+        """
+        Unmanaged function to get matrix tubes from a collection of barcodes, using one query per chunk of barcodes.
+        :param session: The _session to use for querying the database.
+        :param matrix_tube_barcodes: Barcodes identifying matrix tubes, may contain duplicates.
+        :param options: Query options, e.g. relationships to eager load.
+        :return: Map of barcode to MatrixTube, barcodes that do not exist are left out.
+        """
+        matrix_tubes = {}
+        for criterion in in_criteria(session, MatrixTube.barcode, matrix_tube_barcodes):
+            for matrix_tube in session.query(MatrixTube).options(*options).filter(criterion):
+                matrix_tubes[matrix_tube.barcode] = matrix_tube
+        return matrix_tubes
+
     def get_matrix_tube(self, matrix_tube_barcode):
         # type: (str) -> MatrixTube
         """
@@ -597,7 +1756,7 @@ class SampleDB(object):
         :param matrix_tube_barcode: Unique barcode identifying a matrix tube.
         :return: The corresponding MatrixTube
         """
-        with self._session_scope() as session:
+        with self._session_scope(read_only=True) as session:
             matrix_tube = self._get_matrix_tube(session, matrix_tube_barcode)
         return matrix_tube
 
@@ -609,78 +1768,294 @@ class SampleDB(object):
         :return: List of MatrixTubes
         """
         with self._session_scope() as session:
-            matrix_tubes = [self._get_matrix_tube(session, _) for _ in matrix_tube_barcodes]
+            matrix_tubes = self._get_matrix_tubes_by_barcode(session, matrix_tube_barcodes,
+                                                             joinedload(MatrixTube.specimen))
+            missing = [_ for _ in matrix_tube_barcodes if _ not in matrix_tubes]
+            if missing:
+                raise NoResultFound("Matrix tube {} does not exist.".format(missing[0]))
+        return [matrix_tubes[_] for _ in matrix_tube_barcodes]
+
+    @classmethod
+    def _set_matrix_tubes_exhausted(cls, session, matrix_tube_barcodes, exhausted):
+        # type: (Session, list[str], bool) -> dict[str, MatrixTube]
+        """
+        Unmanaged function to set the exhausted flag of matrix tubes with one UPDATE per chunk of barcodes.
+        :param session: The _session to use for querying the database.
+        :param matrix_tube_barcodes: Unique barcodes identifying matrix tubes.
+        :param exhausted: New value of the exhausted flag.
+        :return: Map of barcode to the updated MatrixTube
+        """
+        storage_container = StorageContainer.__table__
+        matrix_tube = MatrixTube.__table__
+        matrix_tube_barcodes = list(set(matrix_tube_barcodes))
+        for criterion in in_criteria(session, matrix_tube.c.barcode, matrix_tube_barcodes):
+            matrix_tube_ids = select([matrix_tube.c.id]).where(criterion)
+            session.execute(storage_container.update().where(storage_container.c.id.in_(matrix_tube_ids))
+                            .values(exhausted=exhausted))
+        matrix_tubes = {}
+        for criterion in in_criteria(session, MatrixTube.barcode, matrix_tube_barcodes):
+            for tube in session.query(MatrixTube).populate_existing().filter(criterion):
+                matrix_tubes[tube.barcode] = tube
+        missing_barcodes = [_ for _ in matrix_tube_barcodes if _ not in matrix_tubes]
+        if missing_barcodes:
+            raise NoResultFound('Matrix tubes with barcodes {} do not exist.'.format(
+                ', '.join(sorted(missing_barcodes))))
+        study_ids, plate_ids, location_ids = cls._get_matrix_tube_scopes(session,
+                                                                         [_.id for _ in matrix_tubes.values()])
+        cls._refresh_count_summaries(session, study_ids, plate_ids, location_ids)
         return matrix_tubes
 
     def set_matrix_tubes_exhausted(self, matrix_tube_barcodes):
         """
-        Set a matrix tube as exhausted.
-        :param matrix_tube_barcodes: Unique barcodes identifying a matrix tube.
-        :return: The corresponding MatrixTube that has been set to exhausted.
+        Set matrix tubes as exhausted.
+        :param matrix_tube_barcodes: Unique barcodes identifying matrix tubes.
+        :return: The corresponding MatrixTubes that have been set to exhausted.
         """
         with self._session_scope() as session:
-            for matrix_tube_barcode in matrix_tube_barcodes:
-                matrix_tube = self._get_matrix_tube(session, matrix_tube_barcode)
-                matrix_tube.exhausted = True
-        return matrix_tube
+            matrix_tubes = self._set_matrix_tubes_exhausted(session, matrix_tube_barcodes, True)
+        return [matrix_tubes[_] for _ in matrix_tube_barcodes]
 
     def unset_matrix_tubes_exhausted(self, matrix_tube_barcodes):
         """
-        Unset a matrix tube as exhausted.
-        :param matrix_tube_barcodes: Unique barcodes identifying a matrix tube.
-        :return: The corresponding MatrixTube that has been unset as exhausted.
+        Unset matrix tubes as exhausted.
+        :param matrix_tube_barcodes: Unique barcodes identifying matrix tubes.
+        :return: The corresponding MatrixTubes that have been unset as exhausted.
         """
         with self._session_scope() as session:
-            for matrix_tube_barcode in matrix_tube_barcodes:
-                matrix_tube = self._get_matrix_tube(session, matrix_tube_barcode)
-                matrix_tube.exhausted = False
-        return matrix_tube
+            matrix_tubes = self._set_matrix_tubes_exhausted(session, matrix_tube_barcodes, False)
+        return [matrix_tubes[_] for _ in matrix_tube_barcodes]
 
     def convert_barcoded_entries(self, barcoded_entries, date_format="%d/%m/%Y"):
-        results = []
-        with self._session_scope() as session:
-            for entry in barcoded_entries:
-                barcode = entry.pop('barcode')
-                try:
-                    matrix_tube = self._get_matrix_tube(session, barcode)
-                    entry['Study Subject UID'] = matrix_tube.specimen.study_subject.uid
-                    entry['Specimen Type'] = matrix_tube.specimen.specimen_type.label
-                    entry['Study Short Code'] = matrix_tube.specimen.study_subject.study.short_code
-                    entry['Comments'] = matrix_tube.comments
-                    if matrix_tube.specimen.collection_date:
-                        entry['Date'] = datetime.date.strftime(matrix_tube.specimen.collection_date, date_format)
-                except NoResultFound:
-                    entry['Study Subject UID'] = "Barcode ({}) Not Found".format(barcode)
-                    entry['Specimen Type'] = ""
-                    entry['Study Short Code'] = ""
-                    entry['Comments'] = ""
-                results.append(entry)
-        return results
+        return list(self.iter_convert_barcoded_entries(barcoded_entries, date_format))
+
+    def iter_convert_barcoded_entries(self, barcoded_entries, date_format="%d/%m/%Y", progress=None):
+        """
+        Generator version of convert_barcoded_entries, barcodes are looked up a chunk at a time and converted
+        entries are yielded in input order as soon as their chunk has been read.
+        :param progress: Optional callable, passed the number of entries processed so far after every chunk.
+        """
+        processed = 0
+        with self._session_scope(read_only=True) as session:
+            for entry_chunk in chunks(barcoded_entries, ENTRY_CHUNK_SIZE):
+                barcodes = [_['barcode'] for _ in entry_chunk]
+                matrix_tube_map = self._get_matrix_tubes_by_barcode(
+                    session, barcodes,
+                    joinedload(MatrixTube.specimen).joinedload(Specimen.study_subject).joinedload(StudySubject.study),
+                    joinedload(MatrixTube.specimen).joinedload(Specimen.specimen_type))
+                for entry in entry_chunk:
+                    barcode = entry.pop('barcode')
+                    matrix_tube = matrix_tube_map.get(barcode)
+                    if matrix_tube:
+                        entry['Study Subject UID'] = matrix_tube.specimen.study_subject.uid
+                        entry['Specimen Type'] = matrix_tube.specimen.specimen_type.label
+                        entry['Study Short Code'] = matrix_tube.specimen.study_subject.study.short_code
+                        entry['Comments'] = matrix_tube.comments
+                        if matrix_tube.specimen.collection_date:
+                            entry['Date'] = datetime.date.strftime(matrix_tube.specimen.collection_date, date_format)
+                    else:
+                        entry['Study Subject UID'] = "Barcode ({}) Not Found".format(barcode)
+                        entry['Specimen Type'] = ""
+                        entry['Study Short Code'] = ""
+                        entry['Comments'] = ""
+                    yield entry
+                processed += len(entry_chunk)
+                if progress:
+                    progress(processed)
+
+    @staticmethod
+    def _get_matrix_tube_specimens(session, column, values):
+        # type: (Session, Column, list) -> list[tuple]
+        """
+        Unmanaged function to look up matrix tubes and the specimens they hold, with one query per chunk of values.
+        :param session: The _session to use for querying the database.
+        :param column: Column of the matrix_tube or storage_container table the values are matched against.
+        :param values: Values of the column, e.g. barcodes.
+        :return: list of (value, matrix tube ID, specimen ID)
+        """
+        storage_container = StorageContainer.__table__
+        matrix_tube = MatrixTube.__table__
+        rows = []
+        for criterion in in_criteria(session, column, values):
+            query = select([column.label('value'), matrix_tube.c.id, storage_container.c.specimen_id])\
+                .select_from(matrix_tube.join(storage_container, matrix_tube.c.id == storage_container.c.id))\
+                .where(criterion)
+            rows += session.execute(query).fetchall()
+        return rows
+
+    def _delete_matrix_tubes(self, session, matrix_tubes, specimen_ids=(), delete_orphans=True):
+        # type: (Session, list[tuple[int, int]], list[int], bool) -> (list[int], list[int])
+        """
+        Unmanaged function to delete matrix tubes and specimens, with chunked DELETE statements instead of deleting
+        rows one object at a time. Specimens that keep containers are found with one GROUP BY query per chunk of
+        specimen IDs, before anything is deleted.
+        :param session: The _session to use for querying the database.
+        :param matrix_tubes: (matrix tube ID, specimen ID) of every matrix tube to delete.
+        :param specimen_ids: Specimens that must be deleted as well.
+        :param delete_orphans: Also delete the specimens the matrix tubes leave without storage containers.
+        :raises ValueError: One of specimen_ids keeps storage containers that are not deleted.
+        :return: IDs of the deleted matrix tubes and IDs of the deleted specimens
+        """
+        storage_container = StorageContainer.__table__
+        matrix_tube = MatrixTube.__table__
+        specimen = Specimen.__table__
+        study_subject = StudySubject.__table__
+        matrix_tubes = set(matrix_tubes)
+        matrix_tube_ids = sorted(set([_ for _, __ in matrix_tubes]))
+        deleted_containers = {}
+        for _, specimen_id in matrix_tubes:
+            deleted_containers[specimen_id] = deleted_containers.get(specimen_id, 0) + 1
+        candidate_ids = set(deleted_containers) | set(specimen_ids)
+
+        remaining_containers = {}
+        for criterion in in_criteria(session, storage_container.c.specimen_id, candidate_ids):
+            query = select([storage_container.c.specimen_id, func.count(storage_container.c.id)])\
+                .where(criterion).group_by(storage_container.c.specimen_id)
+            for specimen_id, count in session.execute(query):
+                remaining_containers[specimen_id] = count - deleted_containers.get(specimen_id, 0)
+        kept_ids = sorted([_ for _ in set(specimen_ids) if remaining_containers.get(_)])
+        if kept_ids:
+            raise ValueError("Specimen {} is still stored in containers that are not being deleted.".format(
+                kept_ids[0]))
+        if delete_orphans:
+            deleted_specimen_ids = sorted([_ for _ in candidate_ids if not remaining_containers.get(_)])
+        else:
+            deleted_specimen_ids = sorted(set(specimen_ids))
+
+        study_ids, plate_ids, location_ids = self._get_matrix_tube_scopes(session, matrix_tube_ids)
+        for criterion in in_criteria(session, specimen.c.id, deleted_specimen_ids):
+            study_ids.update([_ for _, in session.execute(
+                select([study_subject.c.study_id]).select_from(
+                    specimen.join(study_subject, specimen.c.study_subject_id == study_subject.c.id))
+                .where(criterion).distinct())])
+        self._add_tombstones(session, 'matrix_tube', matrix_tube_ids)
+        self._add_tombstones(session, 'specimen', deleted_specimen_ids)
+
+        # Child rows first, foreign keys are enforced.
+        for criterion in in_criteria(session, matrix_tube.c.id, matrix_tube_ids):
+            session.execute(matrix_tube.delete().where(criterion))
+        for criterion in in_criteria(session, storage_container.c.id, matrix_tube_ids):
+            session.execute(storage_container.delete().where(criterion))
+        for criterion in in_criteria(session, specimen.c.id, deleted_specimen_ids):
+            session.execute(specimen.delete().where(criterion))
+        for model, ids in ((StorageContainer, matrix_tube_ids), (Specimen, deleted_specimen_ids)):
+            for row_id in ids:
+                obj = session.identity_map.get(identity_key(model, row_id))
+                if obj is not None:
+                    session.expunge(obj)
+
+        self._refresh_count_summaries(session, study_ids, plate_ids, location_ids)
+        return matrix_tube_ids, deleted_specimen_ids
 
     def delete_matrix_tubes_and_specimens(self, matrix_tubes, specimens):
+        """
+        Delete matrix tubes and specimens, a specimen may only be deleted along with every container it is stored in.
+        Specimens that are not passed are kept, even if the deleted matrix tubes leave them without a container.
+        :raises ValueError: One of the specimens is stored in a container that is not deleted, nothing is deleted.
+        :return: IDs of the deleted matrix tubes and IDs of the deleted specimens
+        """
         with self._session_scope() as session:
-            matrix_tube_ids = list(set([_.id for _ in matrix_tubes]))
-            specimen_ids = list(set([_.id for _ in specimens]))
-            with session.no_autoflush:
-                for matrix_tube in matrix_tubes:
-                    session.delete(matrix_tube)
-                for specimen in specimens:
-                    session.delete(specimen)
-        return matrix_tube_ids, specimen_ids
+            rows = self._get_matrix_tube_specimens(session, MatrixTube.__table__.c.id, [_.id for _ in matrix_tubes])
+            return self._delete_matrix_tubes(session, [(tube_id, specimen_id) for _, tube_id, specimen_id in rows],
+                                             [_.id for _ in specimens], delete_orphans=False)
 
     def delete_matrix_tubes(self, matrix_tubes):
+        """
+        Delete matrix tubes, and the specimens that are not stored in any other container.
+        :return: IDs of the deleted matrix tubes and IDs of the deleted specimens
+        """
         with self._session_scope() as session:
-            matrix_tube_ids = list(set([_.id for _ in matrix_tubes]))
-            specimens = []
-            for matrix_tube in matrix_tubes:
-                specimen = matrix_tube.specimen
-                specimen_matrix_tube_ids = [_.id for _ in specimen.storage_containers if _.discriminator == 'matrix_tube']
-                if set(specimen_matrix_tube_ids).issubset(matrix_tube_ids):
-                    specimens.append(specimen)
-            specimen_ids = list(set([_.id for _ in specimens]))
-            with session.no_autoflush:
-                for matrix_tube in matrix_tubes:
-                    session.delete(matrix_tube)
-                for specimen in specimens:
-                    session.delete(specimen)
-        return matrix_tube_ids, specimen_ids
+            rows = self._get_matrix_tube_specimens(session, MatrixTube.__table__.c.id, [_.id for _ in matrix_tubes])
+            return self._delete_matrix_tubes(session, [(tube_id, specimen_id) for _, tube_id, specimen_id in rows])
+
+    def delete_matrix_tubes_by_barcode(self, barcodes, with_specimens=False):
+        # type: (list[str], bool) -> (list[int], list[int])
+        """
+        Delete matrix tubes, and the specimens that are not stored in any other container.
+        :param barcodes: Barcodes of the matrix tubes.
+        :param with_specimens: Delete the specimen of every matrix tube, all of its containers must be deleted.
+        :raises NoResultFound: One of the barcodes does not exist, nothing is deleted.
+        :raises ValueError: with_specimens and a specimen is stored in a container that is not deleted, nothing is
+            deleted.
+        :return: IDs of the deleted matrix tubes and IDs of the deleted specimens
+        """
+        with self._session_scope() as session:
+            rows = self._get_matrix_tube_specimens(session, MatrixTube.__table__.c.barcode, barcodes)
+            found = set([barcode for barcode, _, __ in rows])
+            for barcode in barcodes:
+                if barcode not in found:
+                    raise NoResultFound("Matrix tube {} does not exist.".format(barcode))
+            matrix_tubes = [(tube_id, specimen_id) for _, tube_id, specimen_id in rows]
+            return self._delete_matrix_tubes(
+                session, matrix_tubes, [specimen_id for _, specimen_id in matrix_tubes] if with_specimens else ())
+
+    def delete_specimens(self, specimen_entries):
+        # type: (list[dict]) -> (list[int], list[int])
+        """
+        Delete the specimens matching entries together with all of their matrix tubes. Entries without a matching
+        specimen, or whose specimen is in no matrix tube, are skipped.
+        :param specimen_entries: list of entries with 'uid', 'short_code', 'specimen_type' and optional
+            'collection_date' keys.
+        :raises MultipleResultsFound: An entry without a collection date matches several specimens.
+        :return: IDs of the deleted matrix tubes and IDs of the deleted specimens
+        """
+        with self._session_scope() as session:
+            specimen_ids = self._match_specimen_entries(session, specimen_entries)
+            rows = self._get_matrix_tube_specimens(session, StorageContainer.__table__.c.specimen_id, specimen_ids)
+            matrix_tubes = [(tube_id, specimen_id) for _, tube_id, specimen_id in rows]
+            return self._delete_matrix_tubes(session, matrix_tubes, [specimen_id for _, specimen_id in matrix_tubes])
+
+    def create_job(self, kind, rows_total=None, result_name=None):
+        # type: (str, int, str) -> Job
+        """
+        Register a new background job.
+        :param kind: Short description of the work, e.g. 'plate_upload'.
+        :param rows_total: Optional number of rows the job will process.
+        :param result_name: File name the result is downloaded as.
+        :return: Job
+        """
+        with self._session_scope() as session:
+            job = Job(kind=kind, rows_total=rows_total, result_name=result_name)
+            session.add(job)
+        return job
+
+    def get_job(self, job_id):
+        # type: (int) -> Job
+        with self._session_scope(read_only=True) as session:
+            job = session.query(Job).get(job_id)
+            if not job:
+                raise NoResultFound('Job {} does not exist.'.format(job_id))
+        return job
+
+    def update_job(self, job_id, d):
+        # type: (int, dict) -> Job
+        with self._session_scope() as session:
+            job = session.query(Job).get(job_id)
+            job.update(d)
+        return job
+
+    def fail_unfinished_jobs(self, error):
+        # type: (str) -> int
+        """
+        Mark every queued or running job as failed, e.g. after a restart lost the workers running them.
+        :param error: Reason recorded on the jobs.
+        :return: Number of jobs marked as failed.
+        """
+        job = Job.__table__
+        with self._session_scope() as session:
+            result = session.execute(job.update().where(job.c.status.in_(['queued', 'running']))
+                                     .values(status='failed', error=error))
+        return result.rowcount
+
+    def delete_finished_jobs(self, before):
+        # type: (datetime.datetime) -> list[str]
+        """
+        Delete the jobs that finished, done or failed, before a point in time.
+        :param before: Jobs last updated before this UTC time are deleted.
+        :return: Result paths of the deleted jobs, the files are left to the caller.
+        """
+        job = Job.__table__
+        criterion = and_(job.c.status.in_(['done', 'failed']), job.c.last_updated < before)
+        with self._session_scope() as session:
+            result_paths = [_ for _, in session.execute(select([job.c.result_path]).where(criterion)) if _]
+            session.execute(job.delete().where(criterion))
+        return result_paths
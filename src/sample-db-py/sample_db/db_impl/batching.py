@@ -0,0 +1,141 @@
+# sample_db -- A Sample Tracking Database
+# Copyright (C) 2017  Maxwell Murphy, Jordan Wilheim
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Batching of statements over large collections of keys, e.g. the barcodes of an uploaded sheet.
+
+Databases limit the number of bound parameters of a statement, SQLite to 999 before 3.32 and 32766 since, unless
+built with another limit. Keys are split into chunks that fit the limit of the connection, or, on SQLite sessions
+configured with a temp_table_threshold, inserted into a temporary table that the statement selects them from.
+"""
+
+import itertools
+
+from sqlalchemy import Table, Column, Integer, MetaData, select
+from sqlalchemy.event import listen
+from sqlalchemy.types import NullType
+
+# Bound parameters per statement on backends whose limit is unknown.
+DEFAULT_MAX_PARAMETERS = 999
+
+MAX_PARAMETERS = {
+    'postgresql': 32767,
+    'mysql': 65535,
+    'mssql': 2100,
+    'oracle': 1000,
+}
+
+# Largest IN list, even if the backend allows more. Compiling a statement costs time per bound parameter, and
+# statements are logged and counted by their text. See sample_db.benchmarks.batching.
+MAX_CHUNK_SIZE = 5000
+
+# Keys of the batches using the temporary table, one table per connection created when it is opened.
+_batch_key = Table('batch_key', MetaData(), Column('batch_id', Integer, primary_key=True),
+                   Column('value', NullType, primary_key=True))
+
+_CREATE_BATCH_KEY = 'CREATE TEMP TABLE IF NOT EXISTS batch_key (batch_id INTEGER NOT NULL, value NOT NULL, ' \
+                    'PRIMARY KEY (batch_id, value))'
+
+_batch_ids = itertools.count()
+
+
+def _sqlite_max_parameters(dbapi_module, dbapi_connection):
+    for option, in dbapi_connection.execute('PRAGMA compile_options'):
+        if option.startswith('MAX_VARIABLE_NUMBER='):
+            return int(option.split('=', 1)[1])
+    return 32766 if dbapi_module.sqlite_version_info >= (3, 32, 0) else 999
+
+
+def configure_engine(engine, temp_tables=False):
+    """
+    Record the bound parameter limit of every connection the engine opens and, for SQLite, optionally give each
+    one the temporary table of batch keys. Runs when a connection is opened, before any transaction, pysqlite
+    commits the open transaction when it executes a PRAGMA or CREATE statement.
+    :param engine: Engine to configure.
+    :param temp_tables: Create the temporary table, connections must not be query_only.
+    """
+    dialect = engine.dialect
+
+    def on_connect(dbapi_connection, connection_record):
+        if dialect.name == 'sqlite':
+            connection_record.info['max_parameters'] = _sqlite_max_parameters(dialect.dbapi, dbapi_connection)
+            if temp_tables:
+                dbapi_connection.execute(_CREATE_BATCH_KEY)
+                connection_record.info['batch_key'] = True
+        else:
+            connection_record.info['max_parameters'] = MAX_PARAMETERS.get(dialect.name, DEFAULT_MAX_PARAMETERS)
+    listen(engine, 'connect', on_connect)
+
+
+def chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def chunk_size(session, reserved=0):
+    # type: (Session, int) -> int
+    """
+    Number of keys a statement of the session can bind.
+    :param reserved: Bound parameters the statement needs besides the keys.
+    """
+    max_parameters = session.connection().info.get('max_parameters', DEFAULT_MAX_PARAMETERS)
+    return max(1, min(max_parameters - reserved, MAX_CHUNK_SIZE))
+
+
+def batches(session, items, reserved=0):
+    """
+    Split items into chunks small enough to bind in one statement of the session.
+    """
+    return chunks(items, chunk_size(session, reserved))
+
+
+def in_criteria(session, column, keys, reserved=0):
+    """
+    Criteria selecting the rows whose column is one of keys, one statement per criterion, e.g.
+
+        for criterion in in_criteria(session, matrix_tube.c.barcode, barcodes):
+            rows += session.execute(select([matrix_tube]).where(criterion)).fetchall()
+
+    Above the temp_table_threshold in session.info, on connections with the temporary table, the keys are inserted
+    into it and a single criterion selects them from there.
+    :param reserved: Bound parameters the statement needs besides the keys.
+    """
+    keys = set(keys)
+    threshold = session.info.get('temp_table_threshold')
+    if threshold is None or len(keys) < threshold or not session.connection().info.get('batch_key'):
+        for chunk in batches(session, keys, reserved):
+            yield column.in_(chunk)
+        return
+    batch_id = next(_batch_ids)
+    session.execute(_batch_key.insert(), [{'batch_id': batch_id, 'value': _} for _ in keys])
+    yield column.in_(select([_batch_key.c.value]).where(_batch_key.c.batch_id == batch_id))
+    # Rows of a batch abandoned by an error go with the rollback of its transaction.
+    session.execute(_batch_key.delete().where(_batch_key.c.batch_id == batch_id))
+
+
+def in_input_order(keys, items, key):
+    """
+    Put results of batched statements, which come back chunk by chunk, in the order of the keys they were
+    looked up by. Items of a key listed more than once are repeated, as a lookup per key would have returned them.
+    :param keys: Keys in input order.
+    :param items: Results.
+    :param key: Function returning the key of a result.
+    """
+    by_key = {}
+    for item in items:
+        by_key.setdefault(key(item), []).append(item)
+    return [item for _ in keys for item in by_key.get(_, [])]
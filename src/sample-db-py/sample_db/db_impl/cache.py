@@ -0,0 +1,72 @@
+# sample_db -- A Sample Tracking Database
+# Copyright (C) 2017  Maxwell Murphy, Jordan Wilheim
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+
+class ReferenceCache(object):
+    """
+    Process wide cache of small reference tables, e.g. studies, specimen types and locations. Each kind is cached as
+    the complete list of its rows, as detached instances, until a write invalidates it. Kinds with more than
+    max_entries rows are not cached, callers fall back to querying the database.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._oversized = set()
+        self._generations = {}
+
+    def get(self, kind, load, size=len):
+        """
+        Get all cached rows of a kind, loading them on a miss.
+        :param kind: Name of the cached table.
+        :param load: Callable returning the complete list of detached instances of the kind.
+        :param size: Callable returning the number of entries loaded instances count as against max_entries.
+        :return: List of instances, or None if the kind has too many rows to be cached.
+        """
+        with self._lock:
+            if kind in self._oversized:
+                return None
+            entries = self._entries.get(kind)
+            generation = self._generations.get(kind, 0)
+        if entries is not None:
+            return entries
+
+        entries = load()
+        oversized = size(entries) > self.max_entries
+        with self._lock:
+            # A write that happened while loading may not be reflected in what was loaded, so it is only kept if the
+            # kind was not invalidated in the meantime.
+            if self._generations.get(kind, 0) == generation:
+                if oversized:
+                    self._oversized.add(kind)
+                else:
+                    self._entries[kind] = entries
+        if oversized:
+            return None
+        return entries
+
+    def invalidate(self, *kinds):
+        """
+        Drop the cached rows of the kinds, the next get reloads them.
+        """
+        with self._lock:
+            for kind in kinds:
+                self._entries.pop(kind, None)
+                self._oversized.discard(kind)
+                self._generations[kind] = self._generations.get(kind, 0) + 1
@@ -0,0 +1,152 @@
+# sample_db -- A Sample Tracking Database
+# Copyright (C) 2017  Maxwell Murphy, Jordan Wilheim
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import time
+import thread
+from collections import Counter
+from contextlib import contextmanager
+
+from sqlalchemy.event import listen
+
+
+def _one_line(statement):
+    return re.sub(r'\s+', ' ', statement).strip()
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryStats(object):
+    """
+    SQL statements executed while recording, counted by their text so statements issued once per row, e.g. by lazy
+    loading relationships, stand out as the most repeated one.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements[statement] += 1
+
+    @property
+    def most_repeated(self):
+        """
+        :return: Tuple of the most often executed statement, on a single line, and how often it was executed, or
+            None if nothing was executed.
+        """
+        if not self.statements:
+            return None
+        statement, times = self.statements.most_common(1)[0]
+        return _one_line(statement), times
+
+    @property
+    def most_repeated_select(self):
+        """
+        Like most_repeated, but only SELECT statements count. Rows added through the ORM are inserted one at a time,
+        which repeats INSERTs without a lookup per row to batch.
+        """
+        for statement, times in self.statements.most_common():
+            if statement.lstrip().upper().startswith('SELECT'):
+                return _one_line(statement), times
+        return None
+
+    def __repr__(self):
+        most_repeated = self.most_repeated
+        if not most_repeated:
+            return '0 statements'
+        return '{} statements in {:.1f} ms, {} times: {}'.format(self.count, self.duration * 1000,
+                                                                 most_repeated[1], most_repeated[0])
+
+
+class QueryRecorder(object):
+    """
+    Records the statements executed on a set of engines into the QueryStats of the recordings active in the scope
+    that executed them. Statements of other scopes, e.g. other requests or background jobs, are not part of a
+    recording.
+    """
+
+    def __init__(self, engines, scopefunc=None):
+        """
+        :param engines: Engines whose statements are recorded.
+        :param scopefunc: Optional function identifying the current scope, the scopefunc of the sessions, e.g. one
+            returning the current greenlet when requests are served by gevent. Scopes are threads by default.
+        """
+        self._scopefunc = scopefunc or thread.get_ident
+        self._active_by_scope = {}
+        for engine in set(engines):
+            listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _active(self):
+        return self._active_by_scope.get(self._scopefunc())
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self._active():
+            conn.info.setdefault('query_start_time', []).append(time.time())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        active = self._active()
+        if active and conn.info.get('query_start_time'):
+            duration = time.time() - conn.info['query_start_time'].pop()
+            for stats in active:
+                stats.record(statement, duration)
+
+    def start(self):
+        """
+        Start recording in the current scope, recordings may be nested.
+        :return: QueryStats that is filled until stop is called with it.
+        """
+        stats = QueryStats()
+        self._active_by_scope.setdefault(self._scopefunc(), []).append(stats)
+        return stats
+
+    def stop(self, stats):
+        scope = self._scopefunc()
+        active = self._active_by_scope.get(scope)
+        if active and stats in active:
+            active.remove(stats)
+        # Scopes, e.g. greenlets, are not kept alive once their last recording stops.
+        if not active:
+            self._active_by_scope.pop(scope, None)
+
+    @contextmanager
+    def recording(self):
+        stats = self.start()
+        try:
+            yield stats
+        finally:
+            self.stop(stats)
+
+    @contextmanager
+    def budget(self, max_statements):
+        """
+        Test helper failing when the block executes more than max_statements statements, e.g.
+
+            with db.query_recorder.budget(2):
+                db.find_specimens(entries)
+
+        :raises QueryBudgetExceeded: An AssertionError naming the most repeated statement.
+        """
+        with self.recording() as stats:
+            yield stats
+        if stats.count > max_statements:
+            raise QueryBudgetExceeded('Query budget of {} exceeded: {!r}'.format(max_statements, stats))
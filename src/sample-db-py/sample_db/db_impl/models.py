@@ -16,10 +16,10 @@
 
 from datetime import datetime
 
-from sqlalchemy import Column, DateTime, Date, String, Integer, ForeignKey, Boolean, event
+from sqlalchemy import Column, DateTime, Date, String, Integer, ForeignKey, Boolean, event, and_, exists
 
 from sqlalchemy.schema import UniqueConstraint
-from sqlalchemy.orm import relationship, validates
+from sqlalchemy.orm import relationship, validates, object_session
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 # from sample_db import conf
 import logging
@@ -28,7 +28,8 @@ import logging
 class Base(object):
     id = Column(Integer, primary_key=True, autoincrement=True, nullable=False)
     created = Column(DateTime, default=datetime.utcnow, nullable=False)
-    last_updated = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+    # Indexed for the change feeds, which look up rows updated after a given time.
+    last_updated = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True, nullable=False)
     read_only_fields = {'id', 'created', 'last_updated'}
 
     def __repr__(self):
@@ -93,13 +94,28 @@ class Study(Base):
 
     @validates("is_longitudinal")
     def validate_is_longitudinal(self, key, is_longitudinal):
-        if not self.is_longitudinal and is_longitudinal:
-            for subject in self.subjects:
-                for specimen in subject.specimens:
-                    if not specimen.collection_date:
-                        raise ValueError("Cannot make study longitudinal, contains specimens without collection dates.")
+        if not self.is_longitudinal and is_longitudinal and self.has_undated_specimens():
+            raise ValueError("Cannot make study longitudinal, contains specimens without collection dates.")
         return is_longitudinal
 
+    def has_undated_specimens(self):
+        """
+        Whether any specimen of the study lacks a collection date. Stored specimens are checked with a single EXISTS
+        query instead of loading the study's subjects and specimens.
+        """
+        session = object_session(self)
+        if self.id is None or session is None:
+            # Not stored yet, all of its subjects are in memory.
+            return any([not specimen.collection_date for subject in self.subjects for specimen in subject.specimens])
+        with session.no_autoflush:
+            for obj in session.new:
+                if isinstance(obj, Specimen) and not obj.collection_date and obj.study_subject is not None and \
+                        obj.study_subject.study is self:
+                    return True
+            return session.query(exists().where(and_(StudySubject.study_id == self.id,
+                                                     Specimen.study_subject_id == StudySubject.id,
+                                                     Specimen.collection_date.is_(None)))).scalar()
+
 
 class StudySubject(Base):
     __tablename__ = 'study_subject'
@@ -149,6 +165,8 @@ class Specimen(Base):
     @validates('collection_date')
     def validate_collection_date(self, key, collection_date):
         if not collection_date:
+            # study is a many to one lookup by primary key, answered from the identity map once an import has loaded
+            # the study, rather than a query per specimen.
             if self.study_subject.study.is_longitudinal:
                 raise ValueError("Not allowed to add specimens without a collection date to a longitudinal study.")
         return collection_date
@@ -231,3 +249,61 @@ class MatrixTube(StorageContainer):
         if well_position not in self.well_list:
             raise ValueError("{} is not a valid well position.".format(well_position))
         return well_position
+
+
+class CountSummary(Base):
+    """
+    Precomputed subject, specimen and tube counts of a study, plate or location, kept in step by the write paths
+    of SampleDB.
+    """
+    __tablename__ = 'count_summary'
+    __table_args__ = (UniqueConstraint('scope', 'scope_id', name='count_summary_scope_uc'),)
+    scopes = ('study', 'plate', 'location')
+
+    scope = Column(String, nullable=False)
+    scope_id = Column(Integer, nullable=False)
+    subject_count = Column(Integer, nullable=False, default=0)
+    specimen_count = Column(Integer, nullable=False, default=0)
+    plate_count = Column(Integer, nullable=False, default=0)
+    tube_count = Column(Integer, nullable=False, default=0)
+    exhausted_tube_count = Column(Integer, nullable=False, default=0)
+
+    def __str__(self):
+        return "<{}: {} {}>".format(self.__class__.__name__, self.scope, self.scope_id)
+
+
+class Job(Base):
+    """
+    Long running import or search handed off to a background worker, along with its progress and where its result
+    was written.
+    """
+    __tablename__ = 'job'
+    statuses = ('queued', 'running', 'done', 'failed')
+
+    kind = Column(String, nullable=False)
+    status = Column(String, nullable=False, default='queued')
+    rows_total = Column(Integer)
+    rows_processed = Column(Integer, nullable=False, default=0)
+    result_name = Column(String)
+    result_path = Column(String)
+    error = Column(String)
+
+    def __str__(self):
+        return "<{}: {} {}>".format(self.__class__.__name__, self.kind, self.status)
+
+
+class Tombstone(Base):
+    """
+    Record of a row that left a study or plate, so clients syncing the changes of either can drop their copy. Rows
+    leave when they are deleted, matrix tubes also leave a plate when they are moved off it. A row belonging to
+    several plates gets a tombstone for each of them.
+    """
+    __tablename__ = 'tombstone'
+
+    table_name = Column(String, nullable=False)
+    row_id = Column(Integer, nullable=False)
+    study_id = Column(Integer, index=True)
+    plate_id = Column(Integer, index=True)
+
+    def __str__(self):
+        return "<{}: {} {}>".format(self.__class__.__name__, self.table_name, self.row_id)
@@ -0,0 +1,86 @@
+# sample_db -- A Sample Tracking Database
+# Copyright (C) 2017  Maxwell Murphy, Jordan Wilheim
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Wells of a 96 well plate in row major order, the index of a well is its bit in a plate's occupancy bitmap.
+WELLS = [row + column for row in 'ABCDEFGH' for column in ['{:02d}'.format(_) for _ in range(1, 13)]]
+WELL_BITS = dict([(well, 1 << i) for i, well in enumerate(WELLS)])
+
+
+class WellConflictError(ValueError):
+    def __init__(self, conflicts, hint=None):
+        """
+        :param conflicts: List of (plate UID, well position) that more than one tube would occupy, a well several
+            tubes would be placed in is listed once.
+        :param hint: Optional sentence appended to the message.
+        """
+        conflicts = sorted(set(conflicts))
+        message = "Tube Position Conflict at {}.".format(', '.join(["{} {}".format(*_) for _ in conflicts]))
+        if hint:
+            message = "{} {}".format(message, hint)
+        ValueError.__init__(self, message)
+        self.message = message
+        self.conflicts = conflicts
+
+
+class PlateOccupancy(object):
+    """
+    Occupied wells of a collection of matrix plates, one 96 bit bitmap per plate. Tubes are tracked by ID so the
+    wells of tubes that are about to move can be released before their new positions are claimed.
+    """
+
+    def __init__(self):
+        self._bitmaps = {}
+        self._matrix_tubes = {}
+
+    def add(self, plate_id, well_position, matrix_tube_id=None):
+        """
+        Mark a well as occupied. Wells outside the 96 well layout, e.g. the temporary '-' positions, are ignored.
+        """
+        bit = WELL_BITS.get(well_position)
+        if bit is None:
+            return
+        self._bitmaps[plate_id] = self._bitmaps.get(plate_id, 0) | bit
+        if matrix_tube_id is not None:
+            self._matrix_tubes[matrix_tube_id] = (plate_id, bit)
+
+    def release(self, matrix_tube_id):
+        """
+        Free the well held by a matrix tube, tubes that are not tracked are ignored.
+        """
+        plate_id, bit = self._matrix_tubes.pop(matrix_tube_id, (None, 0))
+        if bit:
+            self._bitmaps[plate_id] &= ~bit
+
+    def is_occupied(self, plate_id, well_position):
+        return bool(self._bitmaps.get(plate_id, 0) & WELL_BITS.get(well_position, 0))
+
+    def occupied_wells(self, plate_id):
+        bitmap = self._bitmaps.get(plate_id, 0)
+        return [_ for _ in WELLS if bitmap & WELL_BITS[_]]
+
+    def place(self, placements):
+        """
+        Claim wells in order, every placement that lands on a well that is already occupied, either beforehand or by
+        an earlier placement of the same batch, is reported.
+        :param placements: Iterable of (plate ID, well position, matrix tube ID or None)
+        :return: List of the conflicting placements
+        """
+        conflicts = []
+        for plate_id, well_position, matrix_tube_id in placements:
+            if self.is_occupied(plate_id, well_position):
+                conflicts.append((plate_id, well_position, matrix_tube_id))
+            self.add(plate_id, well_position, matrix_tube_id)
+        return conflicts
@@ -0,0 +1,152 @@
+# sample_db -- A Sample Tracking Database
+# Copyright (C) 2017  Maxwell Murphy, Jordan Wilheim
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from sqlalchemy import and_, select
+
+from models import Study, StudySubject, Specimen, StorageContainer, MatrixTube, MatrixPlate
+
+study = Study.__table__
+study_subject = StudySubject.__table__
+specimen = Specimen.__table__
+storage_container = StorageContainer.__table__
+matrix_tube = MatrixTube.__table__
+matrix_plate = MatrixPlate.__table__
+
+
+def _isoformat(d):
+    # Same as marshmallow's DateTime field, which treats naive datetimes as UTC.
+    return d.isoformat() + '+00:00' if d is not None else None
+
+
+def _date_isoformat(d):
+    return d.isoformat() if d is not None else None
+
+
+def _string(value):
+    return str(value) if value is not None else None
+
+
+class Projection(object):
+    """
+    The columns of a table a response needs, selected as plain tuples through Core and encoded straight into the
+    entries the table's ModelSchema would dump, without loading ORM instances. One to many relationships are dumped
+    as lists of related IDs, like ModelSchema does.
+    """
+
+    def __init__(self, from_obj, columns, children=()):
+        """
+        :param from_obj: Table, or join of tables, the columns are selected from.
+        :param columns: List of (key, column, encoder or None) in the order of the entry. The 'id' column orders rows.
+        :param children: List of (key, child ID column, child foreign key column) of one to many relationships.
+        """
+        self.from_obj = from_obj
+        self.keys = [key for key, _, _ in columns]
+        self.columns = [column for _, column, _ in columns]
+        self.encoders = [(i, encoder) for i, (_, _, encoder) in enumerate(columns) if encoder]
+        self.id_column = self.columns[self.keys.index('id')]
+        self.children = children
+
+    def dump(self, session, criteria=(), joins=(), limit=None, distinct=False):
+        """
+        Select and encode the rows matching criteria, ordered by ID.
+        :param session: The _session to use for querying the database.
+        :param criteria: List of where clauses.
+        :param joins: List of (table, on clause) to join, for criteria on other tables.
+        :param limit: Optional maximum number of rows.
+        :param distinct: Remove duplicate rows, for joins to the many side of a relationship.
+        :return: List of entries
+        """
+        from_obj = self.from_obj
+        for table, on in joins:
+            from_obj = from_obj.join(table, on)
+        query = select(self.columns).select_from(from_obj).order_by(self.id_column)
+        if criteria:
+            query = query.where(and_(*criteria))
+        if distinct:
+            query = query.distinct()
+        if limit:
+            query = query.limit(limit)
+
+        entries = []
+        for row in session.execute(query):
+            row = list(row)
+            for i, encoder in self.encoders:
+                row[i] = encoder(row[i])
+            entries.append(dict(zip(self.keys, row)))
+
+        if entries and self.children:
+            # Not correlated, the child table may also be joined into the query.
+            ids = query.with_only_columns([self.id_column]).correlate(None)
+            entry_map = dict([(int(_['id']), _) for _ in entries])
+            for key, child_id, parent_id in self.children:
+                for entry in entries:
+                    entry[key] = []
+                for child, parent in session.execute(select([child_id, parent_id]).where(parent_id.in_(ids))
+                                                     .order_by(child_id)):
+                    entry_map[parent][key].append(child)
+        return entries
+
+
+STUDY = Projection(study, [
+    ('id', study.c.id, _string),
+    ('created', study.c.created, _isoformat),
+    ('last_updated', study.c.last_updated, _isoformat),
+    ('title', study.c.title, None),
+    ('description', study.c.description, None),
+    ('short_code', study.c.short_code, None),
+    ('is_longitudinal', study.c.is_longitudinal, None),
+    ('lead_person', study.c.lead_person, None),
+    ('hidden', study.c.hidden, None),
+], children=[('subjects', study_subject.c.id, study_subject.c.study_id)])
+
+STUDY_SUBJECT = Projection(study_subject, [
+    ('id', study_subject.c.id, _string),
+    ('created', study_subject.c.created, _isoformat),
+    ('last_updated', study_subject.c.last_updated, _isoformat),
+    ('uid', study_subject.c.uid, None),
+    ('study', study_subject.c.study_id, _string),
+], children=[('specimens', specimen.c.id, specimen.c.study_subject_id)])
+
+SPECIMEN = Projection(specimen, [
+    ('id', specimen.c.id, _string),
+    ('created', specimen.c.created, _isoformat),
+    ('last_updated', specimen.c.last_updated, _isoformat),
+    ('collection_date', specimen.c.collection_date, _date_isoformat),
+    ('study_subject', specimen.c.study_subject_id, None),
+    ('specimen_type', specimen.c.specimen_type_id, None),
+], children=[('storage_containers', storage_container.c.id, storage_container.c.specimen_id)])
+
+MATRIX_TUBE = Projection(storage_container.join(matrix_tube, matrix_tube.c.id == storage_container.c.id), [
+    ('id', matrix_tube.c.id, _string),
+    ('created', storage_container.c.created, _isoformat),
+    ('last_updated', storage_container.c.last_updated, _isoformat),
+    ('discriminator', storage_container.c.type, None),
+    ('comments', storage_container.c.comments, None),
+    ('exhausted', storage_container.c.exhausted, None),
+    ('specimen', storage_container.c.specimen_id, _string),
+    ('plate', matrix_tube.c.plate_id, _string),
+    ('barcode', matrix_tube.c.barcode, None),
+    ('well_position', matrix_tube.c.well_position, None),
+])
+
+MATRIX_PLATE = Projection(matrix_plate, [
+    ('id', matrix_plate.c.id, _string),
+    ('created', matrix_plate.c.created, _isoformat),
+    ('last_updated', matrix_plate.c.last_updated, _isoformat),
+    ('uid', matrix_plate.c.uid, None),
+    ('hidden', matrix_plate.c.hidden, None),
+    ('location', matrix_plate.c.location_id, _string),
+], children=[('tubes', matrix_tube.c.id, matrix_tube.c.plate_id)])
@@ -0,0 +1,197 @@
+# sample_db -- A Sample Tracking Database
+# Copyright (C) 2017  Maxwell Murphy, Jordan Wilheim
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Log of statements that took longer than a threshold, one JSON object per line, and a report grouping them by shape.
+
+    python -m sample_db.db_impl.slow_queries slow_queries.log slow_queries.log.1
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+
+from sqlalchemy.event import listen
+
+logger = logging.getLogger('sample_db.slow_queries')
+logger.addHandler(logging.NullHandler())
+
+# Parameters logged per statement, IN clauses of a chunk of barcodes have hundreds.
+MAX_LOGGED_PARAMETERS = 20
+
+_APP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app')
+
+
+def _caller():
+    """
+    Name of the outermost SampleDB method on the stack, the one the application called.
+    """
+    caller = None
+    frame = sys._getframe(1)
+    while frame:
+        if os.path.splitext(os.path.abspath(frame.f_code.co_filename))[0] == _APP_FILE:
+            caller = frame.f_code.co_name
+        frame = frame.f_back
+    return caller
+
+
+def _parameters(parameters):
+    if isinstance(parameters, dict):
+        parameters = [parameters[_] for _ in sorted(parameters)]
+    parameters = list(parameters or ())
+    return [_ if isinstance(_, (int, long, float, basestring)) or _ is None else str(_)
+            for _ in parameters[:MAX_LOGGED_PARAMETERS]]
+
+
+class SlowQueryLog(object):
+    """
+    Logs every statement executed on a set of engines that takes at least threshold seconds to
+    'sample_db.slow_queries', with its parameters, the SampleDB method that issued it and, on SQLite, its EXPLAIN
+    QUERY PLAN. Durations cover executing a statement, not fetching the rows of a SELECT after the first one.
+
+    Entries are written when their connection is returned to the pool, after its transaction was committed or rolled
+    back. pysqlite commits the open transaction before executing an EXPLAIN, so explaining a statement while its
+    transaction is still open would commit the writes before it, which a rollback could then no longer undo.
+    """
+
+    def __init__(self, threshold, *engines):
+        """
+        :param threshold: Seconds a statement must take to be logged.
+        :param engines: Engines to watch.
+        """
+        self.threshold = threshold
+        for engine in set(engines):
+            listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+            listen(engine, 'checkin', self._checkin)
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('slow_query_start_time', []).append(time.time())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        duration = time.time() - conn.info['slow_query_start_time'].pop()
+        if duration < self.threshold:
+            return
+        entry = {
+            'time': datetime.datetime.utcnow().isoformat(),
+            'duration': duration,
+            'caller': _caller(),
+            'statement': statement,
+            'parameters': _parameters(parameters[0] if executemany and parameters else parameters),
+            'executemany': executemany,
+            'plan': None
+        }
+        explain = conn.dialect.name == 'sqlite' and statement.lstrip().upper().startswith('SELECT') and \
+            not executemany
+        conn.info.setdefault('slow_queries', []).append((entry, parameters if explain else None))
+
+    @staticmethod
+    def _checkin(dbapi_connection, connection_record):
+        entries = connection_record.info.pop('slow_queries', [])
+        for entry, parameters in entries:
+            if parameters is not None and dbapi_connection is not None:
+                plan_cursor = dbapi_connection.cursor()
+                try:
+                    entry['plan'] = [row[-1] for row in plan_cursor.execute('EXPLAIN QUERY PLAN ' + entry['statement'],
+                                                                             parameters)]
+                except Exception as e:
+                    entry['plan'] = ['Query plan not available: {}'.format(e)]
+                finally:
+                    plan_cursor.close()
+            logger.warning(json.dumps(entry))
+
+
+def statement_shape(statement):
+    """
+    Statement with literals and lists of placeholders collapsed, so statements differing only in how many values an
+    IN clause lists group together.
+    """
+    shape = re.sub(r'\s+', ' ', statement).strip()
+    shape = re.sub(r"'(?:[^']|'')*'", '?', shape)
+    shape = re.sub(r'\b\d+\b', '?', shape)
+    shape = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?)', shape)
+    return shape
+
+
+def full_scans(plan):
+    """
+    Steps of a query plan that read a whole table rather than searching an index.
+    """
+    return [_ for _ in plan or () if re.match(r'^SCAN (TABLE )?\w+$', _.strip())]
+
+
+def read_entries(paths):
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    yield json.loads(line[line.index('{'):])
+                except ValueError:
+                    continue
+
+
+def report(entries):
+    """
+    Group slow statements by shape, slowest total time first.
+    :return: List of dicts with the shape, count, total, max and mean duration, callers, plan of the slowest one
+        and its full table scans.
+    """
+    groups = {}
+    for entry in entries:
+        shape = statement_shape(entry['statement'])
+        group = groups.setdefault(shape, {'shape': shape, 'count': 0, 'total': 0.0, 'max': 0.0, 'callers': set(),
+                                          'plan': None})
+        group['count'] += 1
+        group['total'] += entry['duration']
+        if entry.get('caller'):
+            group['callers'].add(entry['caller'])
+        if entry['duration'] >= group['max']:
+            group['max'] = entry['duration']
+            group['plan'] = entry.get('plan')
+    groups = sorted(groups.values(), key=lambda _: _['total'], reverse=True)
+    for group in groups:
+        group['mean'] = group['total'] / group['count']
+        group['callers'] = sorted(group['callers'])
+        group['full_scans'] = full_scans(group['plan'])
+    return groups
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report of a slow query log, grouped by statement shape.")
+    parser.add_argument('paths', nargs='+', help="Slow query log files, e.g. including rotated ones.")
+    parser.add_argument('--top', type=int, default=20, help="Number of statement shapes to list.")
+    args = parser.parse_args(argv)
+
+    groups = report(read_entries(args.paths))
+    for group in groups[:args.top]:
+        print('{:6d} x  total {:8.3f} s  mean {:7.3f} s  max {:7.3f} s  {}'.format(
+            group['count'], group['total'], group['mean'], group['max'], ', '.join(group['callers']) or '-'))
+        print('    ' + group['shape'][:400])
+        for step in group['plan'] or ():
+            print('    | ' + step + ('    <-- full table scan, missing index?' if step in group['full_scans'] else ''))
+        print('')
+    if not groups:
+        print('No slow statements logged.')
+
+
+if __name__ == '__main__':
+    main()
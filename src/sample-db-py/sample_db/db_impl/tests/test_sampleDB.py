@@ -16,14 +16,25 @@
 
 from __future__ import absolute_import
 
+import os
+import json
+import shutil
+import logging
+import tempfile
 import unittest
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
 
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.event import listen, remove
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm.exc import NoResultFound
 
 from ..models import *
 from ..app import SampleDB
+from ..occupancy import PlateOccupancy, WellConflictError
+from ..cache import ReferenceCache
+from ..instrumentation import QueryBudgetExceeded
+from ..slow_queries import report, statement_shape
+from ..batching import chunks, chunk_size, in_criteria, in_input_order, MAX_CHUNK_SIZE
 
 
 class TestSampleDB(unittest.TestCase):
@@ -122,6 +133,31 @@ class TestSampleDB(unittest.TestCase):
             self.assertRaises(ValueError, self.db._add_specimen, session, study_subject.uid, study.short_code,
                               specimen_type.label)
 
+    def test_make_study_longitudinal(self):
+        study = self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        self.db.register_new_specimen_type('DNA')
+        location = self.db.register_new_location('-80 Freezer')
+        specimen_entries = [
+            {'uid': str(i), 'short_code': 'TEST', 'collection_date': date.today(), 'specimen_type': 'DNA',
+             'barcode': str(i), 'comments': None, 'well_position': 'A{:02d}'.format(i)} for i in range(1, 11)
+        ]
+        self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)
+
+        # Checked with a single query, not by loading the study's subjects and specimens.
+        with self.db._session_scope() as session:
+            study_row = session.query(Study).get(study.id)
+            with self.db.query_recorder.budget(1):
+                study_row.is_longitudinal = True
+        self.assertTrue(self.db.get_study(study.id)[0].is_longitudinal)
+
+        self.db.update_study(study.id, {'is_longitudinal': False})
+        undated_entry = dict(specimen_entries[0], uid='11', collection_date=None, barcode='11')
+        self.db.add_matrix_plate_with_specimens('P2', location.id, [undated_entry], True, True)
+        with self.assertRaises(ValueError) as cm:
+            self.db.update_study(study.id, {'is_longitudinal': True})
+        self.assertEqual(cm.exception.args[0],
+                         "Cannot make study longitudinal, contains specimens without collection dates.")
+
     def test_get_specimens(self):
         study = self.db.create_study('test', 'TEST', True, 'Max', 'No Description')
         study_subject = self.db.add_study_subject('1', study.id)
@@ -199,7 +235,7 @@ class TestSampleDB(unittest.TestCase):
              'well_position': 'A02'},
         ]
 
-        self.assertRaises(IntegrityError, self.db.add_matrix_plate_with_specimens, '1', location.id, specimen_entries, True, True)
+        self.assertRaises(WellConflictError, self.db.add_matrix_plate_with_specimens, '1', location.id, specimen_entries, True, True)
 
     def test_update_matrix_tube_locations(self):
         specimen_type = self.db.register_new_specimen_type('DNA')
@@ -299,7 +335,7 @@ class TestSampleDB(unittest.TestCase):
              'well_position': 'A01'},
         ]
 
-        self.assertRaises(IntegrityError, self.db.update_matrix_tube_locations, update_list)
+        self.assertRaises(ValueError, self.db.update_matrix_tube_locations, update_list)
 
     def test_get_matrix_tube(self):
         specimen_type = self.db.register_new_specimen_type('DNA')
@@ -427,6 +463,869 @@ class TestSampleDB(unittest.TestCase):
             self.db.unset_matrix_tube_exhausted(matrix_tube.barcode)
             self.assertFalse(matrix_tube.exhausted)
 
+    def test_add_matrix_plate_with_specimens_resolves_existing(self):
+        specimen_type = self.db.register_new_specimen_type('DNA')
+        study = self.db.create_study('test', 'TEST', True, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        today = datetime.combine(date.today(), datetime.min.time())
+
+        specimen_entries = [
+            {'uid': str(i // 2),
+             'short_code': study.short_code,
+             'collection_date': today,
+             'specimen_type': specimen_type.label,
+             'barcode': str(i),
+             'comments': None,
+             'well_position': 'A{:02d}'.format(i + 1)} for i in range(6)
+        ]
+        matrix_plate, study_subjects, specimens, matrix_tubes = self.db.add_matrix_plate_with_specimens(
+            '1', location.id, specimen_entries, True, True)
+        self.assertEqual(len(matrix_tubes), 6)
+        self.assertEqual(len(study_subjects), 3)
+        self.assertEqual(len(specimens), 3)
+
+        for entry in specimen_entries:
+            entry['barcode'] += '-aliquot'
+        matrix_plate, study_subjects, specimens, matrix_tubes = self.db.add_matrix_plate_with_specimens(
+            '2', location.id, specimen_entries)
+        self.assertEqual(len(matrix_tubes), 6)
+        self.assertEqual(len(specimens), 3)
+        self.assertEqual(len(self.db.get_study_subjects(study.id)), 3)
+
+    def test_add_matrix_plate_with_specimens_missing(self):
+        specimen_type = self.db.register_new_specimen_type('DNA')
+        study = self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        entry = {'uid': '1',
+                 'short_code': study.short_code,
+                 'collection_date': None,
+                 'specimen_type': specimen_type.label,
+                 'barcode': '1',
+                 'comments': None,
+                 'well_position': 'A01'}
+
+        self.assertRaises(ValueError, self.db.add_matrix_plate_with_specimens, '1', location.id, [entry])
+        self.assertRaises(ValueError, self.db.add_matrix_plate_with_specimens, '1', location.id, [entry], True)
+        self.assertRaises(NoResultFound, self.db.add_matrix_plate_with_specimens, '1', location.id,
+                          [dict(entry, short_code='NOPE')], True, True)
+        self.assertRaises(NoResultFound, self.db.add_matrix_plate_with_specimens, '1', location.id,
+                          [dict(entry, specimen_type='Plasma')], True, True)
+        self.assertEqual(self.db.get_study_subjects(study.id), [])
+
+    def test_find_specimens(self):
+        specimen_type = self.db.register_new_specimen_type('DNA')
+        study = self.db.create_study('test', 'TEST', True, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        today = datetime.combine(date.today(), datetime.min.time())
+        tomorrow = today + timedelta(days=1)
+
+        specimen_entries = [
+            {'uid': '1', 'short_code': 'TEST', 'collection_date': today, 'specimen_type': 'DNA',
+             'barcode': '1', 'comments': 'Tube 1', 'well_position': 'A01'},
+            {'uid': '1', 'short_code': 'TEST', 'collection_date': today, 'specimen_type': 'DNA',
+             'barcode': '2', 'comments': 'Tube 2', 'well_position': 'A02'},
+            {'uid': '1', 'short_code': 'TEST', 'collection_date': tomorrow, 'specimen_type': 'DNA',
+             'barcode': '3', 'comments': None, 'well_position': 'A03'},
+        ]
+        self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)
+
+        search_entries = [
+            {'uid': '2', 'short_code': 'TEST', 'specimen_type': 'DNA', 'collection_date': today},
+            {'uid': '1', 'short_code': 'TEST', 'specimen_type': 'DNA', 'collection_date': today},
+            {'uid': '1', 'short_code': 'TEST', 'specimen_type': 'DNA', 'collection_date': tomorrow},
+        ]
+        results = self.db.find_specimens(search_entries)
+        date_string = today.strftime("%d/%m/%Y")
+        self.assertEqual(results, [
+            {'UID': '2', 'Study Short Code': 'TEST', 'Specimen Type': 'DNA', 'Plate UID': 'Specimen not found',
+             'Well': '', 'Comments': '', 'Date': date_string},
+            {'UID': '1', 'Study Short Code': 'TEST', 'Specimen Type': 'DNA', 'Plate UID': 'P1',
+             'Well': 'A01', 'Comments': 'Tube 1', 'Date': date_string},
+            {'UID': '1', 'Study Short Code': 'TEST', 'Specimen Type': 'DNA', 'Plate UID': 'P1',
+             'Well': 'A02', 'Comments': 'Tube 2', 'Date': date_string},
+            {'UID': '1', 'Study Short Code': 'TEST', 'Specimen Type': 'DNA', 'Plate UID': 'P1',
+             'Well': 'A03', 'Comments': None, 'Date': tomorrow.strftime("%d/%m/%Y")},
+        ])
+
+    def test_convert_barcoded_entries(self):
+        self.db.register_new_specimen_type('DNA')
+        self.db.create_study('test', 'TEST', True, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        today = datetime.combine(date.today(), datetime.min.time())
+        specimen_entries = [
+            {'uid': '1', 'short_code': 'TEST', 'collection_date': today, 'specimen_type': 'DNA',
+             'barcode': '1', 'comments': 'Tube 1', 'well_position': 'A01'},
+        ]
+        self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)
+
+        results = self.db.convert_barcoded_entries([{'barcode': '2', 'Other': 'a'}, {'barcode': '1', 'Other': 'b'}])
+        self.assertEqual(results, [
+            {'Other': 'a', 'Study Subject UID': 'Barcode (2) Not Found', 'Specimen Type': '',
+             'Study Short Code': '', 'Comments': ''},
+            {'Other': 'b', 'Study Subject UID': '1', 'Specimen Type': 'DNA', 'Study Short Code': 'TEST',
+             'Comments': 'Tube 1', 'Date': today.strftime("%d/%m/%Y")},
+        ])
+
+    def test_set_matrix_tubes_exhausted(self):
+        self.db.register_new_specimen_type('DNA')
+        self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        specimen_entries = [
+            {'uid': '1', 'short_code': 'TEST', 'collection_date': None, 'specimen_type': 'DNA',
+             'barcode': str(i), 'comments': None, 'well_position': 'A{:02d}'.format(i)} for i in range(1, 4)
+        ]
+        self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)
+
+        matrix_tubes = self.db.set_matrix_tubes_exhausted(['2', '1'])
+        self.assertEqual([_.barcode for _ in matrix_tubes], ['2', '1'])
+        self.assertTrue(all([_.exhausted for _ in matrix_tubes]))
+        self.assertFalse(self.db.get_matrix_tube('3').exhausted)
+
+        matrix_tubes = self.db.unset_matrix_tubes_exhausted(['1'])
+        self.assertFalse(matrix_tubes[0].exhausted)
+        self.assertTrue(self.db.get_matrix_tube('2').exhausted)
+
+        self.assertRaises(NoResultFound, self.db.set_matrix_tubes_exhausted, ['3', '4'])
+        self.assertFalse(self.db.get_matrix_tube('3').exhausted)
+
+    def test_hide_plates(self):
+        location = self.db.register_new_location('-80 Freezer')
+        plate1 = self.db.add_matrix_plate_with_specimens('P1', location.id, [])[0]
+        plate2 = self.db.add_matrix_plate_with_specimens('P2', location.id, [])[0]
+
+        plates = self.db.hide_plates([plate2.id, plate1.id])
+        self.assertEqual(plates, [plate2, plate1])
+        self.assertTrue(all([_.hidden for _ in self.db.get_matrix_plates()]))
+
+        plates = self.db.unhide_plates([plate1.id])
+        self.assertFalse(plates[0].hidden)
+        self.assertTrue(plate2.hidden)
+
+        self.assertRaises(NoResultFound, self.db.hide_plates, [plate1.id, plate2.id + 1])
+        self.assertFalse(plate1.hidden)
+
+    def test_add_matrix_plate_with_specimens_conflicts(self):
+        self.db.register_new_specimen_type('DNA')
+        self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        specimen_entries = [
+            {'uid': '1', 'short_code': 'TEST', 'collection_date': None, 'specimen_type': 'DNA',
+             'barcode': str(i), 'comments': None, 'well_position': well} for i, well in enumerate(['A01', 'B01', 'A01'])
+        ]
+        with self.assertRaises(WellConflictError) as cm:
+            self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)
+        self.assertEqual(cm.exception.conflicts, [('P1', 'A01')])
+        self.assertEqual(self.db.get_matrix_plates(), [])
+
+        self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries[:2], True, True)
+        specimen_entries = [
+            {'uid': '1', 'short_code': 'TEST', 'collection_date': None, 'specimen_type': 'DNA',
+             'barcode': str(i), 'comments': None, 'well_position': well} for i, well in [(3, 'B01'), (4, 'C01'),
+                                                                                        (5, 'A01'), (6, 'A01')]
+        ]
+        # Both new tubes in A01 conflict with the tube already there, the well is reported once.
+        with self.assertRaises(WellConflictError) as cm:
+            self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)
+        self.assertEqual(cm.exception.conflicts, [('P1', 'A01'), ('P1', 'B01')])
+        self.assertEqual(cm.exception.message, "Tube Position Conflict at P1 A01, P1 B01.")
+        self.assertEqual(len(self.db.get_matrix_plates()[0].tubes), 2)
+
+    def test_add_matrix_plate_with_specimens_dry_run(self):
+        self.db.register_new_specimen_type('DNA')
+        self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        self.db.create_study('longitudinal', 'LONG', True, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        self.db.add_matrix_plate_with_specimens('P1', location.id, [
+            {'uid': '1', 'short_code': 'TEST', 'collection_date': None, 'specimen_type': 'DNA',
+             'barcode': '1', 'comments': None, 'well_position': 'A01'}], True, True)
+
+        def entry(uid, short_code, specimen_type, barcode, well_position):
+            return {'uid': uid, 'short_code': short_code, 'collection_date': None, 'specimen_type': specimen_type,
+                    'barcode': barcode, 'comments': None, 'well_position': well_position}
+
+        specimen_entries = [
+            entry('1', 'TEST', 'DNA', '2', 'A02'),
+            entry('2', 'TEST', 'DNA', '1', 'A01'),
+            entry('2', 'NONE', 'RNA', '3', 'Z01'),
+            entry('2', 'LONG', 'DNA', '2', 'A02'),
+            entry('3', 'TEST', 'DNA', '4', 'A03'),
+        ]
+        report = self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, False,
+                                                         dry_run=True)
+        self.assertEqual(report, [
+            [],
+            ['Matrix tube with barcode 1 already exists.', 'Tube Position Conflict at P1 A01.',
+             'Sample 2 in Study TEST does not exist.'],
+            ['Z01 is not a valid well position.', 'Study NONE does not exist.', 'Specimen type RNA is not registered.'],
+            ['Barcode 2 is also used in entry 1.', 'Tube Position Conflict at P1 A02.',
+             'Sample 2 in Study LONG does not exist.'],
+            ['Sample 3 in Study TEST does not exist.'],
+        ])
+        report = self.db.add_matrix_plate_with_specimens('P2', location.id, specimen_entries[3:], True, True,
+                                                         dry_run=True)
+        self.assertEqual(report, [['Not allowed to add specimens without a collection date to a longitudinal '
+                                   'study.'], []])
+        self.assertEqual(len(self.db.get_matrix_plates()), 1)
+        self.assertEqual(len(self.db.get_study_subjects(self.db.get_study_by_short_code('TEST').id)), 1)
+
+    def test_update_matrix_tube_locations_dry_run(self):
+        self.db.register_new_specimen_type('DNA')
+        self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        specimen_entries = [
+            {'uid': '1', 'short_code': 'TEST', 'collection_date': None, 'specimen_type': 'DNA',
+             'barcode': str(i), 'comments': None, 'well_position': 'A{:02d}'.format(i)} for i in range(1, 4)
+        ]
+        self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)
+
+        update_list = [
+            {'barcode': '1', 'plate_uid': 'P1', 'well_position': 'A02'},
+            {'barcode': '2', 'plate_uid': 'P1', 'well_position': 'A01'},
+            {'barcode': '3', 'plate_uid': 'P1', 'well_position': 'A01'},
+            {'barcode': '4', 'plate_uid': 'P2', 'well_position': 'Z01'},
+        ]
+        report = self.db.update_matrix_tube_locations(update_list, dry_run=True)
+        self.assertEqual(report, [
+            [],
+            [],
+            ['Tube Position Conflict at P1 A01.'],
+            ['Matrix Tube with barcode 4 does not exist.', 'Matrix plate with UID P2 does not exist.',
+             'Z01 is not a valid well position.'],
+        ])
+        self.assertEqual(self.db.get_matrix_tube('1').well_position, 'A01')
+
+    def test_update_matrix_tube_locations_swap(self):
+        self.db.register_new_specimen_type('DNA')
+        self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        specimen_entries = [
+            {'uid': '1', 'short_code': 'TEST', 'collection_date': None, 'specimen_type': 'DNA',
+             'barcode': str(i), 'comments': None, 'well_position': 'A{:02d}'.format(i)} for i in range(1, 4)
+        ]
+        plate1 = self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)[0]
+        plate2 = self.db.add_matrix_plate_with_specimens('P2', location.id, [])[0]
+
+        update_list = [
+            {'barcode': '1', 'plate_uid': 'P1', 'well_position': 'A02', 'comments': None},
+            {'barcode': '2', 'plate_uid': 'P1', 'well_position': 'A01', 'comments': 'Swapped'},
+            {'barcode': '3', 'plate_uid': 'P2', 'well_position': 'H12', 'comments': None},
+        ]
+        matrix_plates, study_subjects, specimens, matrix_tubes = self.db.update_matrix_tube_locations(update_list)
+        self.assertEqual(set(matrix_plates), {plate1, plate2})
+        self.assertEqual(len(study_subjects), 1)
+        self.assertEqual([(_.barcode, _.plate.uid, _.well_position) for _ in matrix_tubes],
+                         [('1', 'P1', 'A02'), ('2', 'P1', 'A01'), ('3', 'P2', 'H12')])
+        self.assertEqual(self.db.get_matrix_tube('2').comments, 'Swapped')
+        self.assertEqual(len(plate1.tubes), 2)
+        self.assertEqual(len(plate2.tubes), 1)
+
+        update_list = [
+            {'barcode': '1', 'plate_uid': 'P1', 'well_position': 'A01'},
+            {'barcode': '3', 'plate_uid': 'P1', 'well_position': 'A02'},
+        ]
+        with self.assertRaises(WellConflictError) as cm:
+            self.db.update_matrix_tube_locations(update_list)
+        self.assertEqual(cm.exception.conflicts, [('P1', 'A01')])
+        self.assertEqual(self.db.get_matrix_tube('3').well_position, 'H12')
+        self.assertRaises(ValueError, self.db.update_matrix_tube_locations,
+                          [{'barcode': '1', 'plate_uid': 'P1', 'well_position': 'Z01'}])
+        self.assertRaises(NoResultFound, self.db.update_matrix_tube_locations,
+                          [{'barcode': '4', 'plate_uid': 'P1', 'well_position': 'A01'}])
+        self.assertRaises(NoResultFound, self.db.update_matrix_tube_locations,
+                          [{'barcode': '1', 'plate_uid': 'P3', 'well_position': 'A01'}])
+
+    def test_get_study_paginated(self):
+        self.db.register_new_specimen_type('DNA')
+        plasma = self.db.register_new_specimen_type('Plasma')
+        study = self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        specimen_entries = [
+            {'uid': str(i), 'short_code': 'TEST', 'collection_date': None, 'specimen_type': 'DNA' if i % 2 else 'Plasma',
+             'barcode': str(i), 'comments': None, 'well_position': 'A{:02d}'.format(i)} for i in range(1, 6)
+        ]
+        self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)
+        self.db.set_matrix_tubes_exhausted(['1'])
+
+        study_, study_subjects, specimens, matrix_tubes = self.db.get_study(study.id, limit=2)
+        self.assertEqual([_.barcode for _ in matrix_tubes], ['1', '2'])
+        self.assertEqual(sorted([_.uid for _ in study_subjects]), ['1', '2'])
+        self.assertEqual(len(specimens), 2)
+
+        matrix_tubes = self.db.get_study(study.id, limit=2, after=matrix_tubes[-1].id)[3]
+        self.assertEqual([_.barcode for _ in matrix_tubes], ['3', '4'])
+        matrix_tubes = self.db.get_study(study.id, limit=2, after=matrix_tubes[-1].id)[3]
+        self.assertEqual([_.barcode for _ in matrix_tubes], ['5'])
+
+        matrix_tubes = self.db.get_study(study.id, exhausted=False, specimen_type_id=plasma.id)[3]
+        self.assertEqual([_.barcode for _ in matrix_tubes], ['2', '4'])
+        self.assertEqual(len(self.db.get_study(study.id)[1]), 5)
+
+    def test_get_matrix_plates_paginated(self):
+        location = self.db.register_new_location('-80 Freezer')
+        plates = [self.db.add_matrix_plate_with_specimens(str(i), location.id, [])[0] for i in range(3)]
+        self.db.hide_plates([plates[1].id])
+        self.assertEqual(self.db.get_matrix_plates(limit=2), plates[:2])
+        self.assertEqual(self.db.get_matrix_plates(limit=2, after=plates[1].id), plates[2:])
+        self.assertEqual(self.db.get_matrix_plates(hidden=False), [plates[0], plates[2]])
+        self.assertEqual(self.db.get_studies(limit=1), [])
+
+    def _count_summaries(self, scope):
+        return dict([(_.scope_id, (_.subject_count, _.specimen_count, _.plate_count, _.tube_count,
+                                   _.exhausted_tube_count)) for _ in self.db.get_count_summaries(scope)])
+
+    def test_count_summaries(self):
+        self.db.register_new_specimen_type('DNA')
+        study = self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        self.assertEqual(self._count_summaries('study'), {study.id: (0, 0, 0, 0, 0)})
+        self.assertEqual(self._count_summaries('location'), {location.id: (0, 0, 0, 0, 0)})
+
+        specimen_entries = [
+            {'uid': str(i % 2), 'short_code': 'TEST', 'collection_date': None, 'specimen_type': 'DNA',
+             'barcode': str(i), 'comments': None, 'well_position': 'A{:02d}'.format(i)} for i in range(1, 4)
+        ]
+        plate1 = self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)[0]
+        plate2 = self.db.add_matrix_plate_with_specimens('P2', location.id, [])[0]
+        self.assertEqual(self._count_summaries('study'), {study.id: (2, 2, 1, 3, 0)})
+        self.assertEqual(self._count_summaries('plate'), {plate1.id: (2, 2, 1, 3, 0), plate2.id: (0, 0, 1, 0, 0)})
+        self.assertEqual(self._count_summaries('location'), {location.id: (2, 2, 2, 3, 0)})
+
+        self.db.update_matrix_tube_locations([{'barcode': '1', 'plate_uid': 'P2', 'well_position': 'A01'}])
+        self.db.set_matrix_tubes_exhausted(['2'])
+        self.assertEqual(self._count_summaries('study'), {study.id: (2, 2, 2, 3, 1)})
+        self.assertEqual(self._count_summaries('plate'), {plate1.id: (2, 2, 1, 2, 1), plate2.id: (1, 1, 1, 1, 0)})
+
+        self.db.delete_matrix_tubes(self.db.get_matrix_tubes(['1']))
+        self.db.delete_plate(plate2.id)
+        self.assertEqual(self._count_summaries('study'), {study.id: (2, 2, 1, 2, 1)})
+        self.assertEqual(self._count_summaries('plate'), {plate1.id: (2, 2, 1, 2, 1)})
+        self.assertEqual(self._count_summaries('location'), {location.id: (2, 2, 1, 2, 1)})
+
+        summaries = self._count_summaries('plate'), self._count_summaries('location')
+        self.db.rebuild_count_summaries()
+        self.assertEqual((self._count_summaries('plate'), self._count_summaries('location')), summaries)
+        self.assertRaises(ValueError, self.db.get_count_summaries, 'specimen')
+
+
+
+    def test_jobs(self):
+        job = self.db.create_job('barcode_search', 10, 'barcode_search.csv')
+        self.assertEqual((job.status, job.rows_processed), ('queued', 0))
+        self.db.update_job(job.id, {'status': 'running', 'rows_processed': 5})
+        self.assertEqual(self.db.get_job(job.id).rows_processed, 5)
+        done = self.db.create_job('plate_upload')
+        self.db.update_job(done.id, {'status': 'done'})
+
+        self.assertEqual(self.db.fail_unfinished_jobs('Interrupted'), 1)
+        self.assertEqual((self.db.get_job(job.id).status, self.db.get_job(job.id).error), ('failed', 'Interrupted'))
+        self.assertEqual(self.db.get_job(done.id).status, 'done')
+        self.assertRaises(NoResultFound, self.db.get_job, 100)
+
+        self.db.update_job(done.id, {'result_path': 'plate_upload.json'})
+        running = self.db.create_job('specimen_search')
+        job_ids = [job.id, done.id, running.id]
+        self.assertEqual(self.db.delete_finished_jobs(datetime.utcnow() - timedelta(days=1)), [])
+        self.assertEqual(self.db.delete_finished_jobs(datetime.utcnow() + timedelta(seconds=1)),
+                         ['plate_upload.json'])
+        self.assertRaises(NoResultFound, self.db.get_job, job_ids[0])
+        self.assertRaises(NoResultFound, self.db.get_job, job_ids[1])
+        self.assertEqual(self.db.get_job(job_ids[2]).status, 'queued')
+
+    def test_find_specimens_progress(self):
+        location = self.db.register_new_location('-80 Freezer')
+        self.db.register_new_specimen_type('DNA')
+        self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        self.db.add_matrix_plate_with_specimens('P1', location.id, [
+            {'uid': '1', 'short_code': 'TEST', 'collection_date': None, 'specimen_type': 'DNA',
+             'barcode': '1', 'comments': None, 'well_position': 'A01'}], True, True)
+        progress = []
+        entries = [{'uid': str(i), 'short_code': 'TEST', 'specimen_type': 'DNA'} for i in range(600)]
+        self.assertEqual(len(list(self.db.iter_find_specimens(entries, progress=progress.append))), 600)
+        self.assertEqual(progress, [500, 600])
+        progress = []
+        entries = [{'barcode': str(i)} for i in range(3)]
+        list(self.db.iter_convert_barcoded_entries(entries, progress=progress.append))
+        self.assertEqual(progress, [3])
+
+    def test_plate_progress(self):
+        self.db.register_new_specimen_type('DNA')
+        self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        specimen_entries = [
+            {'uid': str(i), 'short_code': 'TEST', 'collection_date': None, 'specimen_type': 'DNA',
+             'barcode': str(i), 'comments': None, 'well_position': '{}{:02d}'.format('ABCD'[i // 12], i % 12 + 1)}
+            for i in range(30)
+        ]
+        progress = []
+        self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True,
+                                                progress=progress.append)
+        self.assertEqual(progress, [24, 30])
+        self.db.add_matrix_plate_with_specimens('P2', location.id, [])
+        progress = []
+        self.db.update_matrix_tube_locations([dict(_, plate_uid='P2') for _ in specimen_entries],
+                                             progress=progress.append)
+        self.assertEqual(progress, [24, 30])
+        self.assertEqual(len(self.db.get_matrix_plates()[1].tubes), 30)
+
+    def test_query_budget(self):
+        self.db.register_new_specimen_type('DNA')
+        self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        specimen_entries = [
+            {'uid': str(i), 'short_code': 'TEST', 'collection_date': None, 'specimen_type': 'DNA',
+             'barcode': str(i), 'comments': None, 'well_position': '{}{:02d}'.format('ABCD'[i // 12], i % 12 + 1)}
+            for i in range(48)
+        ]
+        self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)
+        self.db.add_matrix_plate_with_specimens('P2', location.id, [])
+        barcodes = [_['barcode'] for _ in specimen_entries]
+
+        # Budgets stay well below the number of tubes, a statement per tube would exceed them.
+        self.db.remove_session()
+        with self.db.query_recorder.budget(2):
+            self.db.find_specimens([{'uid': _, 'short_code': 'TEST', 'specimen_type': 'DNA'} for _ in barcodes])
+        with self.db.query_recorder.budget(2):
+            matrix_tubes = self.db.get_matrix_tubes(barcodes)
+        self.assertEqual([_.barcode for _ in matrix_tubes], barcodes)
+        with self.db.query_recorder.budget(2):
+            self.db.convert_barcoded_entries([{'barcode': _} for _ in barcodes])
+        with self.db.query_recorder.budget(25):
+            self.db.set_matrix_tubes_exhausted(barcodes)
+        with self.db.query_recorder.budget(30):
+            self.db.update_matrix_tube_locations([dict(_, plate_uid='P2') for _ in specimen_entries])
+        self.assertRaises(NoResultFound, self.db.get_matrix_tubes, ['1', 'missing'])
+
+        with self.assertRaises(QueryBudgetExceeded) as cm:
+            with self.db.query_recorder.budget(10) as stats:
+                for barcode in barcodes:
+                    self.db.get_matrix_tube(barcode)
+        self.assertEqual(stats.count, 48)
+        self.assertEqual(stats.most_repeated[1], 48)
+        self.assertIn('48 times: SELECT', str(cm.exception))
+
+    def test_query_recorder_scopes(self):
+        # Scopes, e.g. greenlets serving requests, share the thread.
+        scope = ['request 1']
+        self.db = SampleDB('sqlite:///', scopefunc=lambda: scope[0])
+        study = self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        stats = self.db.query_recorder.start()
+        scope[0] = 'request 2'
+        self.db.get_study_subjects(study.id)
+        self.assertEqual(stats.count, 0)
+        scope[0] = 'request 1'
+        self.db.get_study_subjects(study.id)
+        self.db.query_recorder.stop(stats)
+        self.assertGreater(stats.count, 0)
+        self.assertEqual(self.db.query_recorder._active_by_scope, {})
+
+    def test_delete_matrix_tubes(self):
+        self.db.register_new_specimen_type('DNA')
+        study = self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        # Two tubes per specimen.
+        specimen_entries = [
+            {'uid': str(i // 2), 'short_code': 'TEST', 'collection_date': None, 'specimen_type': 'DNA',
+             'barcode': str(i), 'comments': None, 'well_position': 'A{:02d}'.format(i + 1)} for i in range(6)
+        ]
+        self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)
+        matrix_tubes = self.db.get_matrix_tubes([_['barcode'] for _ in specimen_entries])
+        matrix_tube_ids = [_.id for _ in matrix_tubes]
+        specimen_ids = [_.specimen_id for _ in matrix_tubes]
+
+        self.assertRaises(NoResultFound, self.db.delete_matrix_tubes_by_barcode, ['0', 'missing'])
+        # Specimen 1 is also stored in tube 3.
+        self.assertRaises(ValueError, self.db.delete_matrix_tubes_by_barcode, ['0', '1', '2'], with_specimens=True)
+        self.assertEqual(len(self.db.get_matrix_tubes([_['barcode'] for _ in specimen_entries])), 6)
+        with self.db.query_recorder.budget(30):
+            deleted = self.db.delete_matrix_tubes_by_barcode(['0', '1', '2'])
+        self.assertEqual(deleted, (matrix_tube_ids[:3], [specimen_ids[0]]))
+        self.assertEqual([_.barcode for _ in self.db.get_matrix_tubes(['3', '4', '5'])], ['3', '4', '5'])
+        self.assertEqual(self._count_summaries('study'), {study.id: (3, 2, 1, 3, 0)})
+
+        self.assertRaises(ValueError, self.db.delete_matrix_tubes_and_specimens, matrix_tubes[4:5],
+                          [matrix_tubes[4].specimen])
+        self.assertEqual(self.db.delete_specimens([{'uid': '2', 'short_code': 'TEST', 'specimen_type': 'DNA'},
+                                                   {'uid': '3', 'short_code': 'TEST', 'specimen_type': 'DNA'}]),
+                         (matrix_tube_ids[4:], [specimen_ids[4]]))
+        specimen = matrix_tubes[3].specimen
+        self.assertEqual(self.db.delete_matrix_tubes_and_specimens(matrix_tubes[3:4], []),
+                         (matrix_tube_ids[3:4], []))
+        self.assertEqual(self.db.delete_matrix_tubes_and_specimens([], [specimen]), ([], [specimen_ids[3]]))
+        self.assertEqual(self._count_summaries('study'), {study.id: (3, 0, 0, 0, 0)})
+        self.assertEqual(sorted([(_.table_name, _.row_id) for _ in self.db.get_study_changes(
+            study.id, datetime.utcnow() - timedelta(days=1)).tombstones if _.table_name == 'specimen']),
+            [('specimen', _) for _ in sorted(set(specimen_ids))])
+
+    def test_get_version(self):
+        self.db.register_new_specimen_type('DNA')
+        study = self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        other_study = self.db.create_study('other', 'OTHER', False, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        specimen_entries = [
+            {'uid': '1', 'short_code': 'TEST', 'collection_date': None, 'specimen_type': 'DNA',
+             'barcode': str(i), 'comments': None, 'well_position': 'A{:02d}'.format(i)} for i in range(1, 3)
+        ]
+        plate = self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)[0]
+
+        def versions():
+            return dict([(_, self.db.get_version(*_)) for _ in
+                         [('studies',), ('study', study.id), ('study', other_study.id), ('plates',),
+                          ('plate', plate.id), ('locations',), ('location', location.id)]])
+
+        before = versions()
+        self.assertEqual(before, versions())
+        self.assertIsNotNone(before[('plate', plate.id)].last_modified)
+
+        self.db.update_matrix_tube_locations([{'barcode': '1', 'plate_uid': 'P1', 'well_position': 'B01'}])
+        after_move = versions()
+        changed = set([_ for _ in before if before[_].etag != after_move[_].etag])
+        self.assertEqual(changed, {('study', study.id), ('plates',), ('plate', plate.id)})
+
+        self.db.set_matrix_tubes_exhausted(['2'])
+        after_exhausted = versions()
+        changed = set([_ for _ in before if after_move[_].etag != after_exhausted[_].etag])
+        self.assertEqual(changed, {('study', study.id), ('plates',), ('plate', plate.id)})
+
+        self.db.update_study(other_study.id, {'lead_person': 'Jordan'})
+        self.assertNotEqual(after_exhausted[('studies',)].etag, self.db.get_version('studies').etag)
+        self.assertEqual(after_exhausted[('study', study.id)].etag, self.db.get_version('study', study.id).etag)
+
+        self.assertIsNone(self.db.get_version('plate', plate.id + 1))
+        self.assertRaises(ValueError, self.db.get_version, 'subject')
+
+    def test_get_study_changes(self):
+        self.db.register_new_specimen_type('DNA')
+        study = self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        specimen_entries = [
+            {'uid': str(i), 'short_code': 'TEST', 'collection_date': None, 'specimen_type': 'DNA',
+             'barcode': str(i), 'comments': None, 'well_position': 'A{:02d}'.format(i)} for i in range(1, 4)
+        ]
+        self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)
+        self.db.add_matrix_plate_with_specimens('P2', location.id, [])
+
+        since = datetime.utcnow()
+        changes = self.db.get_study_changes(study.id, since)
+        self.assertEqual(changes.scope, study)
+        self.assertEqual((changes.study_subjects, changes.specimens, changes.matrix_tubes, changes.tombstones),
+                         ([], [], [], []))
+        self.assertLess(changes.synced_at, since)
+
+        self.db.update_matrix_tube_locations([{'barcode': '1', 'plate_uid': 'P2', 'well_position': 'A01'}])
+        matrix_tubes = self.db.get_matrix_tubes(['2'])
+        self.db.delete_matrix_tubes_and_specimens(matrix_tubes, [_.specimen for _ in matrix_tubes])
+        subject = self.db.add_study_subject('4', study.id)
+
+        changes = self.db.get_study_changes(study.id, since)
+        self.assertEqual([_.uid for _ in changes.study_subjects], ['4'])
+        self.assertEqual(changes.specimens, [])
+        self.assertEqual([_.barcode for _ in changes.matrix_tubes], ['1'])
+        self.assertEqual(sorted([(_.table_name, _.row_id) for _ in changes.tombstones]),
+                         [('matrix_tube', matrix_tubes[0].id), ('specimen', matrix_tubes[0].specimen_id)])
+
+        self.db.delete_study_subject(subject.id)
+        changes = self.db.get_study_changes(study.id, since)
+        self.assertEqual(changes.study_subjects, [])
+        self.assertIn(('study_subject', subject.id), [(_.table_name, _.row_id) for _ in changes.tombstones])
+
+        self.assertRaises(NoResultFound, self.db.get_study_changes, study.id + 1, since)
+
+    def test_get_matrix_plate_changes(self):
+        self.db.register_new_specimen_type('DNA')
+        study = self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        specimen_entries = [
+            {'uid': str(i), 'short_code': 'TEST', 'collection_date': None, 'specimen_type': 'DNA',
+             'barcode': str(i), 'comments': None, 'well_position': 'A{:02d}'.format(i)} for i in range(1, 4)
+        ]
+        plate1 = self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)[0]
+        plate2 = self.db.add_matrix_plate_with_specimens('P2', location.id, [])[0]
+
+        since = datetime.utcnow()
+        self.db.update_matrix_tube_locations([{'barcode': '1', 'plate_uid': 'P2', 'well_position': 'A01'},
+                                              {'barcode': '2', 'plate_uid': 'P1', 'well_position': 'B02'}])
+
+        changes = self.db.get_matrix_plate_changes(plate1.id, since)
+        self.assertEqual(changes.scope, plate1)
+        self.assertEqual([_.barcode for _ in changes.matrix_tubes], ['2'])
+        self.assertEqual([_.uid for _ in changes.study_subjects], ['2'])
+        tube1 = self.db.get_matrix_tube('1')
+        self.assertEqual([(_.table_name, _.row_id) for _ in changes.tombstones], [('matrix_tube', tube1.id)])
+
+        changes = self.db.get_matrix_plate_changes(plate2.id, since)
+        self.assertEqual([_.barcode for _ in changes.matrix_tubes], ['1'])
+        self.assertEqual([_.id for _ in changes.specimens], [tube1.specimen_id])
+        self.assertEqual([_.uid for _ in changes.study_subjects], ['1'])
+        self.assertEqual(changes.tombstones, [])
+
+        self.db.delete_plate(plate2.id)
+        self.assertRaises(NoResultFound, self.db.get_matrix_plate_changes, plate2.id, since)
+        changes = self.db.get_study_changes(study.id, since)
+        self.assertEqual(sorted([_.barcode for _ in changes.matrix_tubes]), ['1', '2'])
+        self.assertIsNone(self.db.get_matrix_tube('1').plate_id)
+
+    def test_dump_study(self):
+        self.db.register_new_specimen_type('DNA')
+        study = self.db.create_study('test', 'TEST', True, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        specimen_entries = [
+            {'uid': str(i % 2), 'short_code': 'TEST', 'collection_date': date(2017, 1, 1), 'specimen_type': 'DNA',
+             'barcode': str(i), 'comments': None, 'well_position': 'A{:02d}'.format(i)} for i in range(1, 4)
+        ]
+        plate = self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)[0]
+        self.db.set_matrix_tubes_exhausted(['1'])
+
+        study_entry, study_subject_entries, specimen_entries, matrix_tube_entries = self.db.dump_study(study.id)
+        study, study_subjects, specimens, matrix_tubes = self.db.get_study(study.id)
+        study_subjects, specimens = [sorted(_, key=lambda row: row.id) for _ in (study_subjects, specimens)]
+        self.assertEqual(study_entry['id'], str(study.id))
+        self.assertEqual(study_entry['created'], study.created.isoformat() + '+00:00')
+        self.assertEqual(study_entry['subjects'], sorted([_.id for _ in study.subjects]))
+        self.assertEqual([(_['uid'], _['study'], _['specimens']) for _ in study_subject_entries],
+                         [(_.uid, str(study.id), sorted([s.id for s in _.specimens])) for _ in study_subjects])
+        self.assertEqual([(_['collection_date'], _['storage_containers']) for _ in specimen_entries],
+                         [('2017-01-01', sorted([c.id for c in _.storage_containers])) for _ in specimens])
+        self.assertEqual([(_['barcode'], _['plate'], _['specimen'], _['exhausted'], _['discriminator'])
+                          for _ in matrix_tube_entries],
+                         [(_.barcode, str(plate.id), str(_.specimen_id), _.exhausted, 'matrix_tube')
+                          for _ in matrix_tubes])
+
+        study_entry, study_subject_entries, specimen_entries, matrix_tube_entries = self.db.dump_study(
+            study.id, limit=1, after=matrix_tubes[0].id)
+        self.assertEqual([_['barcode'] for _ in matrix_tube_entries], ['2'])
+        self.assertEqual([_['uid'] for _ in study_subject_entries], ['0'])
+        self.assertEqual(self.db.dump_study(study.id, exhausted=True)[3][0]['barcode'], '1')
+        self.assertEqual(self.db.dump_study(study.id + 1), (None, [], [], []))
+
+    def test_dump_matrix_plate(self):
+        self.db.register_new_specimen_type('DNA')
+        self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        specimen_entries = [
+            {'uid': '1', 'short_code': 'TEST', 'collection_date': None, 'specimen_type': 'DNA',
+             'barcode': str(i), 'comments': None, 'well_position': 'A{:02d}'.format(i)} for i in range(1, 4)
+        ]
+        plate = self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)[0]
+
+        plate_entry, study_subject_entries, specimen_entries, matrix_tube_entries = self.db.dump_matrix_plate(plate.id)
+        self.assertEqual((plate_entry['uid'], plate_entry['location']), ('P1', str(location.id)))
+        self.assertEqual(plate_entry['tubes'], sorted([_.id for _ in plate.tubes]))
+        self.assertEqual(len(study_subject_entries), 1)
+        self.assertEqual(len(specimen_entries), 1)
+        self.assertEqual(len(specimen_entries[0]['storage_containers']), 3)
+        self.assertEqual([_['well_position'] for _ in matrix_tube_entries], ['A01', 'A02', 'A03'])
+        self.assertEqual(self.db.dump_matrix_plate(plate.id + 1), (None, [], [], []))
+
+    def _count_statements(self, func, *args):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        listen(self.db.engine, 'before_cursor_execute', count)
+        try:
+            result = func(*args)
+        finally:
+            remove(self.db.engine, 'before_cursor_execute', count)
+        return result, len(statements)
+
+    def test_reference_cache(self):
+        study = self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        specimen_type = self.db.register_new_specimen_type('DNA')
+        location = self.db.register_new_location('-80 Freezer')
+        self.db.get_studies(), self.db.get_specimen_types(), self.db.get_locations()
+        self.db.get_study_by_short_code('TEST')
+
+        # Attributes are read inside the counted block, the returned copies must not be expired.
+        short_codes, statements = self._count_statements(lambda: [_.short_code for _ in self.db.get_studies()])
+        self.assertEqual((short_codes, statements), (['TEST'], 0))
+        short_codes, statements = self._count_statements(
+            lambda: [self.db.get_study_by_short_code('TEST').short_code for _ in range(5)])
+        self.assertEqual((short_codes, statements), (['TEST'] * 5, 0))
+        labels, statements = self._count_statements(lambda: [_.label for _ in self.db.get_specimen_types()])
+        self.assertEqual((labels, statements), (['DNA'], 0))
+        description, statements = self._count_statements(lambda: self.db.get_location(location.id).description)
+        self.assertEqual((description, statements), ('-80 Freezer', 0))
+        self.assertIsNone(self.db.get_location(location.id + 1))
+
+        self.db.update_location(location.id, {'description': 'Bldg 20 Freezer'})
+        self.db.register_new_location('Bldg 30 Freezer')
+        self.assertEqual([_.description for _ in self.db.get_locations()], ['Bldg 20 Freezer', 'Bldg 30 Freezer'])
+        study_subject = self.db.add_study_subject('1', study.id)
+        self.assertEqual([_.id for _ in self.db.get_studies()[0].subjects], [study_subject.id])
+        self.db.update_specimen_type(specimen_type.id, {'label': 'RNA'})
+        self.assertEqual(self.db.get_specimen_type(specimen_type.id).label, 'RNA')
+
+        # Plate uploads resolve studies and specimen types without querying their tables.
+        self.db.get_study_by_short_code('TEST')
+        specimen_entries = [{'uid': '1', 'short_code': 'TEST', 'collection_date': None, 'specimen_type': 'RNA',
+                             'barcode': '1', 'comments': None, 'well_position': 'A01'}]
+        statements = []
+        listen(self.db.engine, 'before_cursor_execute',
+               lambda conn, cursor, statement, *args: statements.append(statement))
+        self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)
+        self.assertFalse([_ for _ in statements if 'study.short_code' in _ or 'specimen_type.label' in _])
+
+    def test_reference_cache_size(self):
+        self.db = SampleDB('sqlite:///', reference_cache_size=1)
+        self.db.register_new_location('Bldg 20 Freezer')
+        self.db.register_new_location('Bldg 30 Freezer')
+        self.db.get_locations()
+        locations, statements = self._count_statements(self.db.get_locations)
+        self.assertEqual(len(locations), 2)
+        self.assertGreater(statements, 0)
+
+
+class TestReferenceCache(unittest.TestCase):
+    def test_invalidate_while_loading(self):
+        cache = ReferenceCache()
+
+        def load():
+            cache.invalidate('study')
+            return ['stale']
+        self.assertEqual(cache.get('study', load), ['stale'])
+        self.assertEqual(cache.get('study', lambda: ['fresh']), ['fresh'])
+        self.assertEqual(cache.get('study', lambda: ['reloaded']), ['fresh'])
+        cache.invalidate('study')
+        self.assertEqual(cache.get('study', lambda: ['reloaded']), ['reloaded'])
+
+
+class TestSlowQueryLog(unittest.TestCase):
+    def setUp(self):
+        self.entries = []
+        self.handler = logging.Handler()
+        self.handler.emit = lambda record: self.entries.append(json.loads(record.getMessage()))
+        logging.getLogger('sample_db.slow_queries').addHandler(self.handler)
+
+    def tearDown(self):
+        logging.getLogger('sample_db.slow_queries').removeHandler(self.handler)
+
+    def test_log_and_report(self):
+        db = SampleDB('sqlite:///', slow_query_threshold=0)
+        db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        db.add_study_subjects(['1', '2'], 1)
+        del self.entries[:]
+        db.get_specimens('1', 'TEST')
+        db.get_specimens('2', 'TEST')
+
+        self.assertTrue(self.entries)
+        self.assertEqual(set([_['caller'] for _ in self.entries]), {'get_specimens'})
+        specimen_entries = [_ for _ in self.entries if 'FROM specimen' in _['statement']]
+        self.assertEqual([_['parameters'] for _ in specimen_entries], [['1', 'TEST'], ['2', 'TEST']])
+        self.assertTrue(specimen_entries[0]['plan'])
+
+        groups = report(self.entries)
+        self.assertEqual(sum([_['count'] for _ in groups]), len(self.entries))
+        group = [_ for _ in groups if 'FROM specimen' in _['shape']][0]
+        self.assertEqual(group['count'], 2)
+        self.assertEqual(group['callers'], ['get_specimens'])
+
+    def test_rollback(self):
+        # Explaining a statement must not commit the writes of its transaction.
+        db = SampleDB('sqlite:///', slow_query_threshold=0)
+        with self.assertRaises(ValueError):
+            with db._session_scope() as session:
+                session.add(Study(title='test', short_code='TEST', is_longitudinal=False, lead_person='Max'))
+                session.flush()
+                session.query(Study).filter(Study.short_code == 'TEST').all()
+                raise ValueError()
+        self.assertEqual(db.get_studies(), [])
+        self.assertTrue([_ for _ in self.entries if 'FROM study' in _['statement'] and _['plan']])
+
+    def test_statement_shape(self):
+        self.assertEqual(statement_shape("SELECT id FROM t\n WHERE a IN (?, ?,?) AND b = 'x' LIMIT 10"),
+                         "SELECT id FROM t WHERE a IN (?) AND b = ? LIMIT ?")
+        groups = report([{'statement': 'SELECT * FROM t', 'duration': 1.0, 'plan': ['SCAN t']},
+                         {'statement': 'SELECT * FROM t WHERE id = ?', 'duration': 0.5,
+                          'plan': ['SEARCH t USING INTEGER PRIMARY KEY (rowid=?)']}])
+        self.assertEqual([_['full_scans'] for _ in groups], [['SCAN t'], []])
+
+
+class TestBatching(unittest.TestCase):
+    def setUp(self):
+        self.db = SampleDB('sqlite:///', temp_table_threshold=10)
+
+    def test_in_criteria(self):
+        matrix_tube = MatrixTube.__table__
+        with self.db._session_scope() as session:
+            max_parameters = session.connection().info['max_parameters']
+            self.assertGreaterEqual(max_parameters, 999)
+            self.assertEqual(chunk_size(session), min(max_parameters, MAX_CHUNK_SIZE))
+            self.assertEqual(chunk_size(session, reserved=max_parameters), 1)
+            self.assertEqual([len(_) for _ in chunks(range(5), 2)], [2, 2, 1])
+
+            criteria = list(in_criteria(session, matrix_tube.c.barcode, ['1', '2', '2']))
+            self.assertEqual(len(criteria), 1)
+            self.assertEqual(len(criteria[0].right.clauses), 2)
+
+            criteria = in_criteria(session, matrix_tube.c.barcode, [str(_) for _ in range(20)])
+            self.assertIn('batch_key', str(next(criteria)))
+            self.assertEqual(session.execute('SELECT count(*) FROM batch_key').scalar(), 20)
+            self.assertEqual(list(criteria), [])
+            self.assertEqual(session.execute('SELECT count(*) FROM batch_key').scalar(), 0)
+
+    def test_bulk_statements(self):
+        self.db.register_new_specimen_type('DNA')
+        self.db.create_study('test', 'TEST', False, 'Max', 'No Description')
+        location = self.db.register_new_location('-80 Freezer')
+        specimen_entries = [
+            {'uid': str(i), 'short_code': 'TEST', 'collection_date': None, 'specimen_type': 'DNA',
+             'barcode': str(i), 'comments': None, 'well_position': 'A{:02d}'.format(i + 1)} for i in range(12)
+        ]
+        self.db.add_matrix_plate_with_specimens('P1', location.id, specimen_entries, True, True)
+        barcodes = [_['barcode'] for _ in reversed(specimen_entries)]
+
+        with self.db.query_recorder.recording() as stats:
+            matrix_tubes = self.db.get_matrix_tubes(barcodes)
+        self.assertEqual([_.barcode for _ in matrix_tubes], barcodes)
+        self.assertTrue([_ for _ in stats.statements if 'batch_key' in _])
+        self.assertEqual([_.barcode for _ in self.db.set_matrix_tubes_exhausted(barcodes[:11])], barcodes[:11])
+        self.assertEqual([_.barcode for _ in self.db.get_matrix_tubes_from_specimens(
+            [{'uid': _, 'short_code': 'TEST', 'specimen_type': 'DNA'} for _ in barcodes + ['missing']])], barcodes)
+        self.assertEqual(len(self.db.delete_matrix_tubes_by_barcode(barcodes)[1]), 12)
+        self.assertRaises(NoResultFound, self.db.get_matrix_tubes, barcodes)
+
+    def test_in_input_order(self):
+        items = [(1, 'a'), (3, 'c'), (2, 'b'), (1, 'd')]
+        self.assertEqual(in_input_order([2, 1, 4, 2], items, lambda _: _[0]),
+                         [(2, 'b'), (1, 'a'), (1, 'd'), (2, 'b')])
+
+
+class TestPlateOccupancy(unittest.TestCase):
+    def test_place(self):
+        occupancy = PlateOccupancy()
+        occupancy.add(1, 'A01', 10)
+        occupancy.add(1, 'H12', 11)
+        occupancy.add(1, '-B01', 12)
+        self.assertEqual(occupancy.occupied_wells(1), ['A01', 'H12'])
+        self.assertFalse(occupancy.is_occupied(2, 'A01'))
+
+        occupancy.release(10)
+        conflicts = occupancy.place([(1, 'A01', 11), (1, 'H12', 13), (2, 'A01', 14), (2, 'A01', 15)])
+        self.assertEqual(conflicts, [(1, 'H12', 13), (2, 'A01', 15)])
+
+
+class TestSampleDBWALMode(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.db = SampleDB('sqlite:///' + os.path.join(self.db_dir, 'sample_db.sqlite'), wal_mode=True)
+
+    def tearDown(self):
+        self.db.remove_session()
+        self.db.engine.dispose()
+        self.db.read_engine.dispose()
+        shutil.rmtree(self.db_dir)
+
+    def test_journal_mode(self):
+        self.assertEqual(self.db.engine.execute("PRAGMA journal_mode").scalar(), 'wal')
+        self.assertEqual(self.db.read_engine.execute("PRAGMA query_only").scalar(), 1)
+
+    def test_reads_use_read_only_engine(self):
+        location = self.db.register_new_location('-80 Freezer')
+        self.assertEqual([_.id for _ in self.db.get_locations()], [location.id])
+        with self.db._session_scope(read_only=True) as session:
+            self.assertIs(session.bind, self.db.read_engine)
+            self.assertRaises(OperationalError, session.execute, "DELETE FROM location")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,8 +1,15 @@
 import os
+import logging
+from logging.handlers import RotatingFileHandler
 
 from .config import config
-from flask import Flask
+from flask import Flask, _app_ctx_stack
+from sqlalchemy.event import listen
+from sqlalchemy.engine.url import make_url
 from .utils import backup_db
+from .metrics import TimedQueuePool, count_sqlite_busy
+from .jobs import JobQueue
+from .errors import job_error_message
 
 # import logging
 # conf = config['Production']
@@ -22,9 +29,39 @@ app.config.from_object(conf)
 # handler.setFormatter(formatter)
 # app.logger.addHandler(handler)
 
+if conf.SLOW_QUERY_THRESHOLD is not None:
+    if not os.path.exists(os.path.dirname(conf.SLOW_QUERY_LOG_PATH)):
+        os.makedirs(os.path.dirname(conf.SLOW_QUERY_LOG_PATH))
+    slow_query_handler = RotatingFileHandler(
+        conf.SLOW_QUERY_LOG_PATH, maxBytes=conf.SLOW_QUERY_LOG_MAX_BYTES, backupCount=conf.SLOW_QUERY_LOG_BACKUPS)
+    slow_query_handler.setFormatter(logging.Formatter('%(message)s'))
+    slow_query_log = logging.getLogger('sample_db.slow_queries')
+    slow_query_log.addHandler(slow_query_handler)
+    slow_query_log.propagate = False
+
 backup_db(conf.DB_PATH, conf.BACKUP_PATH, conf.BACKUP_DATE_FORMAT)
 
-db = SampleDB(conf.SQLALCHEMY_DATABASE_URI)
+# Every request gets its own session, backed by a shared connection pool. Requests are served by greenlets and jobs
+# by threads, so SQLite connections are used by other threads than the one that opened them.
+connect_args = {}
+if make_url(conf.SQLALCHEMY_DATABASE_URI).drivername.startswith('sqlite'):
+    connect_args['check_same_thread'] = False
+db = SampleDB(conf.SQLALCHEMY_DATABASE_URI, scopefunc=_app_ctx_stack.__ident_func__, expire_on_commit=False,
+              wal_mode=conf.SQLITE_WAL_MODE, busy_timeout=conf.SQLITE_BUSY_TIMEOUT, mmap_size=conf.SQLITE_MMAP_SIZE,
+              poolclass=TimedQueuePool, pool_size=conf.SQLALCHEMY_POOL_SIZE, max_overflow=conf.SQLALCHEMY_MAX_OVERFLOW,
+              pool_timeout=conf.SQLALCHEMY_POOL_TIMEOUT, connect_args=connect_args,
+              slow_query_threshold=conf.SLOW_QUERY_THRESHOLD, temp_table_threshold=conf.SQLITE_TEMP_TABLE_THRESHOLD)
+for engine in {db.engine, db.read_engine}:
+    listen(engine, 'handle_error', count_sqlite_busy)
+
+job_queue = JobQueue(db, conf.JOB_RESULTS_PATH, conf.JOB_WORKERS, conf.JOB_PROGRESS_INTERVAL,
+                     error_message=job_error_message, retention_days=conf.JOB_RETENTION_DAYS)
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    db.remove_session()
+
 import views
 
 print "Loading Flask App"
@@ -37,6 +37,45 @@ class Config:
     SQLALCHEMY_COMMIT_ON_TEARDOWN = True
     SQLALCHEMY_RECORD_QUERIES = True
     BACKUP_DATE_FORMAT = "%d-%b-%y"
+    # Connections of each pool, the read only pool in WAL mode is sized the same. gevent serves requests from a
+    # single thread without monkey patching, and a checkout waiting for a connection blocks every greenlet, including
+    # those of the streamed responses holding the connections, so it can only end with the POOL_TIMEOUT error and
+    # stalls the server meanwhile. POOL_SIZE + MAX_OVERFLOW must stay above the number of responses streamed at once.
+    SQLALCHEMY_POOL_SIZE = 5
+    SQLALCHEMY_MAX_OVERFLOW = 10
+    SQLALCHEMY_POOL_TIMEOUT = 30
+
+    # Page size of list endpoints when the client does not pass a limit, None returns complete lists.
+    DEFAULT_PAGE_LIMIT = None
+
+    # SQLite storage, WAL mode serves GET and search requests from a separate read only connection pool.
+    SQLITE_WAL_MODE = False
+    SQLITE_BUSY_TIMEOUT = 5000
+    SQLITE_MMAP_SIZE = 268435456
+    # Bulk statements over at least this many barcodes or IDs select them from a temporary table instead of binding
+    # them, None always binds them. See sample_db.benchmarks.batching for where the two cross over.
+    SQLITE_TEMP_TABLE_THRESHOLD = 100
+
+    # Background jobs, JOB_WORKERS caps how many imports and searches run at once. Finished jobs and their results
+    # are deleted JOB_RETENTION_DAYS after they finished, on the next start of the application. None keeps them.
+    JOB_WORKERS = 1
+    JOB_PROGRESS_INTERVAL = 1.0
+    JOB_RETENTION_DAYS = 7
+
+    # JSON responses of at least GZIP_MIN_SIZE bytes are gzipped for clients that accept it.
+    GZIP_MIN_SIZE = 1024
+    GZIP_LEVEL = 6
+
+    # SQL statements of each request are logged to 'sample_db.queries', with a warning when one statement ran at
+    # least QUERY_REPEAT_WARNING times. QUERY_STATS_HEADERS also sends them as X-Query-* response headers.
+    QUERY_REPEAT_WARNING = 10
+    QUERY_STATS_HEADERS = False
+
+    # Statements taking at least SLOW_QUERY_THRESHOLD seconds are logged with their query plan to
+    # SLOW_QUERY_LOG_PATH, see sample_db.db_impl.slow_queries. None turns the log off.
+    SLOW_QUERY_THRESHOLD = 0.5
+    SLOW_QUERY_LOG_MAX_BYTES = 10485760
+    SLOW_QUERY_LOG_BACKUPS = 5
 
     # Logging
 
@@ -49,8 +88,11 @@ class DevelopmentConfig(Config):
                                                                                                 'dev_sample_db.sqlite')
     DB_PATH = os.path.join(basedir, 'dev_sample_db.sqlite')
     BACKUP_PATH = os.path.join(basedir, 'db_backups')
+    JOB_RESULTS_PATH = os.path.join(basedir, 'job_results')
+    SLOW_QUERY_LOG_PATH = os.path.join(basedir, 'slow_queries.log')
     ASSETS_PATH = os.path.join(basedir, 'static')
     SQLALCHEMY_ECHO = True
+    QUERY_STATS_HEADERS = True
     LOGGING_LOCATION = os.path.join(basedir, 'app.log')
     LOGGING_LEVEL = logging.DEBUG
 
@@ -60,13 +102,34 @@ class ProductionConfig(Config):
                                                                                                  'sample_db.sqlite')
     DB_PATH = os.path.join(APPDATA, 'sample_db.sqlite')
     BACKUP_PATH = os.path.join(APPDATA, 'db_backups')
+    JOB_RESULTS_PATH = os.path.join(APPDATA, 'job_results')
+    SLOW_QUERY_LOG_PATH = os.path.join(APPDATA, 'slow_queries.log')
 
     ASSETS_PATH = os.path.join(prod_dir, 'static')
     LOGGING_LOCATION = os.path.join(prod_dir, 'app.log')
     LOGGING_LEVEL = logging.ERROR
 
 
+class BenchmarkConfig(Config):
+    """
+    Throwaway application of sample_db.benchmarks, which point BENCHMARK_DIR at a temporary directory before
+    importing it. Nothing is written to the install, no job workers are started and no slow query log is opened.
+    """
+    data_dir = os.environ.get('BENCHMARK_DIR') or os.path.join(basedir, 'benchmark')
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(data_dir, 'benchmark.sqlite')
+    DB_PATH = os.path.join(data_dir, 'benchmark.sqlite')
+    BACKUP_PATH = os.path.join(data_dir, 'db_backups')
+    JOB_RESULTS_PATH = os.path.join(data_dir, 'job_results')
+    JOB_WORKERS = 0
+    JOB_RETENTION_DAYS = None
+    SLOW_QUERY_THRESHOLD = None
+    ASSETS_PATH = os.path.join(basedir, 'static')
+    LOGGING_LOCATION = os.path.join(data_dir, 'app.log')
+    LOGGING_LEVEL = logging.ERROR
+
+
 config = {
     'Production': ProductionConfig,
-    'Development': DevelopmentConfig
+    'Development': DevelopmentConfig,
+    'Benchmark': BenchmarkConfig
 }
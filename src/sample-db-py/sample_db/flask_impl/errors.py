@@ -0,0 +1,70 @@
+from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.exc import IntegrityError
+
+from file_manager import DateParseError
+
+field_name_mapping = {
+    'short_code': 'Short Code',
+    'last_updated': 'Last Updated',
+    'is_longitudinal': 'Longitudinal',
+    'lead_person': 'Lead Person',
+    'uid': 'UID',
+    'study_subject': 'Study Subject',
+    'specimen_type': 'Specimen Type',
+    'collection_date': 'Collection Date',
+    'well_position': 'Well Position',
+    'study_subject_id': 'Study Subject',
+    'specimen_type_id': 'Specimen Type'
+}
+
+
+def parse_integrity_error(e):
+    if 'NOT NULL' in e.message:
+        msg = e.message.split(':')[1].strip()
+        field = field_name_mapping.get(msg.split('.')[1], msg.split('.')[1]).title()
+        return "{} Field cannot be empty".format(field)
+    elif 'UNIQUE' in e.message:
+        msg = e.message.split(':')[1].strip()
+        fields = msg.split(" ")
+        fields = [_.split('.')[1] for _ in fields]
+        fields = [_.replace(',', '') for _ in fields]
+        fields = [field_name_mapping.get(_, _) for _ in fields]
+        fields = [_.title() for _ in fields]
+        if len(fields) > 1:
+            s = "Fields [" + "{}, " * (len(fields) - 1) + "{}] are not unique"
+            return s.format(*fields)
+        else:
+            return "{} Field is not unique".format(fields[0])
+    else:
+        return e.message
+
+
+class InvalidUsage(Exception):
+    status_code = 400
+
+    def __init__(self, message, status_code=None, payload=None):
+        Exception.__init__(self)
+        self.message = message
+        if status_code is not None:
+            self.status_code = status_code
+        self.payload = payload
+
+    def to_dict(self):
+        rv = dict(self.payload or ())
+        rv['message'] = self.message
+        return rv
+
+
+def job_error_message(e):
+    """
+    Message recorded on a background job that failed, following the error handling of the synchronous endpoints.
+    """
+    if isinstance(e, (InvalidUsage, DateParseError)):
+        return e.message
+    if isinstance(e, IntegrityError):
+        return parse_integrity_error(e)
+    if isinstance(e, NoResultFound) and not (e.args and e.args[0]):
+        return "One or more items do not exist"
+    if isinstance(e, KeyError):
+        return "File Malformed"
+    return e.args[0] if e.args else repr(e)
@@ -1,7 +1,7 @@
+import io
 import os
 import csv
 import datetime
-import tempfile
 
 
 class DateParseError(Exception):
@@ -130,15 +130,6 @@ class BaseFileManager(object):
         except csv.Error:
             raise ValueError('File Format Incorrect, Must be CSV')
 
-    @staticmethod
-    def create_specimen_search_file(entries, header):
-        handle, temp_path = tempfile.mkstemp(suffix='csv', prefix='specimens')
-        with open(temp_path, 'w') as f:
-            w = csv.DictWriter(f, fieldnames=header)
-            w.writeheader()
-            w.writerows(entries)
-        return temp_path
-
     @staticmethod
     def parse_barcode_search_file(f):
         barcode_entries = []
@@ -167,13 +158,21 @@ class BaseFileManager(object):
             raise ValueError('File Format Incorrect, Must be CSV')
 
     @staticmethod
-    def create_barcode_search_file(entries, header):
-        handle, temp_path = tempfile.mkstemp(suffix='csv', prefix='barcodes')
-        with open(temp_path, 'w') as f:
-            w = csv.DictWriter(f, fieldnames=header)
-            w.writeheader()
-            w.writerows(entries)
-        return temp_path
+    def stream_csv(entries, header, chunk_size=65536):
+        """
+        Generator that writes entries as CSV, yielding the file in chunks of roughly chunk_size bytes as entries
+        come in.
+        """
+        buf = io.BytesIO()
+        w = csv.DictWriter(buf, fieldnames=header)
+        w.writeheader()
+        for entry in entries:
+            w.writerow(entry)
+            if buf.tell() >= chunk_size:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
 
 
 class CLIFileManager(BaseFileManager):
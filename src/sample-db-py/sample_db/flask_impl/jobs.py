@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import Queue
+import logging
+import datetime
+import threading
+
+
+class JobProgress(object):
+    """
+    Callable handed to a job to report the number of rows processed so far. Updates are written to the job table at
+    most once every interval seconds.
+    """
+
+    def __init__(self, db, job_id, interval=1.0):
+        self.db = db
+        self.job_id = job_id
+        self.interval = interval
+        self.rows_processed = 0
+        self._last_write = 0
+
+    def __call__(self, rows_processed):
+        self.rows_processed = rows_processed
+        now = time.time()
+        if now - self._last_write >= self.interval:
+            self._last_write = now
+            self.db.update_job(self.job_id, {'rows_processed': rows_processed})
+
+
+class JobQueue(object):
+    """
+    Runs long imports and searches on a fixed number of worker threads, so the request that submitted them can
+    return right away. The number of workers caps how many jobs run at once, everything else waits in the queue.
+
+    A job is a callable taking a JobProgress. It returns either a dict, written out as JSON, or an iterable of
+    CSV chunks, written out as is. Results are stored in results_path and the job table records where. Finished jobs
+    and their results are kept for retention_days, and deleted when a later queue starts.
+    """
+
+    def __init__(self, db, results_path, workers=1, progress_interval=1.0, error_message=None, retention_days=None):
+        """
+        :param db: SampleDB the job table lives in.
+        :param results_path: Directory job results are written to.
+        :param workers: Number of jobs that may run at the same time.
+        :param progress_interval: Minimum seconds between progress updates of a job.
+        :param error_message: Optional callable turning an exception raised by a job into the message recorded on it.
+        :param retention_days: Optional days finished jobs and their results are kept, None keeps them forever.
+        """
+        self.db = db
+        self.results_path = results_path
+        self.progress_interval = progress_interval
+        self.error_message = error_message or (lambda e: e.args[0] if e.args else repr(e))
+        self._queue = Queue.Queue()
+        self._workers = []
+
+        # Queued jobs only live in memory, anything unfinished was lost with the previous process.
+        self.db.fail_unfinished_jobs("Interrupted by a restart of the application.")
+        if retention_days is not None:
+            self.delete_finished_jobs(datetime.datetime.utcnow() - datetime.timedelta(days=retention_days))
+        for _ in range(workers):
+            worker = threading.Thread(target=self._work, name='sample-db-job-worker')
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, kind, func, rows_total=None, result_name=None):
+        """
+        Queue a job.
+        :param kind: Short description of the work, e.g. 'plate_upload'.
+        :param func: Callable doing the work, see JobQueue.
+        :param rows_total: Optional number of rows the job will process.
+        :param result_name: File name the result is downloaded as.
+        :return: The queued Job
+        """
+        job = self.db.create_job(kind, rows_total, result_name)
+        self._queue.put((job.id, func))
+        return job
+
+    def delete_finished_jobs(self, before):
+        """
+        Delete the jobs that finished before a point in time, along with their result files.
+        :param before: UTC time.
+        """
+        for result_path in self.db.delete_finished_jobs(before):
+            if not os.path.exists(result_path):
+                continue
+            try:
+                os.remove(result_path)
+            except OSError:
+                logging.warning("Result %s of a deleted job could not be removed", result_path)
+
+    def join(self):
+        """
+        Block until every queued job has finished.
+        """
+        self._queue.join()
+
+    def _work(self):
+        while True:
+            job_id, func = self._queue.get()
+            try:
+                self._run(job_id, func)
+            except Exception:
+                logging.exception("Job %s could not be recorded", job_id)
+            finally:
+                self.db.remove_session()
+                self._queue.task_done()
+
+    def _run(self, job_id, func):
+        self.db.update_job(job_id, {'status': 'running'})
+        progress = JobProgress(self.db, job_id, self.progress_interval)
+        try:
+            result = func(progress)
+            if not os.path.exists(self.results_path):
+                os.makedirs(self.results_path)
+            if isinstance(result, dict):
+                result_path = os.path.join(self.results_path, '{}.json'.format(job_id))
+                with open(result_path, 'wb') as f:
+                    json.dump(result, f)
+            else:
+                result_path = os.path.join(self.results_path, '{}.csv'.format(job_id))
+                with open(result_path, 'wb') as f:
+                    for chunk in result:
+                        f.write(chunk)
+        except Exception as e:
+            self.db.update_job(job_id, {'status': 'failed', 'rows_processed': progress.rows_processed,
+                                        'error': self.error_message(e)})
+        else:
+            self.db.update_job(job_id, {'status': 'done', 'rows_processed': progress.rows_processed,
+                                        'result_path': result_path})
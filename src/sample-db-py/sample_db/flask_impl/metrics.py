@@ -0,0 +1,181 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy.pool import QueuePool
+
+# Media type of the Prometheus text exposition format.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(['{}="{}"'.format(name, _escape(value)) for name, value in pairs]) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    """
+    A named metric with one value per combination of label values, rendered in the Prometheus text format.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError('{} takes labels {}'.format(self.name, ', '.join(self.labels)))
+        return tuple(labels)
+
+    def samples(self):
+        """
+        :return: List of (name suffix, label values, extra labels, value)
+        """
+        with self._lock:
+            return [('', key, (), value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, key, extra, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, _format_labels(self.labels, key, extra),
+                                            _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, labels=()):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in sorted(self._values.items())]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', key, [('le', _format_value(bound))], cumulative))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), cumulative))
+        return samples
+
+
+REGISTRY = []
+
+
+def render():
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+    return '\n'.join([_.render() for _ in REGISTRY]) + '\n'
+
+
+REQUESTS = Counter('sampledb_http_requests_total', 'Requests handled, by route, method and status code.',
+                   ['route', 'method', 'status'])
+REQUEST_ERRORS = Counter('sampledb_http_request_errors_total',
+                         'Requests failing with a server error, by route and method.', ['route', 'method'])
+REQUEST_LATENCY = Histogram('sampledb_http_request_duration_seconds',
+                            'Time spent handling requests, by route and method.', ['route', 'method'])
+POOL_CHECKOUT_WAIT = Histogram('sampledb_db_pool_checkout_wait_seconds',
+                               'Time spent waiting for a database connection from the pool.',
+                               buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0))
+SQLITE_BUSY = Counter('sampledb_sqlite_busy_total',
+                      'Statements failing on a database SQLite reported busy or locked after its busy timeout.')
+IMPORT_ROWS = Counter('sampledb_import_rows_total', 'Rows of uploaded files imported, by kind of import.', ['kind'])
+IMPORT_SECONDS = Counter('sampledb_import_seconds_total', 'Time spent importing uploaded files, by kind of import.',
+                         ['kind'])
+IMPORT_ROWS_PER_SECOND = Gauge('sampledb_import_rows_per_second', 'Rows per second of the latest import, by kind.',
+                               ['kind'])
+BACKUP_DURATION = Gauge('sampledb_backup_duration_seconds', 'Time the latest daily database backup took.')
+
+
+@contextmanager
+def timed_import(kind, rows):
+    """
+    Record the import of a number of rows by the block, if it succeeds.
+    """
+    start = time.time()
+    yield
+    duration = time.time() - start
+    IMPORT_ROWS.inc((kind,), rows)
+    IMPORT_SECONDS.inc((kind,), duration)
+    if duration:
+        IMPORT_ROWS_PER_SECOND.set(rows / duration, (kind,))
+
+
+def count_sqlite_busy(context):
+    """
+    handle_error listener counting statements that failed on a busy or locked SQLite database.
+    """
+    # SQLITE_BUSY and SQLITE_LOCKED, 'database is locked' and 'database table is locked'.
+    if 'is locked' in str(context.original_exception):
+        SQLITE_BUSY.inc()
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool recording how long each checkout waits for a connection, including opening a new one.
+    """
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            POOL_CHECKOUT_WAIT.observe(time.time() - start)
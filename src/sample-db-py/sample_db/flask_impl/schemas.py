@@ -1,5 +1,5 @@
 from ..db_impl.models import Study, StudySubject, SpecimenType, Specimen, Location, StorageContainer, MatrixPlate, \
-    MatrixTube
+    MatrixTube, CountSummary, Job, Tombstone
 from marshmallow import fields
 from marshmallow_sqlalchemy import ModelSchema
 
@@ -65,6 +65,21 @@ class MatrixPlateSchema(BaseSchema):
     location = fields.String(attribute="location_id")
 
 
+class CountSummarySchema(BaseSchema):
+    class Meta:
+        model = CountSummary
+    scope_id = fields.String()
+
 
+class JobSchema(BaseSchema):
+    class Meta:
+        model = Job
+        exclude = ('result_path',)
 
 
+class TombstoneSchema(BaseSchema):
+    class Meta:
+        model = Tombstone
+    row_id = fields.String()
+    study_id = fields.String()
+    plate_id = fields.String()
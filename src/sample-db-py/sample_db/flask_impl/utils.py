@@ -1,6 +1,9 @@
 import os
 import datetime
 import shutil
+import time
+
+from .metrics import BACKUP_DURATION
 
 
 def backup_db(path, backup_dir, date_format="%d-%b-%y"):
@@ -23,6 +26,8 @@ def backup_db(path, backup_dir, date_format="%d-%b-%y"):
             )
         )
         try:
+            start = time.time()
             shutil.copy(path, backup_dest)
+            BACKUP_DURATION.set(time.time() - start)
         except IOError:
             pass
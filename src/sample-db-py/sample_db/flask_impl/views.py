@@ -1,10 +1,24 @@
-from . import app, db
-from flask import request, jsonify, send_from_directory, abort, send_file
+from . import app, db, job_queue
+import io
+import time
+import gzip
+import hashlib
+import functools
+import logging
+import itertools
+
+from flask import g, request, jsonify, send_from_directory, send_file, abort, Response, stream_with_context, \
+    make_response
 from werkzeug.exceptions import NotFound
+from marshmallow import fields, ValidationError
 
+import metrics
 from file_manager import BaseFileManager, DateParseError
+from errors import InvalidUsage, parse_integrity_error
+from ..db_impl.models import CountSummary
+from ..db_impl.occupancy import WellConflictError
 from schemas import StudySchema, StudySubjectSchema, LocationSchema, SpecimenTypeSchema, \
-    MatrixPlateSchema, SpecimenSchema, MatrixTubeSchema
+    MatrixPlateSchema, SpecimenSchema, MatrixTubeSchema, CountSummarySchema, JobSchema, TombstoneSchema
 from sqlalchemy.orm.exc import NoResultFound, UnmappedInstanceError
 from sqlalchemy.exc import IntegrityError
 
@@ -15,65 +29,314 @@ location_schema = LocationSchema()
 specimen_type_schema = SpecimenTypeSchema()
 matrix_plate_schema = MatrixPlateSchema()
 matrix_tube_schema = MatrixTubeSchema()
+count_summary_schema = CountSummarySchema()
+job_schema = JobSchema()
+tombstone_schema = TombstoneSchema()
+
+query_log = logging.getLogger('sample_db.queries')
+query_log.addHandler(logging.NullHandler())
+
+# Media type of responses whose entity lists are sent in columnar form, see entity_response.
+COLUMNAR_MIMETYPE = 'application/vnd.sampledb.columnar+json'
+
+
+@app.before_request
+def record_queries():
+    g.query_stats = db.query_recorder.start()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.time()
+
+
+def record_request(status_code):
+    started = g.pop('request_started', None)
+    if started is None:
+        return
+    # Labelled by the matched URL rule, not the path, to keep the number of series bounded.
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.REQUEST_LATENCY.observe(time.time() - started, (route, request.method))
+    metrics.REQUESTS.inc((route, request.method, str(status_code)))
+    if status_code >= 500:
+        metrics.REQUEST_ERRORS.inc((route, request.method))
 
 
 @app.after_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,If-None-Match')
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+    expose = 'ETag,Last-Modified'
+    if app.config['QUERY_STATS_HEADERS']:
+        expose += ',X-Query-Count,X-Query-Time,X-Query-Most-Repeated'
+    response.headers.add('Access-Control-Expose-Headers', expose)
     return response
 
-field_name_mapping = {
-    'short_code': 'Short Code',
-    'last_updated': 'Last Updated',
-    'is_longitudinal': 'Longitudinal',
-    'lead_person': 'Lead Person',
-    'uid': 'UID',
-    'study_subject': 'Study Subject',
-    'specimen_type': 'Specimen Type',
-    'collection_date': 'Collection Date',
-    'well_position': 'Well Position',
-    'study_subject_id': 'Study Subject',
-    'specimen_type_id': 'Specimen Type'
-}
-
-
-def parse_integrity_error(e):
-    if 'NOT NULL' in e.message:
-        msg = e.message.split(':')[1].strip()
-        field = field_name_mapping.get(msg.split('.')[1], msg.split('.')[1]).title()
-        return "{} Field cannot be empty".format(field)
-    elif 'UNIQUE' in e.message:
-        msg = e.message.split(':')[1].strip()
-        fields = msg.split(" ")
-        fields = [_.split('.')[1] for _ in fields]
-        fields = [_.replace(',', '') for _ in fields]
-        fields = [field_name_mapping.get(_, _) for _ in fields]
-        fields = [_.title() for _ in fields]
-        if len(fields) > 1:
-            s = "Fields [" + "{}, " * (len(fields) - 1) + "{}] are not unique"
-            return s.format(*fields)
-        else:
-            return "{} Field is not unique".format(fields[0])
+
+@app.after_request
+def report_queries(response):
+    """
+    Log the SQL statements of the request, warning about statements repeated often enough to be issued once per
+    row, and send them along as headers in development. Statements of streamed responses executed while the
+    response is sent are not included.
+    """
+    stats = g.pop('query_stats', None)
+    if stats is None:
+        return response
+    db.query_recorder.stop(stats)
+    most_repeated_select = stats.most_repeated_select
+    if most_repeated_select and most_repeated_select[1] >= app.config['QUERY_REPEAT_WARNING']:
+        query_log.warning('%s %s: %r', request.method, request.path, stats)
+    else:
+        query_log.debug('%s %s: %r', request.method, request.path, stats)
+    if app.config['QUERY_STATS_HEADERS']:
+        response.headers['X-Query-Count'] = str(stats.count)
+        response.headers['X-Query-Time'] = '{:.1f}'.format(stats.duration * 1000)
+        if stats.count:
+            statement, times = stats.most_repeated
+            response.headers['X-Query-Most-Repeated'] = '{}; {}'.format(times, statement[:200])
+    return response
+
+
+@app.after_request
+def record_request_metrics(response):
+    record_request(response.status_code)
+    return response
+
+
+@app.teardown_request
+def stop_recording_queries(exception=None):
+    # Requests failing with an unhandled exception skip after_request.
+    stats = g.pop('query_stats', None)
+    if stats is not None:
+        db.query_recorder.stop(stats)
+    record_request(500)
+
+
+@app.after_request
+def compress(response):
+    """
+    Gzip JSON responses of clients that accept it. Small and streamed responses are sent as is.
+    """
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed or \
+            'Content-Encoding' in response.headers or not response.mimetype.endswith('json') or \
+            'gzip' not in request.headers.get('Accept-Encoding', '').lower():
+        return response
+    data = response.get_data()
+    if len(data) < app.config['GZIP_MIN_SIZE']:
+        return response
+    buf = io.BytesIO()
+    with gzip.GzipFile(mode='wb', fileobj=buf, compresslevel=app.config['GZIP_LEVEL']) as f:
+        f.write(data)
+    response.set_data(buf.getvalue())
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    # The encoded bytes differ, so the tag of the content is only a weak validator for them.
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def parse_page_args():
+    """
+    Read the keyset pagination arguments of a list request. Lists are only paginated when a limit is requested or
+    configured with DEFAULT_PAGE_LIMIT, 'all=true' always returns the complete list.
+    :return: limit, after
+    """
+    if request.args.get('all', '').lower() == 'true':
+        return None, None
+    limit = request.args.get('limit', app.config.get('DEFAULT_PAGE_LIMIT'), type=int)
+    after = request.args.get('after', type=int)
+    if limit is not None and limit < 1:
+        raise InvalidUsage("Limit must be a positive integer", status_code=400)
+    return limit, after
+
+
+def parse_bool_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return value.lower() in ('true', '1')
+
+
+def parse_since_arg():
+    """
+    Read the ISO 8601 'since' argument of a change feed, usually the synced_at of the previous response.
+    :return: since as a naive UTC datetime
+    """
+    value = request.args.get('since')
+    if not value:
+        raise InvalidUsage("Since is required", status_code=400)
+    try:
+        since = fields.DateTime().deserialize(value)
+    except ValidationError:
+        raise InvalidUsage("Since must be an ISO 8601 timestamp", status_code=400)
+    if since.utcoffset():
+        since -= since.utcoffset()
+    return since.replace(tzinfo=None)
+
+
+def wants_columnar():
+    """
+    Clients opt into columnar entity lists with 'format=columnar', or by accepting COLUMNAR_MIMETYPE over JSON.
+    """
+    if request.args.get('format'):
+        return request.args['format'] == 'columnar'
+    return request.accept_mimetypes.best_match(['application/json', COLUMNAR_MIMETYPE]) == COLUMNAR_MIMETYPE
+
+
+def columnar(entries):
+    """
+    Columnar form of a list of entries, the field names once and an array of values for each of them.
+    """
+    keys = sorted(entries[0].keys()) if entries else []
+    return {'fields': keys, 'values': [[_[key] for _ in entries] for key in keys]}
+
+
+def entity_response(data, error, **kwargs):
+    """
+    Response for a dict of entities and entity lists. Clients that want it get the lists in columnar form, which
+    does not repeat every field name in every entry.
+    """
+    if not wants_columnar():
+        res = jsonify(data=data, error=error, **kwargs)
     else:
-        return e.message
+        data = dict([(k, columnar(v) if isinstance(v, list) else v) for k, v in data.items()])
+        res = jsonify(data=data, error=error, **kwargs)
+        res.mimetype = COLUMNAR_MIMETYPE
+    if not request.args.get('format'):
+        res.vary.add('Accept')
+    return res
+
+
+def paginated_response(d, err, entries, limit):
+    """
+    Response for a page of entries, 'next' holds the cursor of the following page or null on the last one.
+    """
+    if not limit:
+        return entity_response(d, err)
+    if len(entries) < limit:
+        next_cursor = None
+    elif isinstance(entries[-1], dict):
+        next_cursor = entries[-1]['id']
+    else:
+        next_cursor = str(entries[-1].id)
+    return entity_response(d, err, next=next_cursor)
+
+
+def csv_attachment(rows, filename):
+    """
+    Chunked response streaming CSV rows to the client while they are being generated.
+    """
+    return Response(stream_with_context(rows), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
+
+
+def conditional(scope):
+    """
+    Decorator for GET views that tags responses with the version of a scope as ETag and Last-Modified, and answers
+    304 Not Modified without running the view while the client's If-None-Match still matches. The ID of single row
+    scopes is the view's URL argument.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(**kwargs):
+            version = db.get_version(scope, *kwargs.values())
+            if version is None:
+                return f(**kwargs)
+            etag = version.etag
+            variant = request.query_string
+            if wants_columnar():
+                variant += '|columnar'
+            if variant:
+                etag = "{}-{}".format(etag, hashlib.md5(variant).hexdigest()[:8])
+            if request.if_none_match.contains_weak(etag):
+                res = Response(status=304)
+            else:
+                res = make_response(f(**kwargs))
+            res.set_etag(etag)
+            if version.last_modified:
+                res.last_modified = version.last_modified
+            return res
+        return wrapper
+    return decorator
+
 
+def run_in_background():
+    return request.values.get('background', '').lower() == 'true'
 
-class InvalidUsage(Exception):
-    status_code = 400
 
-    def __init__(self, message, status_code=None, payload=None):
-        Exception.__init__(self)
-        self.message = message
-        if status_code is not None:
-            self.status_code = status_code
-        self.payload = payload
+def job_response(job):
+    """
+    Response for a request handed off to the job queue, the client polls /jobs/<id> for the outcome.
+    """
+    d, err = job_schema.dump(job)
+    res = jsonify(data=d, error=err)
+    res.status_code = 202
+    return res
+
 
-    def to_dict(self):
-        rv = dict(self.payload or ())
-        rv['message'] = self.message
-        return rv
+def dump_plate_changes(matrix_plates, study_subjects, specimens, matrix_tubes, many=False):
+    plate_entry, plate_err = matrix_plate_schema.dump(matrix_plates, many=many)
+    study_subject_entry, study_subject_err = study_subject_schema.dump(study_subjects, many=True)
+    specimen_entry, specimen_err = specimen_schema.dump(specimens, many=True)
+    matrix_tube_entry, matrix_tube_err = matrix_tube_schema.dump(matrix_tubes, many=True)
+    d = {
+        'matrix_plate': plate_entry,
+        'study_subject': study_subject_entry,
+        'specimen': specimen_entry,
+        'matrix_tube': matrix_tube_entry
+    }
+    err = {
+        'matrix_plate': plate_err,
+        'study_subject': study_subject_err,
+        'specimen': specimen_err,
+        'matrix_tube': matrix_tube_err
+    }
+    return d, err
+
+
+def changes_response(scope, scope_schema, changes):
+    """
+    Response of a change feed, 'synced_at' is the since of the next request. Clients drop the rows listed under
+    'tombstone' before applying the changed rows.
+    """
+    scope_entry, scope_err = scope_schema.dump(changes.scope)
+    study_subject_entry, study_subject_err = study_subject_schema.dump(changes.study_subjects, many=True)
+    specimen_entry, specimen_err = specimen_schema.dump(changes.specimens, many=True)
+    matrix_tube_entry, matrix_tube_err = matrix_tube_schema.dump(changes.matrix_tubes, many=True)
+    tombstone_entry, tombstone_err = tombstone_schema.dump(changes.tombstones, many=True)
+    d = {
+        scope: scope_entry,
+        'study_subject': study_subject_entry,
+        'specimen': specimen_entry,
+        'matrix_tube': matrix_tube_entry,
+        'tombstone': tombstone_entry
+    }
+    err = {
+        scope: scope_err,
+        'study_subject': study_subject_err,
+        'specimen': specimen_err,
+        'matrix_tube': matrix_tube_err,
+        'tombstone': tombstone_err
+    }
+    return entity_response(d, err, synced_at=changes.synced_at.isoformat())
+
+
+def dry_run_response(entries, report):
+    """
+    Response listing every entry of a dry run that failed validation, entries are numbered from 1.
+    """
+    rows = [{'row': i + 1, 'barcode': entry.get('barcode'), 'well_position': entry.get('well_position'),
+             'errors': errors} for i, (entry, errors) in enumerate(zip(entries, report)) if errors]
+    return jsonify(data={'valid': not rows, 'rows': rows}, error={})
+
+
+def conflicts_payload(e):
+    return {'conflicts': [{'plate_uid': plate_uid, 'well_position': well_position}
+                          for plate_uid, well_position in e.conflicts]}
 
 
 @app.errorhandler(InvalidUsage)
@@ -96,11 +359,18 @@ def check_status():
     return jsonify(status="online")
 
 
+@app.route('/metrics')
+def get_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route('/study', methods=['GET'])
+@conditional('studies')
 def get_studies():
-    studies = db.get_studies()
+    limit, after = parse_page_args()
+    studies = db.get_studies(limit, after)
     d, err = study_schema.dump(studies, many=True)
-    res = jsonify(data=d, error=err)
+    res = paginated_response(d, err, studies, limit)
     return res
 
 
@@ -149,13 +419,18 @@ def create_or_update_study():
 
 
 @app.route('/study/<int:study_id>', methods=['GET'])
+@conditional('study')
 def get_study(study_id):
+    limit, after = parse_page_args()
     try:
-        study, study_subjects, specimens, matrix_tubes = db.get_study(study_id)
-        study_entries, study_error = study_schema.dump(study)
-        study_subject_entries, study_subject_error = study_subject_schema.dump(study_subjects, many=True)
-        specimen_entries, specimen_error = specimen_schema.dump(specimens, many=True)
-        matrix_tube_entries, matrix_tube_error = matrix_tube_schema.dump(matrix_tubes, many=True)
+        # Large studies are dumped through projections, ModelSchema dumps of every tube are too slow.
+        study_entries, study_subject_entries, specimen_entries, matrix_tube_entries = db.dump_study(
+            study_id, limit, after,
+            exhausted=parse_bool_arg('exhausted'),
+            specimen_type_id=request.args.get('specimen_type', type=int),
+            plate_id=request.args.get('plate', type=int))
+        if not study_entries:
+            raise NoResultFound
         d = {
             'study': study_entries,
             'study_subject': study_subject_entries,
@@ -163,18 +438,28 @@ def get_study(study_id):
             'matrix_tube': matrix_tube_entries
         }
         err = {
-            'study': study_error,
-            'study_subject': study_subject_error,
-            'specimen': specimen_error,
-            'matrix_tube': matrix_tube_error
+            'study': {},
+            'study_subject': {},
+            'specimen': {},
+            'matrix_tube': {}
         }
 
-        res = jsonify(data=d, error=err)
+        res = paginated_response(d, err, matrix_tube_entries, limit)
         return res
     except NoResultFound:
         raise InvalidUsage("Study does not exist", status_code=404)
 
 
+@app.route('/study/<int:study_id>/changes', methods=['GET'])
+def get_study_changes(study_id):
+    since = parse_since_arg()
+    try:
+        changes = db.get_study_changes(study_id, since)
+        return changes_response('study', study_schema, changes)
+    except NoResultFound:
+        raise InvalidUsage("Study does not exist", status_code=404)
+
+
 @app.route('/study/<int:study_id>', methods=['DELETE'])
 def delete_study(study_id):
     try:
@@ -206,7 +491,8 @@ def add_study_subject_file(study_id):
             study_subject_uids = bf.parse_study_subject_file(study_subject_file)
         except:
             raise KeyError
-        db.add_study_subjects(study_subject_uids, study_id)
+        with metrics.timed_import('study_subject_upload', len(study_subject_uids)):
+            db.add_study_subjects(study_subject_uids, study_id)
         study_subjects = db.get_study_subjects(study_id)
         d, err = study_subject_schema.dump(study_subjects, many=True)
         return jsonify(success=True, data=d, error=err)
@@ -219,6 +505,7 @@ def add_study_subject_file(study_id):
 
 
 @app.route('/location', methods=['GET'])
+@conditional('locations')
 def get_locations():
     locations = db.get_locations()
     d, err = location_schema.dump(locations, many=True)
@@ -245,6 +532,7 @@ def create_or_update_location():
 
 
 @app.route('/location/<int:location_id>', methods=['GET'])
+@conditional('location')
 def get_location(location_id):
     try:
         location = db.get_location(location_id)
@@ -267,6 +555,7 @@ def delete_location(location_id):
 
 
 @app.route('/specimen-type', methods=['GET'])
+@conditional('specimen_types')
 def get_specimen_types():
     specimen_types = db.get_specimen_types()
     d, err = specimen_type_schema.dump(specimen_types, many=True)
@@ -293,6 +582,7 @@ def create_or_update_specimen_type():
 
 
 @app.route('/specimen-type/<int:specimen_type_id>', methods=['GET'])
+@conditional('specimen_type')
 def get_specimen_type(specimen_type_id):
     try:
         location = db.get_specimen_type(specimen_type_id)
@@ -329,22 +619,21 @@ def delete_study_subject(study_subject_id):
 
 
 @app.route('/plate', methods=['GET'])
+@conditional('plates')
 def get_plates():
-    plates = db.get_matrix_plates()
+    limit, after = parse_page_args()
+    plates = db.get_matrix_plates(limit, after, hidden=parse_bool_arg('hidden'))
     d, err = matrix_plate_schema.dump(plates, many=True)
-    return jsonify(data=d, error=err)
+    return paginated_response(d, err, plates, limit)
 
 
 @app.route('/plate/<int:plate_id>', methods=['GET'])
+@conditional('plate')
 def get_plate(plate_id):
     try:
-        plate, study_subjects, specimens, matrix_tubes = db.get_matrix_plate(plate_id)
-        if not plate:
+        plate_entry, study_subject_entry, specimen_entry, matrix_tube_entry = db.dump_matrix_plate(plate_id)
+        if not plate_entry:
             raise NoResultFound
-        plate_entry, plate_err = matrix_plate_schema.dump(plate)
-        study_subject_entry, study_subject_err = study_subject_schema.dump(study_subjects, many=True)
-        specimen_entry, specimen_err = specimen_schema.dump(specimens, many=True)
-        matrix_tube_entry, matrix_tube_err = matrix_tube_schema.dump(matrix_tubes, many=True)
         d = {
             'matrix_plate': plate_entry,
             'study_subject': study_subject_entry,
@@ -352,12 +641,22 @@ def get_plate(plate_id):
             'matrix_tube': matrix_tube_entry
         }
         err = {
-            'matrix_plate': plate_err,
-            'study_subject': study_subject_err,
-            'specimen': specimen_err,
-            'matrix_tube': matrix_tube_err
+            'matrix_plate': {},
+            'study_subject': {},
+            'specimen': {},
+            'matrix_tube': {}
         }
-        return jsonify(data=d, error=err)
+        return entity_response(d, err)
+    except NoResultFound:
+        raise InvalidUsage("Plate does not exist", status_code=404)
+
+
+@app.route('/plate/<int:plate_id>/changes', methods=['GET'])
+def get_plate_changes(plate_id):
+    since = parse_since_arg()
+    try:
+        changes = db.get_matrix_plate_changes(plate_id, since)
+        return changes_response('matrix_plate', matrix_plate_schema, changes)
     except NoResultFound:
         raise InvalidUsage("Plate does not exist", status_code=404)
 
@@ -371,31 +670,28 @@ def upload_plate():
         location_id = int(request.form['location_id'])
         create_missing_subjects = request.form['create_missing_subjects']
         create_missing_specimens = request.form['create_missing_specimens']
+        dry_run = request.form.get('dry_run', '').lower() == 'true'
         if plate_file:
             specimen_entries = bf.parse_new_plate_file(plate_file)
         else:
             specimen_entries = []
-        matrix_plate, study_subjects, specimens, matrix_tubes = db.add_matrix_plate_with_specimens(plate_uid, location_id,
-                                                                                     specimen_entries,
-                                                                                     create_missing_specimens,
-                                                                                     create_missing_subjects)
-        plate_entry, plate_err = matrix_plate_schema.dump(matrix_plate)
-        study_subject_entry, study_subject_err = study_subject_schema.dump(study_subjects, many=True)
-        specimen_entry, specimen_err = specimen_schema.dump(specimens, many=True)
-        matrix_tube_entry, matrix_tube_err = matrix_tube_schema.dump(matrix_tubes, many=True)
-        d = {
-            'matrix_plate': plate_entry,
-            'study_subject': study_subject_entry,
-            'specimen': specimen_entry,
-            'matrix_tube': matrix_tube_entry
-        }
-        err = {
-            'matrix_plate': plate_err,
-            'study_subject': study_subject_err,
-            'specimen': specimen_err,
-            'matrix_tube': matrix_tube_err
-        }
-        return jsonify(data=d, error=err)
+        if dry_run:
+            report = db.add_matrix_plate_with_specimens(plate_uid, location_id, specimen_entries,
+                                                        create_missing_specimens, create_missing_subjects,
+                                                        dry_run=True)
+            return dry_run_response(specimen_entries, report)
+
+        def upload(progress):
+            with metrics.timed_import('plate_upload', len(specimen_entries)):
+                plate_changes = db.add_matrix_plate_with_specimens(plate_uid, location_id, specimen_entries,
+                                                                   create_missing_specimens, create_missing_subjects,
+                                                                   progress=progress)
+            d, err = dump_plate_changes(*plate_changes)
+            return {'data': d, 'error': err}
+
+        if run_in_background():
+            return job_response(job_queue.submit('plate_upload', upload, len(specimen_entries), 'plate_upload.json'))
+        return entity_response(**upload(lambda _: None))
     except KeyError:
         raise InvalidUsage("File Malformed, should be .csv and header should contain ['Barcode', 'Well', 'UID', "
                            "'Specimen Type', 'Date', 'Study Short Code', 'Comments']", status_code=403)
@@ -405,6 +701,8 @@ def upload_plate():
         raise InvalidUsage("File Malformed. Are all study codes valid and specimen types registered?", status_code=403)
     except DateParseError as e:
         raise InvalidUsage(e.message, status_code=403)
+    except WellConflictError as e:
+        raise InvalidUsage(e.message, status_code=403, payload=conflicts_payload(e))
     except ValueError as e:
         raise InvalidUsage(e.args[0], status_code=403)
 
@@ -457,24 +755,20 @@ def update_plates():
         updated_matrix_tubes = []
         for plate_file in plate_files:
             updated_matrix_tubes += bf.parse_plate_update_file(plate_file)
-        matrix_plates, study_subjects, specimens, matrix_tubes = db.update_matrix_tube_locations(updated_matrix_tubes)
-        plate_entry, plate_err = matrix_plate_schema.dump(matrix_plates, many=True)
-        study_subject_entry, study_subject_err = study_subject_schema.dump(study_subjects, many=True)
-        specimen_entry, specimen_err = specimen_schema.dump(specimens, many=True)
-        matrix_tube_entry, matrix_tube_err = matrix_tube_schema.dump(matrix_tubes, many=True)
-        d = {
-            'matrix_plate': plate_entry,
-            'study_subject': study_subject_entry,
-            'specimen': specimen_entry,
-            'matrix_tube': matrix_tube_entry
-        }
-        err = {
-            'matrix_plate': plate_err,
-            'study_subject': study_subject_err,
-            'specimen': specimen_err,
-            'matrix_tube': matrix_tube_err
-        }
-        return jsonify(data=d, error=err)
+        if request.form.get('dry_run', '').lower() == 'true':
+            report = db.update_matrix_tube_locations(updated_matrix_tubes, dry_run=True)
+            return dry_run_response(updated_matrix_tubes, report)
+
+        def update(progress):
+            with metrics.timed_import('plate_update', len(updated_matrix_tubes)):
+                plate_changes = db.update_matrix_tube_locations(updated_matrix_tubes, progress=progress)
+            d, err = dump_plate_changes(*plate_changes, many=True)
+            return {'data': d, 'error': err}
+
+        if run_in_background():
+            return job_response(job_queue.submit('plate_update', update, len(updated_matrix_tubes),
+                                                 'plate_update.json'))
+        return entity_response(**update(lambda _: None))
     except KeyError:
         raise InvalidUsage("File Malformed, should be .csv, file names should be plate UID, and header should contain"
                            " ['Well', 'Barcode', 'Comments']", status_code=403)
@@ -485,6 +779,8 @@ def update_plates():
             raise InvalidUsage(e.args[0], status_code=403)
         else:
             raise InvalidUsage("One or more items do not exist", status_code=403)
+    except WellConflictError as e:
+        raise InvalidUsage(e.message, status_code=403, payload=conflicts_payload(e))
     except ValueError as e:
         raise InvalidUsage(e.args[0], status_code=403)
 
@@ -506,13 +802,23 @@ def search_for_specimens():
     try:
         search_file = request.files.get('files')
         parsed_specimen_entries = bf.parse_specimen_search_file(search_file)
-        matrix_tubes = db.find_specimens(parsed_specimen_entries)
-        header = matrix_tubes[0].keys()
-        header.remove('Well')
-        header.remove('Plate UID')
-        header = ['Plate UID', 'Well'] + header
-        temp_path = bf.create_specimen_search_file(matrix_tubes, header)
-        return send_file(temp_path, as_attachment=True, attachment_filename="specimen_search.csv")
+
+        def search(progress):
+            matrix_tubes = db.iter_find_specimens(parsed_specimen_entries, progress=progress)
+            try:
+                first_matrix_tube = next(matrix_tubes)
+            except StopIteration:
+                raise InvalidUsage("File could not be converted.", status_code=403)
+            header = first_matrix_tube.keys()
+            header.remove('Well')
+            header.remove('Plate UID')
+            header = ['Plate UID', 'Well'] + header
+            return bf.stream_csv(itertools.chain([first_matrix_tube], matrix_tubes), header)
+
+        if run_in_background():
+            return job_response(job_queue.submit('specimen_search', search, len(parsed_specimen_entries),
+                                                 'specimen_search.csv'))
+        return csv_attachment(search(None), "specimen_search.csv")
     except DateParseError as e:
         raise InvalidUsage(e.message, status_code=403)
     except KeyError:
@@ -528,17 +834,24 @@ def search_by_barcode():
     try:
         search_file = request.files.get('files')
         barcoded_entries, fields, barcode_index = bf.parse_barcode_search_file(search_file)
-        entries = db.convert_barcoded_entries(barcoded_entries)
-        if entries:
-            if 'Date' in entries[0].keys():
+
+        def search(progress):
+            entries = db.iter_convert_barcoded_entries(barcoded_entries, progress=progress)
+            try:
+                first_entry = next(entries)
+            except StopIteration:
+                raise InvalidUsage("File could not be converted.", status_code=403)
+            if 'Date' in first_entry.keys():
                 new_header = ['Study Subject UID', 'Study Short Code', 'Date', 'Specimen Type', 'Comments']
             else:
                 new_header = ['Study Subject UID', 'Study Short Code', 'Specimen Type', 'Comments']
             header = fields[:barcode_index] + new_header + fields[barcode_index + 1:]
-            temp_path = bf.create_barcode_search_file(entries, header)
-            return send_file(temp_path, as_attachment=True, attachment_filename="barcode_search.csv")
-        else:
-            raise InvalidUsage("File could not be converted.", status_code=403)
+            return bf.stream_csv(itertools.chain([first_entry], entries), header)
+
+        if run_in_background():
+            return job_response(job_queue.submit('barcode_search', search, len(barcoded_entries),
+                                                 'barcode_search.csv'))
+        return csv_attachment(search(None), "barcode_search.csv")
     except KeyError:
         raise InvalidUsage("File Malformed, should be .csv and header should contain ['Barcode']", status_code=403)
     except ValueError as e:
@@ -551,9 +864,7 @@ def delete_specimens():
     try:
         specimens_file = request.files.get('files')
         parsed_specimen_entries = bf.parse_specimen_search_file(specimens_file)
-        matrix_tubes = db.get_matrix_tubes_from_specimens(parsed_specimen_entries)
-        specimens = [_.specimen for _ in matrix_tubes]
-        matrix_tube_ids, specimen_ids = db.delete_matrix_tubes_and_specimens(matrix_tubes, specimens)
+        matrix_tube_ids, specimen_ids = db.delete_specimens(parsed_specimen_entries)
         return jsonify(data={'matrix_tube_ids': matrix_tube_ids,
                              'specimen_ids': specimen_ids},
                        error={})
@@ -570,19 +881,54 @@ def delete_barcodes():
     try:
         barcodes_file = request.files.get('files')
         barcodes = bf.parse_barcode_file(barcodes_file)
-        matrix_tubes = db.get_matrix_tubes(barcodes)
-        specimens = [_.specimen for _ in matrix_tubes]
-        matrix_tube_ids, specimen_ids = db.delete_matrix_tubes_and_specimens(matrix_tubes, specimens)
+        matrix_tube_ids, specimen_ids = db.delete_matrix_tubes_by_barcode(barcodes, with_specimens=True)
         return jsonify(data={'matrix_tube_ids': matrix_tube_ids,
                              'specimen_ids': specimen_ids},
                        error={})
     except KeyError:
         raise InvalidUsage("File Malformed, should be .csv, header should contain"
                            " ['Barcode']", status_code=403)
+    except NoResultFound as e:
+        raise InvalidUsage(e.args[0], status_code=403)
     except ValueError as e:
         raise InvalidUsage(e.args[0], status_code=403)
 
 
+@app.route('/summary', methods=['GET'])
+def get_count_summaries():
+    scope = request.args.get('scope')
+    try:
+        summaries = db.get_count_summaries(scope)
+    except ValueError as e:
+        raise InvalidUsage(e.message, status_code=400)
+    d, err = count_summary_schema.dump(summaries, many=True)
+    data = dict([(_, []) for _ in ([scope] if scope else CountSummary.scopes)])
+    for summary in d:
+        data[summary['scope']].append(summary)
+    return jsonify(data=data, error=err)
+
+
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+def get_job(job_id):
+    try:
+        job = db.get_job(job_id)
+    except NoResultFound as e:
+        raise InvalidUsage(e.args[0], status_code=404)
+    d, err = job_schema.dump(job)
+    return jsonify(data=d, error=err)
+
+
+@app.route('/jobs/<int:job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    try:
+        job = db.get_job(job_id)
+    except NoResultFound as e:
+        raise InvalidUsage(e.args[0], status_code=404)
+    if job.status != 'done':
+        raise InvalidUsage("Job {} has not finished.".format(job_id), status_code=409)
+    return send_file(job.result_path, as_attachment=True, attachment_filename=job.result_name)
+
+
 @app.route('/log-error', methods=['POST'])
 def log_error():
     payload = request.get_json()